@@ -0,0 +1,184 @@
+"""
+Бенчмарк /export: время и пиковый RSS в зависимости от числа заказов.
+
+Каждый замер идёт в отдельном процессе (пик RSS не наследуется от
+предыдущих прогонов): песочница с N заказами по 1–3 позиции, N/10
+пользователей и доставкой каждого второго заказа, затем
+build_export_archive по всем наборам. RSS снимается из /proc каждые 10 мс
+во время выгрузки; без /proc — ru_maxrss за весь процесс.
+
+Пример:
+  python bench_export.py --rows 1000,10000,100000 --formats csv,parquet
+  python bench_export.py --rows 100000 --chunk-rows 5000,1000000
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fake_telegram import FakeTelegramAPI
+from replay_updates import REPO_DIR, import_bot, prepare_sandbox
+
+ROW_COUNTS = (1000, 10000, 100000)
+FLAVORS = [f"Flavor {index:03d}" for index in range(200)]
+
+
+def rss_bytes() -> int | None:
+    try:
+        with open("/proc/self/status", encoding="ascii") as file_obj:
+            for line in file_obj:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class PeakRss:
+    """Фоновый опрос VmRSS; peak — максимум за время работы."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = rss_bytes() or 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+
+    def _poll(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes() or 0)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes() or 0)
+
+
+def seed(bot_module, orders: int) -> None:
+    now = bot_module.utc_now_iso()
+    conn = bot_module.get_db_connection()
+    try:
+        conn.executemany(
+            "INSERT INTO orders (chat_id, items_json, total, timestamp, payment_status) "
+            "VALUES (?, ?, ?, ?, 'cash')",
+            (
+                (
+                    index % max(orders // 10, 1),
+                    json.dumps([
+                        {"category": "VOZOL Gear 20000", "flavor": random.choice(FLAVORS), "price": 1300}
+                        for _ in range(1 + index % 3)
+                    ], ensure_ascii=False),
+                    1300 * (1 + index % 3),
+                    now,
+                )
+                for index in range(orders)
+            ),
+        )
+        conn.execute(
+            "INSERT INTO delivered_log (order_id, currency, qty, timestamp) "
+            "SELECT order_id, 'cash', 1, timestamp FROM orders WHERE order_id % 2 = 0"
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (chat_id, points, username, registered_at) VALUES (?, ?, ?, ?)",
+            ((chat_id, chat_id % 500, f"user{chat_id}", now) for chat_id in range(max(orders // 10, 1))),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def run_child(orders: int, fmt: str, chunk_rows: int | None) -> dict:
+    random.seed(0)
+    data_dir = prepare_sandbox(REPO_DIR)
+    try:
+        bot_module = import_bot(data_dir, FakeTelegramAPI(), [], threading.Lock())
+        if chunk_rows:
+            bot_module.EXPORT_CHUNK_ROWS = chunk_rows
+        seed(bot_module, orders)
+        bot_module.refresh_analytics_replica()
+        import pandas  # noqa: F401  (импорт не должен попадать в замер)
+        if fmt == "parquet":
+            import pyarrow.parquet  # noqa: F401
+
+        before = rss_bytes()
+        with tempfile.TemporaryDirectory() as work_dir, PeakRss() as peak:
+            started = time.perf_counter()
+            result = bot_module.build_export_archive(list(bot_module.EXPORT_DATASETS), fmt, work_dir)
+            seconds = time.perf_counter() - started
+        if before is None:
+            # Без /proc: пик за весь процесс (Linux — КБ, macOS — байты).
+            scale = 1 if sys.platform == "darwin" else 1024
+            peak.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        return {
+            "orders": orders,
+            "format": fmt,
+            "chunk_rows": bot_module.EXPORT_CHUNK_ROWS,
+            "rows": result["rows"],
+            "seconds": round(seconds, 3),
+            "archive_bytes": result["bytes"],
+            "rss_before_mb": round(before / 2 ** 20, 1) if before else None,
+            "peak_rss_mb": round(peak.peak / 2 ** 20, 1),
+            "peak_delta_mb": round((peak.peak - before) / 2 ** 20, 1) if before else None,
+        }
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", default=",".join(str(count) for count in ROW_COUNTS),
+                        help="число заказов через запятую")
+    parser.add_argument("--formats", default="csv,parquet")
+    parser.add_argument("--chunk-rows", default="",
+                        help="размеры порций через запятую (по умолчанию — как в боте)")
+    parser.add_argument("--output", default="bench_export_output.json")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        chunk_rows = int(args.chunk_rows) if args.chunk_rows else None
+        print(json.dumps(run_child(int(args.rows), args.formats, chunk_rows)))
+        return 0
+
+    results = []
+    print(f"{'orders':>8}{'format':>9}{'chunk':>9}{'line rows':>11}{'seconds':>9}"
+          f"{'peak MB':>9}{'Δ MB':>8}{'zip KB':>9}")
+    for orders in (int(value) for value in args.rows.split(",")):
+        for fmt in args.formats.split(","):
+            for chunk_rows in (args.chunk_rows.split(",") if args.chunk_rows else [""]):
+                completed = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--child",
+                     "--rows", str(orders), "--formats", fmt, "--chunk-rows", chunk_rows],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                )
+                result = json.loads(completed.stdout.strip().splitlines()[-1])
+                results.append(result)
+                print(f"{orders:>8}{fmt:>9}{result['chunk_rows']:>9}{result['rows']['orders']:>11}"
+                      f"{result['seconds']:>9}{result['peak_rss_mb']:>9}"
+                      f"{result['peak_delta_mb'] if result['peak_delta_mb'] is not None else '—':>8}"
+                      f"{result['archive_bytes'] // 1024:>9}", flush=True)
+
+    with open(args.output, "w", encoding="utf-8") as file_obj:
+        json.dump({
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }, file_obj, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+"""
+Микробенчмарки горячих функций bot.py на синтетических каталогах.
+
+Каталоги от 10 до 5000 SKU, корзина, история доставок за сегодня и /start
+целиком (новые и вернувшиеся пользователи); каждая функция гоняется в цикле, берётся лучший из нескольких повторов (мкс на
+вызов). Результат — JSON; режим --compare сравнивает с сохранённым
+baseline и падает, если что-то замедлилось сильнее порога.
+
+Пример:
+  python bench_hotpaths.py --output bench_baseline.json
+  python bench_hotpaths.py --compare bench_baseline.json --threshold 0.25
+"""
+import argparse
+import datetime
+import itertools
+import json
+import platform
+import random
+import shutil
+import sys
+import threading
+import time
+import timeit
+
+from fake_telegram import FakeTelegramAPI
+from replay_updates import REPO_DIR, import_bot, prepare_sandbox
+
+CATALOG_SIZES = (10, 100, 1000, 5000)
+FLAVORS_PER_CATEGORY = 50
+CART_ITEMS = 20
+DELIVERIES_TODAY = 200
+BENCH_CHAT_ID = 777000
+START_CHAT_IDS = itertools.count(10 ** 9)
+PAYMENT_DETAIL = (
+    "Bank: Ziraat Bankası\n"
+    "IBAN: TR00 0000 0000 0000 0000 0000 00\n"
+    "Recipient: Load Test\n"
+    "Comment: order number\n"
+    "Plain line without label"
+)
+
+
+def synthetic_catalog(skus: int) -> dict:
+    categories = max(skus // FLAVORS_PER_CATEGORY, 1)
+    per_category = max(skus // categories, 1)
+    menu = {}
+    for category_index in range(categories):
+        name = f"VOZOL Synthetic {category_index:04d} — 20.000 puffs"
+        menu[name] = {
+            "price": 1300 + category_index % 5 * 100,
+            "photo_url": "",
+            "flavors": [
+                {
+                    "emoji": "🍓",
+                    "flavor": f"Flavor {category_index:04d}-{flavor_index:03d}",
+                    "stock": (flavor_index * 7) % 5,
+                    "rating": 4.5 if flavor_index % 3 == 0 else None,
+                    "tags": [],
+                    "description_ru": "Описание вкуса",
+                    "description_en": "Flavor description",
+                    "photo_url": "",
+                }
+                for flavor_index in range(per_category)
+            ],
+        }
+    return menu
+
+
+def install_catalog(bot_module, menu: dict) -> None:
+    with bot_module.menu_lock:
+        bot_module.menu.clear()
+        bot_module.menu.update(menu)
+        bot_module.publish_catalog()
+
+
+def seed_history(bot_module, menu: dict) -> None:
+    """Сегодняшние доставки для compose_sold_report."""
+    products = [(category, item["flavor"], data["price"]) for category, data in menu.items() for item in data["flavors"]]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    conn = bot_module.get_db_connection()
+    try:
+        conn.execute("DELETE FROM delivered_log")
+        conn.execute("DELETE FROM orders")
+        for order_index in range(DELIVERIES_TODAY):
+            items = [
+                {"category": category, "flavor": flavor, "price": price}
+                for category, flavor, price in random.sample(products, min(3, len(products)))
+            ]
+            cursor = conn.execute(
+                "INSERT INTO orders (chat_id, items_json, total, timestamp) VALUES (?, ?, ?, ?)",
+                (BENCH_CHAT_ID, json.dumps(items, ensure_ascii=False), sum(i["price"] for i in items), now.isoformat()),
+            )
+            conn.execute(
+                "INSERT INTO delivered_log (order_id, currency, qty, timestamp) VALUES (?, ?, ?, ?)",
+                (cursor.lastrowid, random.choice(("cash", "rub", "iban", "free")), len(items),
+                 (now - datetime.timedelta(seconds=order_index)).isoformat()),
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def measure(function, min_time: float, repeats: int) -> dict:
+    timer = timeit.Timer(function)
+    loops, _elapsed = timer.autorange()
+    loops = max(int(loops * min_time / 0.2), 1)
+    best = min(timer.repeat(repeat=repeats, number=loops)) / loops
+    return {"us_per_call": round(best * 1e6, 3), "loops": loops}
+
+
+def start_message(bot_module, chat_id: int, text: str = "/start"):
+    return bot_module.types.Message.de_json({
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": chat_id, "type": "private", "first_name": "Bench"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Bench", "language_code": "en"},
+        "text": text,
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    })
+
+
+def start_cases(bot_module):
+    """/start целиком: регистрация нового пользователя и повторный вход."""
+    returning = start_message(bot_module, BENCH_CHAT_ID)
+    bot_module.cmd_start(returning)
+    bot_module.user_data[BENCH_CHAT_ID]["lang"] = "en"
+    bot_module.save_user_language(BENCH_CHAT_ID, "en")
+
+    def new_user():
+        chat_id = next(START_CHAT_IDS)
+        bot_module.cmd_start(start_message(bot_module, chat_id))
+        # Иначе user_data растёт на каждый прогон и мерит уже не /start.
+        bot_module.user_data.pop(chat_id, None)
+
+    return [
+        ("cmd_start.new_user", new_user),
+        ("cmd_start.returning", lambda: bot_module.cmd_start(returning)),
+    ]
+
+
+def benchmark_cases(bot_module, menu: dict):
+    """(имя, функция без аргументов) для текущего каталога."""
+    catalog = bot_module.current_catalog()
+    products = list(catalog.products)
+    hit_token = products[len(products) // 2]
+    largest = max(catalog.categories, key=lambda category: len(category.flavors)).name
+    first_category, first_data = next(iter(menu.items()))
+    first_flavor = first_data["flavors"][0]["flavor"]
+    cart = [
+        {"category": record.category, "flavor": record.flavor, "price": catalog.by_name[record.category].price}
+        for record in random.sample(list(catalog.products.values()), min(CART_ITEMS, len(products)))
+    ]
+    bot_module.user_data[BENCH_CHAT_ID] = {"lang": "en", "cart": cart}
+
+    return [
+        ("_stable_token", lambda: bot_module._stable_token("product", first_category, first_flavor)),
+        ("resolve_product.hit", lambda: bot_module.resolve_product(hit_token)),
+        ("resolve_product.miss", lambda: bot_module.resolve_product("0" * 16)),
+        ("get_inline_flavors", lambda: bot_module.get_inline_flavors(BENCH_CHAT_ID, largest)),
+        ("get_grouped_cart", lambda: bot_module.get_grouped_cart(BENCH_CHAT_ID)),
+        ("checkout_conversion_text", lambda: bot_module.checkout_conversion_text(BENCH_CHAT_ID, 26000, CART_ITEMS)),
+        ("payment_detail_lines", lambda: bot_module.payment_detail_lines(PAYMENT_DETAIL)),
+        ("compose_sold_report", bot_module.compose_sold_report),
+        ("t", lambda: bot_module.t(BENCH_CHAT_ID, "order_accepted")),
+        ("tr", lambda: bot_module.tr(BENCH_CHAT_ID, "Корзина", "Cart")),
+        ("format_money", lambda: bot_module.format_money(1234.5)),
+        *start_cases(bot_module),
+    ]
+
+
+def compare(baseline_path: str, results: dict, threshold: float) -> list[str]:
+    with open(baseline_path, encoding="utf-8") as file_obj:
+        baseline = json.load(file_obj)["results"]
+    regressions = []
+    print(f"\n{'benchmark':<44}{'baseline us':>14}{'current us':>14}{'change':>10}")
+    for name, current in results.items():
+        before = baseline.get(name)
+        if not before:
+            print(f"{name:<44}{'—':>14}{current['us_per_call']:>14}{'new':>10}")
+            continue
+        change = current["us_per_call"] / before["us_per_call"] - 1 if before["us_per_call"] else 0.0
+        flag = "  ⚠" if change > threshold else ""
+        print(f"{name:<44}{before['us_per_call']:>14}{current['us_per_call']:>14}{change:>+9.0%}{flag}")
+        if change > threshold:
+            regressions.append(f"{name}: {before['us_per_call']} → {current['us_per_call']} us ({change:+.0%})")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default=",".join(str(size) for size in CATALOG_SIZES),
+                        help="размеры каталогов в SKU через запятую")
+    parser.add_argument("--min-time", type=float, default=0.2, help="секунд на один повтор")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--only", help="подстрока имени бенчмарка")
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--compare", help="baseline JSON для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="допустимое замедление относительно baseline (0.25 = +25%%)")
+    args = parser.parse_args()
+
+    random.seed(0)
+    data_dir = prepare_sandbox(REPO_DIR)
+    api = FakeTelegramAPI()
+    outputs = []
+    bot_module = import_bot(data_dir, api, outputs, threading.Lock())
+    # Курсы из «свежего» кеша: так же, как в проде между обновлениями.
+    bot_module.set_exchange_rates(
+        {"RUB": 2.6, "USD": 0.03, "EUR": 0.028, "UAH": 1.25},
+        time.time() + 10 ** 6,
+    )
+
+    results = {}
+    try:
+        for size in (int(value) for value in args.sizes.split(",")):
+            menu = synthetic_catalog(size)
+            install_catalog(bot_module, menu)
+            seed_history(bot_module, menu)
+            for name, function in benchmark_cases(bot_module, menu):
+                key = f"{name}[skus={size}]"
+                if args.only and args.only not in key:
+                    continue
+                results[key] = measure(function, args.min_time, args.repeats)
+                # Журналы фейкового API не должны расти от бенчмарка к бенчмарку.
+                api.calls.clear()
+                outputs.clear()
+                print(f"{key:<44}{results[key]['us_per_call']:>12} us", flush=True)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = {
+        "bot_version": bot_module.BOT_VERSION,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as file_obj:
+        json.dump(report, file_obj, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        regressions = compare(args.compare, results, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}:")
+            for line in regressions:
+                print("  " + line)
+            return 1
+        print("\nNo regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
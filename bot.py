@@ -1,31 +1,52 @@
 import os
 import json
 import html
+import multiprocessing
 import hashlib
+import io
+import cProfile
+import pstats
 import requests
 import datetime
 import random
 import re
 import string
+import shutil
 import sqlite3
+import tempfile
 import threading
+import functools
+import heapq
+import time
+import zipfile
+from bisect import bisect_left
 import pytz
+from collections import OrderedDict
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import MappingProxyType
 from urllib.parse import urlencode
+from urllib.request import pathname2url
 
 
 from apscheduler.schedulers.background import BackgroundScheduler
-from telebot import TeleBot, types
+from telebot import TeleBot, apihelper, types
 from telebot.handler_backends import ContinueHandling
 
+import sales_charts
+
 def _normalize(text: str) -> str:
     """
     Убирает эмодзи и любые спецсимволы, заменяя их на пробел,
     сводит к нижнему регистру и склеивает повторяющиеся пробелы.
     """
     # всё, что не буква/цифра → пробел
-    cleaned = re.sub(r'[^0-9A-Za-zА-Яа-я]+', ' ', text)
-    # убрать «лишние» пробелы и привести к lower
-    return re.sub(r'\s+', ' ', cleaned).strip().lower()
+    cleaned = re.sub(r'[^0-9A-Za-zА-Яа-яЁё]+', ' ', text)
+    # убрать «лишние» пробелы и привести к lower; «ё» ищется как «е»
+    return re.sub(r'\s+', ' ', cleaned).strip().lower().replace('ё', 'е')
 
 # ------------------------------------------------------------------------
 #   1. Загрузка переменных окружения и инициализация бота
@@ -74,21 +95,429 @@ print(
     flush=True,
 )
 
+# Локальный Bot API server или фейковый сервер нагрузочного теста
+# (loadtest.py): формат как у telebot, например http://127.0.0.1:8081/bot{0}/{1}
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip()
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL
+
+# Процесс для графиков продаж (sales_charts) форкается здесь, до TeleBot:
+# конструктор сразу поднимает потоки-воркеры, а дочерний процесс после fork
+# из многопоточного получил бы копии чужих блокировок в любом состоянии.
+_chart_pool: ProcessPoolExecutor | None = None
+_chart_pool_lock = threading.Lock()
+
+
+def start_chart_pool() -> None:
+    """
+    Один процесс-воркер через fork, пока в процессе ещё один поток. spawn и
+    forkserver не подходят — multiprocessing заново выполняет в воркере
+    __main__, то есть bot.py со всей инициализацией БД. Воркеру из bot.py
+    ничего не нужно: функции sales_charts передаются по имени модуля.
+    Пул не пересоздаётся на ходу (см. stop_chart_pool).
+    """
+    global _chart_pool
+    if "fork" not in multiprocessing.get_all_start_methods():
+        print("[WARN] Sales charts disabled: fork is not available", flush=True)
+        return
+    if threading.active_count() > 1:
+        print(
+            f"[WARN] Chart worker forked with {threading.active_count()} threads running",
+            flush=True,
+        )
+    with _chart_pool_lock:
+        if _chart_pool is not None:
+            return
+        _chart_pool = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("fork"),
+        )
+    try:
+        # ProcessPoolExecutor запускает процесс лениво — при первой задаче.
+        _chart_pool.submit(sales_charts.warm_up)
+    except Exception as exc:
+        print(f"[WARN] Chart pool not started: {type(exc).__name__}: {exc}", flush=True)
+
+
+if __name__ == "__main__":
+    start_chart_pool()
+
 bot = TeleBot(TOKEN, parse_mode="HTML")
 
 # ------------------------------------------------------------------------
-#   2. Пути к JSON-файлам и БД (персистентный том /data)
+#   2. Пути к JSON-файлам и БД (персистентный том /data, DATA_DIR)
 # ------------------------------------------------------------------------
-MENU_PATH = "/data/menu.json"
-LANG_PATH = "/data/languages.json"
-DB_PATH = "/data/database.db"
+DATA_DIR = os.getenv("DATA_DIR", "/data")
+MENU_PATH = os.path.join(DATA_DIR, "menu.json")
+LANG_PATH = os.path.join(DATA_DIR, "languages.json")
+DB_PATH = os.path.join(DATA_DIR, "database.db")
+# Старые завершённые заказы переносятся в отдельный файл (см. archive_old_orders).
+ARCHIVE_DB_PATH = os.path.join(DATA_DIR, "archive.db")
 # ------------------------------------------------------------------------
-#   3. Функция для получения локального подключения к БД
+#   3. Метрики процесса и подключение к БД
 # ------------------------------------------------------------------------
+# Гистограммы длительностей (секунды) и счётчики с метками. Всё отдаётся
+# в формате Prometheus на локальном /metrics (см. start_metrics_server).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464") or 0)
+PROCESS_STARTED_AT = time.time()
+
+_metrics_lock = threading.Lock()
+_duration_metrics: dict[tuple, list] = {}
+_counter_metrics: dict[tuple, float] = {}
+
+
+def observe_duration(metric: str, seconds: float, **labels) -> None:
+    """Учитывает одно измерение длительности для метрики с метками."""
+    key = (metric, tuple(sorted(labels.items())))
+    bucket = bisect_left(LATENCY_BUCKETS, seconds)
+    with _metrics_lock:
+        stats = _duration_metrics.get(key)
+        if stats is None:
+            stats = _duration_metrics[key] = [0, 0.0, 0.0, [0] * len(LATENCY_BUCKETS)]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+        if bucket < len(LATENCY_BUCKETS):
+            stats[3][bucket] += 1
+
+
+def increment_counter(metric: str, amount: float = 1, **labels) -> None:
+    """Увеличивает счётчик с метками."""
+    key = (metric, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counter_metrics[key] = _counter_metrics.get(key, 0) + amount
+
+
+def format_metric_labels(labels, *extra) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    rendered = []
+    for name, value in pairs:
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        rendered.append(f'{name}="{escaped}"')
+    return "{" + ",".join(rendered) + "}"
+
+
+def render_metrics() -> str:
+    """Текстовый формат Prometheus: гистограммы, максимумы и счётчики."""
+    with _metrics_lock:
+        durations = sorted(
+            (key, stats[0], stats[1], stats[2], list(stats[3]))
+            for key, stats in _duration_metrics.items()
+        )
+        counters = sorted(_counter_metrics.items())
+
+    lines = [
+        "# TYPE bot_build_info gauge",
+        f"bot_build_info{format_metric_labels([('version', BOT_VERSION)])} 1",
+        "# TYPE process_start_time_seconds gauge",
+        f"process_start_time_seconds {PROCESS_STARTED_AT:.3f}",
+    ]
+    typed = set()
+    for (metric, labels), count, total, maximum, buckets in durations:
+        if metric not in typed:
+            typed.add(metric)
+            lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        for bound, in_bucket in zip(LATENCY_BUCKETS, buckets):
+            cumulative += in_bucket
+            lines.append(f"{metric}_bucket{format_metric_labels(labels, ('le', bound))} {cumulative}")
+        lines.append(f"{metric}_bucket{format_metric_labels(labels, ('le', '+Inf'))} {count}")
+        lines.append(f"{metric}_sum{format_metric_labels(labels)} {total:.6f}")
+        lines.append(f"{metric}_count{format_metric_labels(labels)} {count}")
+    for (metric, labels), count, total, maximum, buckets in durations:
+        if f"{metric}_max" not in typed:
+            typed.add(f"{metric}_max")
+            lines.append(f"# TYPE {metric}_max gauge")
+        lines.append(f"{metric}_max{format_metric_labels(labels)} {maximum:.6f}")
+    for (metric, labels), value in counters:
+        if metric not in typed:
+            typed.add(metric)
+            lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric}{format_metric_labels(labels)} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+def sql_operation(sql: str) -> str:
+    words = sql.split(None, 1)
+    return words[0].upper() if words else "EMPTY"
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Курсор, который замеряет каждый запрос и начало транзакции."""
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def _timed(self, run, sql, parameters):
+        connection = self.connection
+        was_in_transaction = connection.in_transaction
+        started = time.perf_counter()
+        try:
+            return run(sql, parameters)
+        finally:
+            observe_duration(
+                "sqlite_statement_seconds",
+                time.perf_counter() - started,
+                op=sql_operation(sql),
+            )
+            if not was_in_transaction and connection.in_transaction:
+                connection.transaction_started = started
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Соединение SQLite с замером длительности транзакций (BEGIN → COMMIT/ROLLBACK)."""
+
+    transaction_started = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # Встроенные conn.execute()/executemany() создают обычный курсор в обход
+    # cursor(), поэтому идут через него явно — иначе запросы не замеряются.
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        self._finish_transaction(super().commit, "commit")
+
+    def rollback(self):
+        self._finish_transaction(super().rollback, "rollback")
+
+    def _finish_transaction(self, finish, outcome: str) -> None:
+        started = self.transaction_started
+        self.transaction_started = None
+        try:
+            finish()
+        finally:
+            if started is not None:
+                observe_duration(
+                    "sqlite_transaction_seconds",
+                    time.perf_counter() - started,
+                    outcome=outcome,
+                )
+
+
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn = sqlite3.connect(
+        DB_PATH,
+        check_same_thread=False,
+        factory=InstrumentedConnection,
+    )
+    return conn
+
+
+# Таблицы, строки которых уходят в archive.db вместе с заказом.
+# promo_redemptions остаётся в основной базе: это не история, а инвариант —
+# по ней checkout проверяет, что покупатель ещё не использовал промокод.
+ARCHIVED_TABLES = ("orders", "delivered_log", "payment_proofs")
+
+
+def sqlite_uri(path: str, **query) -> str:
+    """file:-URI для sqlite3.connect(uri=True) и ATTACH (mode=ro и т.п.)."""
+    uri = "file:" + pathname2url(os.path.abspath(path))
+    return uri + ("?" + urlencode(query) if query else "")
+
+
+def attach_archive_views(conn) -> None:
+    """
+    Подключает archive.db только для чтения и создаёт временные
+    представления all_<таблица>: оперативные строки плюс архивные.
+    """
+    conn.execute("ATTACH DATABASE ? AS archive", (sqlite_uri(ARCHIVE_DB_PATH, mode="ro"),))
+    for table, key in (
+        ("orders", "order_id"),
+        ("delivered_log", "id"),
+        ("payment_proofs", "proof_id"),
+    ):
+        columns = ", ".join(
+            f'"{row[1]}"' for row in conn.execute(f"PRAGMA main.table_info({table})")
+        )
+        # Между копированием в архив и удалением из основной базы строка
+        # может ненадолго оказаться в обеих — берём оперативную копию.
+        conn.execute(
+            f"CREATE TEMP VIEW all_{table} AS "
+            f"SELECT {columns} FROM main.{table} "
+            f"UNION ALL SELECT {columns} FROM archive.{table} "
+            f"WHERE ({key}) NOT IN (SELECT {key} FROM main.{table})"
+        )
+
+
+def get_reporting_connection():
+    """Оперативная база вместе с архивом (история и профиль покупателя)."""
+    conn = sqlite3.connect(
+        sqlite_uri(DB_PATH),
+        uri=True,
+        check_same_thread=False,
+        factory=InstrumentedConnection,
+    )
+    attach_archive_views(conn)
     return conn
 
+
+# ─── Аналитическая реплика ───
+# Отчёты владельца (/stats, /users, /sold, /stocknow, ежедневный отчёт)
+# читают копию базы, снятую backup API по страницам. Полные сканы идут по
+# отдельному файлу и не конкурируют с BEGIN IMMEDIATE в finalize_order.
+# Копия собирается во временном файле и подменяется os.replace, поэтому
+# читатель всегда видит целый снимок; момент снимка хранится в самой копии.
+ANALYTICS_DB_PATH = os.path.join(DATA_DIR, "analytics.db")
+ANALYTICS_REFRESH_MINUTES = 5
+ANALYTICS_MAX_AGE_SECONDS = 15 * 60
+ANALYTICS_PAGES_PER_STEP = 512
+ANALYTICS_STEP_SLEEP_SECONDS = 0.002
+_analytics_lock = threading.Lock()
+_analytics_as_of: datetime.datetime | None = None
+_analytics_background_lock = threading.Lock()
+_analytics_background = False
+
+
+def refresh_analytics_replica() -> datetime.datetime:
+    """Снимает свежую копию базы для отчётов; возвращает момент снимка."""
+    global _analytics_as_of
+    with _analytics_lock:
+        started = time.perf_counter()
+        # Снимок не старше начала копирования: backup API перезапускается,
+        # если база изменилась, и завершается уже согласованной копией.
+        as_of = datetime.datetime.now(datetime.timezone.utc)
+        temporary_path = f"{ANALYTICS_DB_PATH}.tmp"
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        source = sqlite3.connect(DB_PATH, check_same_thread=False)
+        replica = sqlite3.connect(temporary_path)
+        try:
+            source.backup(
+                replica,
+                pages=ANALYTICS_PAGES_PER_STEP,
+                sleep=ANALYTICS_STEP_SLEEP_SECONDS,
+            )
+            # Копия наследует WAL; файлу только для чтения он не нужен.
+            replica.execute("PRAGMA journal_mode = DELETE")
+            replica.execute("CREATE TABLE replica_meta (as_of TEXT NOT NULL)")
+            replica.execute("INSERT INTO replica_meta VALUES (?)", (as_of.isoformat(),))
+            replica.commit()
+        finally:
+            replica.close()
+            source.close()
+        os.replace(temporary_path, ANALYTICS_DB_PATH)
+        _analytics_as_of = as_of
+    observe_duration("analytics_refresh_seconds", time.perf_counter() - started)
+    return as_of
+
+
+def refresh_analytics_replica_job() -> None:
+    try:
+        refresh_analytics_replica()
+    except Exception as exc:
+        print(f"[WARN] Analytics replica refresh failed: {type(exc).__name__}: {exc}", flush=True)
+
+
+def refresh_analytics_replica_in_background() -> None:
+    """Запускает обновление реплики в отдельном потоке, если оно ещё не идёт."""
+    global _analytics_background
+    with _analytics_background_lock:
+        if _analytics_background:
+            return
+        _analytics_background = True
+
+    def run():
+        global _analytics_background
+        try:
+            refresh_analytics_replica_job()
+        finally:
+            with _analytics_background_lock:
+                _analytics_background = False
+
+    threading.Thread(target=run, name="analytics-refresh", daemon=True).start()
+
+
+def get_analytics_connection(max_age: float = ANALYTICS_MAX_AGE_SECONDS):
+    """
+    Соединение только для чтения к реплике (плюс архив и all_* представления).
+    Возвращает (conn, as_of) — момент снимка для строки «данные на».
+
+    Реплика старше max_age секунд отдаётся как есть, а обновление уходит в
+    фон: полное копирование базы не должно занимать воркер telebot. Пока
+    реплики нет совсем, читается оперативная база. Синхронно обновляют
+    только вызовы с max_age=0 — ежедневный отчёт из планировщика.
+    """
+    if max_age <= 0:
+        refresh_analytics_replica()
+    elif not os.path.exists(ANALYTICS_DB_PATH):
+        refresh_analytics_replica_in_background()
+        return get_reporting_connection(), datetime.datetime.now(datetime.timezone.utc)
+    # immutable=1: файл не меняется на месте, только подменяется целиком,
+    # так что блокировки и проверка журнала не нужны.
+    conn = sqlite3.connect(
+        sqlite_uri(ANALYTICS_DB_PATH, mode="ro", immutable=1),
+        uri=True,
+        check_same_thread=False,
+        factory=InstrumentedConnection,
+    )
+    attach_archive_views(conn)
+    as_of = datetime.datetime.fromisoformat(
+        conn.execute("SELECT as_of FROM replica_meta").fetchone()[0]
+    )
+    if max_age > 0 and (datetime.datetime.now(datetime.timezone.utc) - as_of).total_seconds() > max_age:
+        refresh_analytics_replica_in_background()
+    return conn, as_of
+
+
+def data_as_of_line(as_of: datetime.datetime, lang: str = "en") -> str:
+    stamp = as_of.astimezone(pytz.timezone("Europe/Moscow")).strftime("%d.%m %H:%M:%S")
+    if lang == "ru":
+        return f"🕒 Данные на {stamp} МСК"
+    return f"🕒 Data as of {stamp} MSK"
+
+
+# Каждый вызов Bot API (включая getUpdates) попадает в гистограмму по методу.
+_raw_make_request = apihelper._make_request
+
+
+def timed_make_request(token, method_name, method="get", params=None, files=None):
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        result = _raw_make_request(token, method_name, method, params=params, files=files)
+        outcome = "ok"
+        return result
+    finally:
+        observe_duration(
+            "telegram_api_seconds",
+            time.perf_counter() - started,
+            method=method_name,
+            outcome=outcome,
+        )
+
+
+apihelper._make_request = timed_make_request
+
+
+def timed_http_request(service: str, method: str, url: str, **kwargs):
+    """requests.request с замером длительности внешнего HTTP-вызова."""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        response = requests.request(method, url, **kwargs)
+        outcome = str(response.status_code)
+        return response
+    finally:
+        observe_duration(
+            "http_request_seconds",
+            time.perf_counter() - started,
+            service=service,
+            outcome=outcome,
+        )
+
 # ------------------------------------------------------------------------
 
 # ------------------------------------------------------------------------
@@ -100,6 +529,18 @@ def get_db_connection():
 conn_init = get_db_connection()
 cursor_init = conn_init.cursor()
 
+# Свободные страницы возвращаются в ФС шагами (PRAGMA incremental_vacuum),
+# а не одним долгим VACUUM. Для уже существующей базы режим включается
+# однократным VACUUM на старте, пока бот ещё не принимает апдейты.
+if cursor_init.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+    has_pages = cursor_init.execute("PRAGMA page_count").fetchone()[0] > 0
+    cursor_init.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    if has_pages:
+        print("[INFO] Switching database to auto_vacuum=INCREMENTAL (VACUUM)", flush=True)
+        cursor_init.execute("VACUUM")
+# WAL: чтение не ждёт записи, а checkpoint выполняет ночное обслуживание.
+cursor_init.execute("PRAGMA journal_mode = WAL")
+
 # лог всех нажатий "Order Delivered"
 cursor_init.execute("""
     CREATE TABLE IF NOT EXISTS delivered_log (
@@ -200,11 +641,19 @@ for column_name, column_type in (
     ("delivery_currency", "TEXT"),
     ("delivered_at", "TEXT"),
     ("payment_status", "TEXT"),
+    ("history_summary", "TEXT"),
 ):
     if column_name not in order_columns:
         cursor_init.execute(
             f"ALTER TABLE orders ADD COLUMN {column_name} {column_type}"
         )
+# История заказов листается по order_id (он растёт вместе с timestamp).
+# Индекс покрывает всё, что выводит экран, поэтому страница — один проход
+# по диапазону индекса без чтения самих строк orders.
+cursor_init.execute(
+    "CREATE INDEX IF NOT EXISTS idx_orders_chat_history ON orders("
+    "chat_id, order_id DESC, timestamp, total, promo_code, promo_discount, history_summary)"
+)
 
 # Незавершённая корзина хранится отдельно от оперативного состояния бота.
 # Поэтому redeploy/restart Railway не уничтожает выбранные пользователем товары.
@@ -215,6 +664,10 @@ cursor_init.execute("""
         updated_at  TEXT NOT NULL
     )
 """)
+# По updated_at уборщик находит заброшенные корзины без полного скана.
+cursor_init.execute(
+    "CREATE INDEX IF NOT EXISTS idx_user_carts_updated ON user_carts(updated_at)"
+)
 
 # Пользователь отправляет подтверждение оплаты только после доставки.
 # В SQLite сохраняются идентификаторы Telegram-сообщений и статус проверки;
@@ -291,6 +744,29 @@ cursor_init.execute("""
     )
 """)
 
+# Outbox уведомлений о заказе: строки пишутся в той же транзакции, что и сам
+# заказ, а отправляет их фоновый пул. После перезапуска неотправленные
+# уведомления остаются в таблице и будут доставлены.
+cursor_init.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        outbox_id        INTEGER PRIMARY KEY AUTOINCREMENT,
+        idempotency_key  TEXT NOT NULL UNIQUE,
+        destination      INTEGER NOT NULL,
+        priority         INTEGER NOT NULL DEFAULT 1,
+        payload_json     TEXT NOT NULL,
+        status           TEXT NOT NULL DEFAULT 'pending',
+        attempts         INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at  TEXT NOT NULL,
+        last_error       TEXT,
+        created_at       TEXT NOT NULL,
+        sent_at          TEXT
+    )
+""")
+cursor_init.execute(
+    "CREATE INDEX IF NOT EXISTS idx_outbox_pending "
+    "ON outbox(status, destination, outbox_id)"
+)
+
 # Создание таблицы reviews
 cursor_init.execute("""
     CREATE TABLE IF NOT EXISTS reviews (
@@ -307,6 +783,77 @@ cursor_init.execute("""
 conn_init.commit()
 cursor_init.close()
 conn_init.close()
+
+
+def ensure_archive_schema() -> None:
+    """
+    Создаёт archive.db по образцу основной базы: те же таблицы и индексы,
+    недостающие столбцы добавляются после миграций основной схемы.
+    """
+    hot = get_db_connection()
+    cold = sqlite3.connect(ARCHIVE_DB_PATH)
+    try:
+        for table in ARCHIVED_TABLES:
+            table_sql = hot.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                (table,),
+            ).fetchone()[0]
+            if not cold.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                (table,),
+            ).fetchone():
+                cold.execute(table_sql)
+            cold_columns = {row[1] for row in cold.execute(f"PRAGMA table_info({table})")}
+            for _cid, name, column_type, _notnull, default, _pk in hot.execute(
+                f"PRAGMA table_info({table})"
+            ):
+                if name not in cold_columns:
+                    default_sql = f" DEFAULT {default}" if default is not None else ""
+                    cold.execute(
+                        f'ALTER TABLE {table} ADD COLUMN "{name}" {column_type}{default_sql}'
+                    )
+            for (index_sql,) in hot.execute(
+                "SELECT sql FROM sqlite_master "
+                "WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                (table,),
+            ):
+                cold.execute(index_sql.replace("CREATE INDEX ", "CREATE INDEX IF NOT EXISTS ", 1))
+        cold.commit()
+        archived_promos = cold.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'promo_redemptions'"
+        ).fetchone()
+    finally:
+        cold.close()
+    try:
+        if archived_promos:
+            _return_archived_promo_redemptions(hot)
+    finally:
+        hot.close()
+
+
+def _return_archived_promo_redemptions(hot) -> None:
+    """
+    Ранняя версия архива уносила promo_redemptions в archive.db, и проверка
+    одноразовости промокода их не видела. Возвращает строки в основную базу
+    (при совпадении ключа остаётся оперативная) и удаляет таблицу из архива.
+    """
+    hot.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_PATH,))
+    try:
+        moved = hot.execute(
+            "INSERT OR IGNORE INTO main.promo_redemptions "
+            "(promo_id, chat_id, order_id, discount_amount, redeemed_at) "
+            "SELECT promo_id, chat_id, order_id, discount_amount, redeemed_at "
+            "FROM archive.promo_redemptions"
+        ).rowcount
+        hot.commit()
+        hot.execute("DROP TABLE archive.promo_redemptions")
+        hot.commit()
+    finally:
+        hot.execute("DETACH DATABASE archive")
+    print(f"[INFO] Returned {moved} promo redemptions from archive.db", flush=True)
+
+
+ensure_archive_schema()
 # ------------------------------------------------------------------------
 #   5. Загрузка menu.json и languages.json
 # ------------------------------------------------------------------------
@@ -321,9 +868,67 @@ def load_json(path):
 
 
 menu = load_json(MENU_PATH)
-translations = load_json(LANG_PATH)
 menu_lock = threading.RLock()
 
+# Переводы компилируются при загрузке в плоские таблицы «ключ → строка» на
+# язык, уже с запасными строками, поэтому t() — два поиска по словарю.
+# languages.json перечитывается без рестарта, когда меняется его mtime.
+TRANSLATION_FALLBACKS = {
+    "ru": {
+        "error_out_of_stock": "Этого товара больше нет в наличии.",
+    },
+    "en": {
+        "error_out_of_stock": "This item is no longer in stock.",
+    },
+}
+TRANSLATIONS_CHECK_INTERVAL = 5.0
+translation_tables: dict[str, dict[str, str]] = {}
+# Растёт при каждой перезагрузке таблиц; по ней инвалидируются производные
+# кеши (таблица навигационных кнопок покупателя).
+_TRANSLATIONS_VERSION = 0
+_translations_mtime: float | None = None
+_translations_next_check = 0.0
+_translations_lock = threading.Lock()
+
+
+def compile_translations(raw: dict) -> dict[str, dict[str, str]]:
+    tables = {lang: dict(strings) for lang, strings in TRANSLATION_FALLBACKS.items()}
+    for lang, strings in raw.items():
+        if isinstance(strings, dict):
+            tables.setdefault(lang, {}).update(
+                (str(key), str(value)) for key, value in strings.items()
+            )
+    return tables
+
+
+def translations_mtime() -> float | None:
+    try:
+        return os.stat(LANG_PATH).st_mtime
+    except OSError:
+        return None
+
+
+def reload_translations_if_changed() -> bool:
+    """Перечитывает languages.json, если файл изменился с прошлой загрузки."""
+    global translation_tables, _translations_mtime, _translations_next_check, _TRANSLATIONS_VERSION
+    with _translations_lock:
+        _translations_next_check = time.monotonic() + TRANSLATIONS_CHECK_INTERVAL
+        mtime = translations_mtime()
+        if translation_tables and mtime == _translations_mtime:
+            return False
+        raw = load_json(LANG_PATH)
+        if translation_tables and not raw:
+            # Файл пишется прямо сейчас или битый — остаёмся на старых таблицах.
+            return False
+        translation_tables = compile_translations(raw)
+        _translations_mtime = mtime
+        _TRANSLATIONS_VERSION += 1
+    print(f"[INFO] languages.json loaded: {', '.join(sorted(translation_tables))}", flush=True)
+    return True
+
+
+reload_translations_if_changed()
+
 
 def save_menu_safely() -> None:
     """Атомарно сохраняет каталог, не оставляя частично записанный JSON."""
@@ -333,6 +938,7 @@ def save_menu_safely() -> None:
         file_obj.flush()
         os.fsync(file_obj.fileno())
     os.replace(temporary_path, MENU_PATH)
+    publish_catalog()
 
 
 def blank_flavor_item(flavor_name: str) -> dict:
@@ -347,6 +953,25 @@ def blank_flavor_item(flavor_name: str) -> dict:
         "photo_url": "",
     }
 
+def parse_saved_cart(items_json: str | None) -> list[dict]:
+    """Корзина из user_carts.items_json; битые позиции и JSON отбрасываются."""
+    if not items_json:
+        return []
+    try:
+        parsed_cart = json.loads(items_json)
+    except (json.JSONDecodeError, TypeError):
+        return []
+    if not isinstance(parsed_cart, list):
+        return []
+    return [
+        item for item in parsed_cart
+        if isinstance(item, dict)
+        and isinstance(item.get("category"), str)
+        and isinstance(item.get("flavor"), str)
+        and isinstance(item.get("price"), (int, float))
+    ]
+
+
 # 0. Убедимся, что у пользователя всегда есть запись в user_data, новое добавленное
 def init_user(chat_id: int):
     if chat_id not in user_data:
@@ -365,23 +990,16 @@ def init_user(chat_id: int):
                 (chat_id,),
             )
             cart_row = cursor_local.fetchone()
-            if cart_row and cart_row[0]:
-                parsed_cart = json.loads(cart_row[0])
-                if isinstance(parsed_cart, list):
-                    saved_cart = [
-                        item for item in parsed_cart
-                        if isinstance(item, dict)
-                        and isinstance(item.get("category"), str)
-                        and isinstance(item.get("flavor"), str)
-                        and isinstance(item.get("price"), (int, float))
-                    ]
-        except (sqlite3.OperationalError, json.JSONDecodeError, TypeError):
+            if cart_row:
+                saved_cart = parse_saved_cart(cart_row[0])
+        except sqlite3.OperationalError:
             # На случай первого запуска во время миграции старой БД.
             saved_language = None
         finally:
             cursor_local.close()
             conn_local.close()
 
+        remember_language(chat_id, saved_language)
         user_data[chat_id] = {
             "lang": saved_language,
             "cart": saved_cart,
@@ -416,30 +1034,167 @@ def init_user(chat_id: int):
 #   6. Хранилище данных пользователей (in-memory)
 # ------------------------------------------------------------------------
 user_data = {}  # структура объяснялась ранее
+# Язык чата для t()/tr(): обновляется вместе с user_data[chat_id]["lang"].
+chat_languages: dict[int, str] = {}
+
+
+def remember_language(chat_id: int, lang: str | None) -> None:
+    chat_languages[chat_id] = lang or "ru"
+
+
+def chat_language(chat_id: int) -> str:
+    lang = chat_languages.get(chat_id)
+    if lang is None:
+        if chat_id not in user_data:
+            init_user(chat_id)
+        lang = user_data.get(chat_id, {}).get("lang") or "ru"
+        chat_languages[chat_id] = lang
+    return lang
+
+
+# Сохранение корзины и сброс просроченной корзины уборкой в памяти идут под
+# одним замком: уборка не затрёт корзину, сохранённую после её DELETE.
+_cart_store_lock = threading.Lock()
 
 
 def save_user_cart(chat_id: int) -> None:
-    """Сохраняет текущую корзину пользователя в SQLite."""
-    cart = user_data.get(chat_id, {}).get("cart", [])
+    """Сохраняет текущую корзину пользователя в SQLite (пустую — удаляет)."""
+    with _cart_store_lock:
+        cart = user_data.get(chat_id, {}).get("cart", [])
+        conn_local = get_db_connection()
+        cursor_local = conn_local.cursor()
+        if not cart:
+            # Отсутствие строки и '[]' читаются одинаково, а строка занимает место.
+            cursor_local.execute("DELETE FROM user_carts WHERE chat_id = ?", (chat_id,))
+        else:
+            cursor_local.execute(
+                """
+                INSERT INTO user_carts (chat_id, items_json, updated_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT(chat_id) DO UPDATE SET
+                    items_json = excluded.items_json,
+                    updated_at = excluded.updated_at
+                """,
+                (
+                    chat_id,
+                    json.dumps(cart, ensure_ascii=False),
+                    datetime.datetime.utcnow().isoformat(),
+                ),
+            )
+        conn_local.commit()
+        cursor_local.close()
+        conn_local.close()
+
+
+# ─── Уборка заброшенных корзин ───
+CART_EXPIRY_DAYS = max(int(os.getenv("CART_EXPIRY_DAYS", "30") or 0), 0)
+CART_GC_BATCH_SIZE = 200
+CART_GC_PAUSE_SECONDS = 0.05
+
+
+def _delete_carts_batch(where: str, params: tuple) -> list[tuple[int, str]]:
+    """Удаляет до CART_GC_BATCH_SIZE корзин короткой транзакцией."""
     conn_local = get_db_connection()
-    cursor_local = conn_local.cursor()
-    cursor_local.execute(
-        """
-        INSERT INTO user_carts (chat_id, items_json, updated_at)
-        VALUES (?, ?, ?)
-        ON CONFLICT(chat_id) DO UPDATE SET
-            items_json = excluded.items_json,
-            updated_at = excluded.updated_at
-        """,
-        (
-            chat_id,
-            json.dumps(cart, ensure_ascii=False),
-            datetime.datetime.utcnow().isoformat(),
-        ),
+    try:
+        rows = conn_local.execute(
+            "DELETE FROM user_carts WHERE chat_id IN ("
+            f"SELECT chat_id FROM user_carts WHERE {where} LIMIT ?"
+            ") RETURNING chat_id, items_json",
+            (*params, CART_GC_BATCH_SIZE),
+        ).fetchall()
+        conn_local.commit()
+    finally:
+        conn_local.close()
+    return [(row[0], row[1]) for row in rows]
+
+
+def _forget_expired_carts(deleted: list[tuple[int, str]]) -> None:
+    """
+    Сбрасывает в памяти корзины, удалённые как просроченные, — иначе забытая
+    корзина вернётся в БД при следующем save_user_cart. Корзину, которую
+    покупатель успел изменить или сохранить после DELETE, не трогаем.
+    """
+    with _cart_store_lock:
+        conn_local = get_db_connection()
+        try:
+            for chat_id, items_json in deleted:
+                data = user_data.get(chat_id)
+                if data is None:
+                    continue
+                if conn_local.execute(
+                    "SELECT 1 FROM user_carts WHERE chat_id = ?", (chat_id,)
+                ).fetchone():
+                    continue
+                try:
+                    stale = json.loads(items_json)
+                except (TypeError, ValueError):
+                    continue
+                if data.get("cart") == stale:
+                    data["cart"] = []
+        finally:
+            conn_local.close()
+
+
+def _freelist_pages() -> int:
+    conn_local = get_db_connection()
+    try:
+        return conn_local.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        conn_local.close()
+
+
+def collect_abandoned_carts(expiry_days: int | None = None) -> dict:
+    """
+    Удаляет пустые корзины и корзины, не менявшиеся expiry_days дней.
+    Работает пачками, чтобы не держать блокировку записи; между пачками
+    бот успевает записать свои транзакции. Возвращает статистику уборки.
+    """
+    expiry_days = CART_EXPIRY_DAYS if expiry_days is None else expiry_days
+    started = time.perf_counter()
+    freelist_before = _freelist_pages()
+    stats = {"empty": 0, "expired": 0, "pages": 0, "seconds": 0.0}
+
+    phases = [("empty", "items_json = '[]'", ())]
+    if expiry_days > 0:
+        cutoff = (
+            datetime.datetime.utcnow() - datetime.timedelta(days=expiry_days)
+        ).isoformat(timespec="seconds")
+        phases.append(("expired", "updated_at < ?", (cutoff,)))
+
+    for reason, where, params in phases:
+        while True:
+            deleted = _delete_carts_batch(where, params)
+            if not deleted:
+                break
+            stats[reason] += len(deleted)
+            if reason == "expired":
+                _forget_expired_carts(deleted)
+            if len(deleted) < CART_GC_BATCH_SIZE:
+                break
+            time.sleep(CART_GC_PAUSE_SECONDS)
+
+    stats["pages"] = max(_freelist_pages() - freelist_before, 0)
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    for reason in ("empty", "expired"):
+        if stats[reason]:
+            increment_counter("cart_gc_rows_total", stats[reason], reason=reason)
+    return stats
+
+
+def collect_abandoned_carts_job() -> None:
+    """Обёртка для планировщика: ошибки только логируются."""
+    try:
+        stats = collect_abandoned_carts()
+    except Exception as exc:
+        print(f"[WARN] Cart GC failed: {type(exc).__name__}: {exc}", flush=True)
+        return
+    print(
+        f"[INFO] Cart GC: empty={stats['empty']}, expired={stats['expired']}, "
+        f"pages freed={stats['pages']}, {stats['seconds']}s",
+        flush=True,
     )
-    conn_local.commit()
-    cursor_local.close()
-    conn_local.close()
+
+
 # 6.2 Декоратор для гарантированной инициализации
 def ensure_user(handler):
     def wrapper(message_or_call, *args, **kwargs):
@@ -468,32 +1223,20 @@ def pop_state(chat_id: int) -> str | None:
 # ------------------------------------------------------------------------
 #   7. Утилиты
 # ------------------------------------------------------------------------
-import time
-
 def t(chat_id: int, key: str) -> str:
     """
     Возвращает перевод из languages.json по ключу.
     Если перевод не найден — возвращает сам ключ.
     """
-    if chat_id not in user_data:
-        init_user(chat_id)
-    lang = user_data.get(chat_id, {}).get("lang") or "ru"
-    fallback = {
-        "ru": {
-            "error_out_of_stock": "Этого товара больше нет в наличии.",
-        },
-        "en": {
-            "error_out_of_stock": "This item is no longer in stock.",
-        },
-    }
-    return translations.get(lang, {}).get(key, fallback.get(lang, {}).get(key, key))
+    if time.monotonic() >= _translations_next_check:
+        reload_translations_if_changed()
+    table = translation_tables.get(chat_languages.get(chat_id) or chat_language(chat_id))
+    return table.get(key, key) if table is not None else key
 
 
 def tr(chat_id: int, ru_text: str, en_text: str) -> str:
     """Возвращает короткий встроенный перевод без зависимости от JSON-файла."""
-    if chat_id not in user_data:
-        init_user(chat_id)
-    lang = user_data.get(chat_id, {}).get("lang") or "ru"
+    lang = chat_languages.get(chat_id) or chat_language(chat_id)
     return en_text if lang == "en" else ru_text
 
 
@@ -568,88 +1311,609 @@ def product_token(category: str, flavor: str) -> str:
     return _stable_token("product", category, flavor)
 
 
-def resolve_category(token: str) -> str | None:
-    """Поддерживает новые ID и старые сообщения с названием категории."""
-    if token in menu:
-        return token
-    for category in menu:
-        if category_token(category) == token:
-            return category
-    return None
+# ------------------------------------------------------------------------
+#   Неизменяемые снимки каталога
+# ------------------------------------------------------------------------
+# menu — рабочая копия писателей, её меняют только под menu_lock. Читатели
+# используют current_catalog(): замороженный снимок, который публикуется
+# атомарной заменой ссылки после каждой записи (см. save_menu_safely).
+# Поэтому экраны и отчёты не берут блокировку и не видят половину правки.
+@dataclass(frozen=True, slots=True)
+class CatalogFlavor:
+    category: str
+    flavor: str
+    token: str
+    stock: int
+    emoji: str
+    rating: object
+    description_ru: str
+    description_en: str
+    photo_url: str
+
+    def description(self, lang: str) -> str:
+        return self.description_en if lang == "en" else self.description_ru
+
+
+@dataclass(frozen=True, slots=True)
+class CatalogCategory:
+    name: str
+    token: str
+    price: int | float
+    photo_url: str
+    flavors: tuple
+    in_stock: tuple
+    total_stock: int
+
+
+@dataclass(frozen=True, slots=True)
+class CatalogSnapshot:
+    version: int
+    categories: tuple
+    by_name: MappingProxyType
+    by_token: MappingProxyType
+    products: MappingProxyType
+    total_stock: int
+
+
+def _stock_value(raw) -> int:
+    try:
+        return max(int(raw or 0), 0)
+    except (TypeError, ValueError):
+        return 0
 
 
-def resolve_product(token: str) -> tuple[str, dict] | None:
-    for category, category_data in menu.items():
-        for item in category_data.get("flavors", []):
-            if product_token(category, str(item.get("flavor", ""))) == token:
-                return category, item
-    return None
+def build_catalog_snapshot(source: dict, version: int) -> CatalogSnapshot:
+    """Строит замороженный снимок из рабочей копии каталога."""
+    categories = []
+    products = {}
+    for name, category_data in source.items():
+        if not isinstance(category_data, dict):
+            continue
+        name = str(name)
+        flavors = []
+        for item in category_data.get("flavors", []) or []:
+            if not isinstance(item, dict):
+                continue
+            flavor_name = str(item.get("flavor", ""))
+            record = CatalogFlavor(
+                category=name,
+                flavor=flavor_name,
+                token=product_token(name, flavor_name),
+                stock=_stock_value(item.get("stock")),
+                emoji=str(item.get("emoji", "") or ""),
+                rating=item.get("rating"),
+                description_ru=str(item.get("description_ru", "") or ""),
+                description_en=str(item.get("description_en", "") or ""),
+                photo_url=str(item.get("photo_url", "") or ""),
+            )
+            flavors.append(record)
+            products[record.token] = record
+        in_stock = tuple(record for record in flavors if record.stock > 0)
+        categories.append(CatalogCategory(
+            name=name,
+            token=category_token(name),
+            price=category_data.get("price", 0),
+            photo_url=str(category_data.get("photo_url", "") or "").strip(),
+            flavors=tuple(flavors),
+            in_stock=in_stock,
+            total_stock=sum(record.stock for record in in_stock),
+        ))
+    return CatalogSnapshot(
+        version=version,
+        categories=tuple(categories),
+        by_name=MappingProxyType({category.name: category for category in categories}),
+        by_token=MappingProxyType({category.token: category for category in categories}),
+        products=MappingProxyType(products),
+        total_stock=sum(category.total_stock for category in categories),
+    )
 
 
-def cart_quantity(chat_id: int, category: str, flavor: str) -> int:
-    return sum(
-        1 for item in user_data.get(chat_id, {}).get("cart", [])
-        if item.get("category") == category and item.get("flavor") == flavor
-    )
+_catalog: CatalogSnapshot | None = None
 
 
-def cart_totals(chat_id: int) -> tuple[int, float]:
-    cart = user_data.get(chat_id, {}).get("cart", [])
-    return len(cart), sum(float(item.get("price", 0)) for item in cart)
+def publish_catalog() -> CatalogSnapshot:
+    """Публикует новый снимок каталога (вызывается писателем под menu_lock)."""
+    global _catalog
+    with menu_lock:
+        version = (_catalog.version + 1) if _catalog is not None else 1
+        snapshot = build_catalog_snapshot(menu, version)
+        update_search_index(snapshot)
+        _catalog = snapshot
+    return snapshot
 
 
-def disable_inline_keyboard(call) -> None:
-    """Убирает кнопки у устаревшего сообщения, если Telegram это позволяет."""
-    try:
-        bot.edit_message_reply_markup(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            reply_markup=None,
-        )
-    except Exception:
-        pass
+def current_catalog() -> CatalogSnapshot:
+    """Текущий снимок каталога; читателям блокировка не нужна."""
+    return _catalog
 
 
-def render_inline_screen(
-    chat_id: int,
-    text: str,
-    reply_markup,
-    call=None,
+def resolve_category(token: str) -> str | None:
+    """Поддерживает новые ID и старые сообщения с названием категории."""
+    catalog = current_catalog()
+    if token in catalog.by_name:
+        return token
+    category = catalog.by_token.get(token)
+    return category.name if category else None
+
+
+def resolve_product(token: str) -> tuple[str, CatalogFlavor] | None:
+    record = current_catalog().products.get(token)
+    if record is None:
+        return None
+    return record.category, record
+
+
+def resolve_menu_item(token: str) -> tuple[str, dict] | None:
+    """Для писателей: изменяемая позиция рабочей копии (вызывать под menu_lock)."""
+    record = current_catalog().products.get(token)
+    if record is None:
+        return None
+    for item in menu.get(record.category, {}).get("flavors", []):
+        if item.get("flavor") == record.flavor:
+            return record.category, item
+    return None
+
+
+# ------------------------------------------------------------------------
+#   Поисковый индекс каталога
+# ------------------------------------------------------------------------
+# Индекс строится из снимка при публикации и обновляется только по тем
+# позициям, у которых изменился текст (название, эмодзи, описания).
+# Продажа или приход товара меняют лишь множество позиций в наличии,
+# поэтому поиск не отдаёт закончившиеся вкусы и не переиндексирует текст.
+SEARCH_RESULTS_LIMIT = 20
+
+
+@dataclass(frozen=True, slots=True)
+class SearchDocument:
+    signature: tuple
+    name_text: str
+    text: str
+    name_terms: frozenset
+    text_terms: frozenset
+
+
+_search_lock = threading.Lock()
+_search_documents: dict[str, SearchDocument] = {}
+# терм → позиции; термы — триграммы слов и префиксы длиной 1–2
+_search_name_postings: dict[str, set[str]] = {}
+_search_text_postings: dict[str, set[str]] = {}
+_search_emoji: dict[str, set[str]] = {}
+_search_in_stock: set[str] = set()
+# порядок выдачи совпадает с порядком каталога на экранах
+_search_rank: dict[str, int] = {}
+
+
+def search_terms(word: str) -> set[str]:
+    """Триграммы слова; у слов короче трёх букв — сами префиксы."""
+    if len(word) < 3:
+        return {word[:length] for length in range(1, len(word) + 1)}
+    return {word[index:index + 3] for index in range(len(word) - 2)}
+
+
+def indexed_terms(text: str) -> frozenset:
+    terms = set()
+    for word in set(text.split()):
+        terms |= search_terms(word)
+        # Короткие запросы («ма», «i») ищутся по префиксам слов.
+        terms.update(word[:length] for length in (1, 2) if len(word) > length)
+    return frozenset(terms)
+
+
+def search_signature(record: CatalogFlavor) -> tuple:
+    return (record.category, record.flavor, record.emoji.strip(),
+            record.description_ru, record.description_en)
+
+
+def search_document(record: CatalogFlavor) -> SearchDocument:
+    name_text = _normalize(f"{record.flavor} {record.category}")
+    text = _normalize(f"{name_text} {record.description_ru} {record.description_en}")
+    return SearchDocument(
+        signature=search_signature(record),
+        name_text=name_text,
+        text=text,
+        name_terms=indexed_terms(name_text),
+        text_terms=indexed_terms(text),
+    )
+
+
+def _discard_posting(postings: dict[str, set[str]], term: str, token: str) -> None:
+    posting = postings.get(term)
+    if posting is not None:
+        posting.discard(token)
+        if not posting:
+            del postings[term]
+
+
+def _unindex(token: str, document: SearchDocument) -> None:
+    for term in document.name_terms:
+        _discard_posting(_search_name_postings, term, token)
+    for term in document.text_terms:
+        _discard_posting(_search_text_postings, term, token)
+    if document.signature[2]:
+        _discard_posting(_search_emoji, document.signature[2], token)
+
+
+def update_search_index(snapshot: CatalogSnapshot) -> int:
+    """Приводит индекс к снимку; возвращает число переиндексированных позиций."""
+    global _search_in_stock, _search_rank
+    changed = 0
+    with _search_lock:
+        for token in [token for token in _search_documents if token not in snapshot.products]:
+            _unindex(token, _search_documents.pop(token))
+            changed += 1
+        for token, record in snapshot.products.items():
+            previous = _search_documents.get(token)
+            if previous is not None:
+                if previous.signature == search_signature(record):
+                    continue
+                _unindex(token, previous)
+            document = search_document(record)
+            _search_documents[token] = document
+            for term in document.name_terms:
+                _search_name_postings.setdefault(term, set()).add(token)
+            for term in document.text_terms:
+                _search_text_postings.setdefault(term, set()).add(token)
+            if document.signature[2]:
+                _search_emoji.setdefault(document.signature[2], set()).add(token)
+            changed += 1
+        _search_in_stock = {token for token, record in snapshot.products.items() if record.stock > 0}
+        _search_rank = {token: rank for rank, token in enumerate(snapshot.products)}
+    return changed
+
+
+def _search_candidates(postings: dict[str, set[str]], words: list[str]) -> set[str]:
+    candidates = None
+    for word in words:
+        # Сначала самые короткие списки: пересечение быстро сужается.
+        for posting in sorted((postings.get(term, ()) for term in search_terms(word)), key=len):
+            candidates = _search_in_stock.intersection(posting) if candidates is None else candidates & posting
+            if not candidates:
+                return set()
+    return candidates or set()
+
+
+def _take_in_rank_order(candidates, limit: int, accept) -> list[str]:
+    heap = [(_search_rank.get(token, 0), token) for token in candidates]
+    heapq.heapify(heap)
+    taken = []
+    while heap and len(taken) < limit:
+        token = heapq.heappop(heap)[1]
+        if accept(token):
+            taken.append(token)
+    return taken
+
+
+def search_catalog(query: str, limit: int = SEARCH_RESULTS_LIMIT) -> list[CatalogFlavor]:
+    """
+    Вкусы в наличии, где встречаются все слова запроса (или эмодзи):
+    сначала совпадения в названии, затем в описании, в порядке каталога.
+    """
+    words = _normalize(query).split()
+    tokens = []
+    with _search_lock:
+        if not words:
+            emoji_posting = _search_emoji.get(query.strip(), ())
+            tokens = _take_in_rank_order(
+                _search_in_stock.intersection(emoji_posting), limit, lambda token: True,
+            )
+        else:
+            # Триграммы дают кандидатов; точное вхождение проверяем по тексту.
+            tokens = _take_in_rank_order(
+                _search_candidates(_search_name_postings, words),
+                limit,
+                lambda token: all(word in _search_documents[token].name_text for word in words),
+            )
+            if len(tokens) < limit:
+                found = set(tokens)
+                tokens += _take_in_rank_order(
+                    _search_candidates(_search_text_postings, words) - found,
+                    limit - len(tokens),
+                    lambda token: all(word in _search_documents[token].text for word in words),
+                )
+    products = current_catalog().products
+    records = (products.get(token) for token in tokens)
+    return [record for record in records if record is not None and record.stock > 0]
+
+
+publish_catalog()
+
+
+# Журнал изменений рабочей копии: хранит прежние значения только тех
+# позиций и категорий, которые реально тронули, поэтому откат стоит
+# O(изменённых позиций), а не O(каталога).
+_JOURNAL_MISSING = object()
+
+
+class StockJournal:
+    """Журнал отката изменений `menu` (использовать под menu_lock)."""
+
+    def __init__(self):
+        self._entries = []
+        self._category_order = None
+
+    def __bool__(self) -> bool:
+        return bool(self._entries)
+
+    def set_stock(self, item: dict, new_stock: int) -> None:
+        self.set_field(item, "stock", int(new_stock))
+
+    def set_field(self, target: dict, key: str, value) -> None:
+        self._entries.append(("field", target, key, target.get(key, _JOURNAL_MISSING)))
+        target[key] = value
+
+    def append_flavor(self, flavors: list, item: dict) -> None:
+        self._entries.append(("append", flavors, item, None))
+        flavors.append(item)
+
+    def set_category(self, name: str, value) -> None:
+        """value=None удаляет категорию; порядок категорий восстановится при откате."""
+        if self._category_order is None:
+            self._category_order = tuple(menu)
+        self._entries.append(("category", name, None, menu.get(name, _JOURNAL_MISSING)))
+        if value is None:
+            menu.pop(name, None)
+        else:
+            menu[name] = value
+
+    def _undo(self) -> None:
+        for kind, target, key, previous in reversed(self._entries):
+            if kind == "field":
+                if previous is _JOURNAL_MISSING:
+                    target.pop(key, None)
+                else:
+                    target[key] = previous
+            elif kind == "append":
+                for index in range(len(target) - 1, -1, -1):
+                    if target[index] is key:
+                        del target[index]
+                        break
+            elif previous is _JOURNAL_MISSING:
+                menu.pop(target, None)
+            else:
+                menu[target] = previous
+        if self._category_order is not None:
+            ordered = [(name, menu[name]) for name in self._category_order if name in menu]
+            ordered.extend((name, value) for name, value in menu.items() if name not in self._category_order)
+            menu.clear()
+            menu.update(ordered)
+        self._entries.clear()
+        self._category_order = None
+
+    def save(self) -> None:
+        """Сохраняет каталог; если запись не удалась — откатывает память и пробрасывает ошибку."""
+        try:
+            save_menu_safely()
+        except Exception:
+            with menu_lock:
+                self._undo()
+            raise
+
+    def commit(self) -> None:
+        """Изменения подтверждены: журнал больше не нужен."""
+        self._entries.clear()
+        self._category_order = None
+
+    def rollback(self, context: str = "menu") -> None:
+        """Возвращает прежние значения и сохраняет каталог, если было что откатывать."""
+        with menu_lock:
+            if not self._entries:
+                return
+            self._undo()
+            try:
+                save_menu_safely()
+            except Exception as exc:
+                print(f"{context}: menu rollback failed: {exc}", flush=True)
+
+
+def cart_quantity(chat_id: int, category: str, flavor: str) -> int:
+    return sum(
+        1 for item in user_data.get(chat_id, {}).get("cart", [])
+        if item.get("category") == category and item.get("flavor") == flavor
+    )
+
+
+def cart_totals(chat_id: int) -> tuple[int, float]:
+    cart = user_data.get(chat_id, {}).get("cart", [])
+    return len(cart), sum(float(item.get("price", 0)) for item in cart)
+
+
+# Кеш последнего отрисованного содержимого: (chat_id, message_id) → хеш
+# (текст, клавиатура). Повторная отрисовка того же экрана не тратит запрос
+# к Telegram; записи вытесняются по размеру и по давности.
+RENDER_CACHE_MAX_ENTRIES = 5000
+RENDER_CACHE_TTL = 24 * 3600
+_render_cache: "OrderedDict[tuple[int, int], tuple[bytes, float]]" = OrderedDict()
+_render_cache_lock = threading.Lock()
+
+
+def render_digest(text: str, reply_markup) -> bytes:
+    markup_json = reply_markup.to_json() if reply_markup is not None else ""
+    return hashlib.sha256(f"{text}\0{markup_json}".encode("utf-8")).digest()
+
+
+def render_cache_matches(chat_id: int, message_id: int, digest: bytes) -> bool:
+    key = (chat_id, message_id)
+    with _render_cache_lock:
+        cached = _render_cache.get(key)
+        if cached is not None and time.monotonic() - cached[1] > RENDER_CACHE_TTL:
+            del _render_cache[key]
+            cached = None
+        if cached is not None:
+            _render_cache.move_to_end(key)
+        matched = cached is not None and cached[0] == digest
+    increment_counter("cache_requests_total", cache="render", result="hit" if matched else "miss")
+    return matched
+
+
+def remember_render(chat_id: int, message_id: int, digest: bytes) -> None:
+    now = time.monotonic()
+    with _render_cache_lock:
+        _render_cache[(chat_id, message_id)] = (digest, now)
+        _render_cache.move_to_end((chat_id, message_id))
+        while len(_render_cache) > RENDER_CACHE_MAX_ENTRIES:
+            _render_cache.popitem(last=False)
+        # Самые старые записи — в начале; снимаем протухшие.
+        while _render_cache:
+            oldest_key, (_, stamp) = next(iter(_render_cache.items()))
+            if now - stamp <= RENDER_CACHE_TTL:
+                break
+            del _render_cache[oldest_key]
+
+
+def clear_render_cache() -> None:
+    """Сбрасывает весь кеш отрисовок (после /restore экраны не совпадают с базой)."""
+    with _render_cache_lock:
+        _render_cache.clear()
+
+
+def forget_render(chat_id: int, message_id: int) -> None:
+    """Сбрасывает кеш сообщения, изменённого в обход render_inline_screen."""
+    with _render_cache_lock:
+        _render_cache.pop((chat_id, message_id), None)
+
+
+def disable_inline_keyboard(call) -> None:
+    """Убирает кнопки у устаревшего сообщения, если Telegram это позволяет."""
+    forget_render(call.message.chat.id, call.message.message_id)
+    try:
+        bot.edit_message_reply_markup(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            reply_markup=None,
+        )
+    except Exception:
+        pass
+
+
+def render_inline_screen(
+    chat_id: int,
+    text: str,
+    reply_markup,
+    call=None,
     *,
     allow_media_edit: bool = True,
 ) -> None:
     """Обновляет активный экран; при невозможности безопасно создаёт новый."""
+    digest = render_digest(text, reply_markup)
     if call is not None:
         message = getattr(call, "message", None)
         if message is not None:
             is_media = bool(getattr(message, "photo", None)) or getattr(
                 message, "content_type", None
             ) == "photo"
+            message_chat_id = message.chat.id
+            message_id = message.message_id
+            if (not is_media or allow_media_edit) and render_cache_matches(
+                message_chat_id, message_id, digest
+            ):
+                increment_counter("render_edits_skipped_total")
+                return
             try:
                 if is_media and allow_media_edit:
                     bot.edit_message_caption(
                         caption=text,
-                        chat_id=message.chat.id,
-                        message_id=message.message_id,
+                        chat_id=message_chat_id,
+                        message_id=message_id,
                         parse_mode="HTML",
                         reply_markup=reply_markup,
                     )
                 elif not is_media:
                     bot.edit_message_text(
                         text,
-                        chat_id=message.chat.id,
-                        message_id=message.message_id,
+                        chat_id=message_chat_id,
+                        message_id=message_id,
                         parse_mode="HTML",
                         reply_markup=reply_markup,
                     )
                 else:
                     raise RuntimeError("text screen requested from media message")
+                remember_render(message_chat_id, message_id, digest)
                 return
             except Exception as exc:
                 if "message is not modified" in str(exc).lower():
+                    remember_render(message_chat_id, message_id, digest)
                     return
                 disable_inline_keyboard(call)
-    bot.send_message(chat_id, text, parse_mode="HTML", reply_markup=reply_markup)
+    sent = bot.send_message(chat_id, text, parse_mode="HTML", reply_markup=reply_markup)
+    if sent is not None:
+        remember_render(sent.chat.id, sent.message_id, digest)
+
+
+# Ранний ответ на callback: Telegram сразу получает ack с промежуточным
+# тостом, а тяжёлая часть обработчика (транзакции, сохранение каталога,
+# рассылка) продолжается в фоновом пуле. Время до ack считается от приёма
+# апдейта (received_at, см. stamp_received_updates) — вместе с ожиданием в
+# очереди воркеров telebot — и сравнивается с SLO.
+CALLBACK_ACK_SLO_SECONDS = 0.3
+_callback_executor = ThreadPoolExecutor(
+    max_workers=max(int(os.getenv("CALLBACK_WORKERS", "4")), 1),
+    thread_name_prefix="callback",
+)
+
+
+def run_callback_continuation(handler, call) -> None:
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        profiled_call(handler, call)
+    except Exception as exc:
+        outcome = "error"
+        print(f"Background callback {handler.__name__} failed: {type(exc).__name__}: {exc}", flush=True)
+    finally:
+        observe_duration(
+            "callback_continuation_seconds",
+            time.perf_counter() - started,
+            handler=handler.__name__,
+            outcome=outcome,
+        )
+
+
+def early_callback_ack(provisional, *, guard=None):
+    """Отвечает на callback сразу и продолжает обработчик в фоне."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(call):
+            started = getattr(call, "received_at", None) or time.perf_counter()
+            # Проверка доступа остаётся синхронной: отказ показывается alert.
+            if guard is not None and guard(call):
+                return
+            toast = provisional(call) if callable(provisional) else provisional
+            try:
+                bot.answer_callback_query(call.id, toast)
+                call.early_acked = True
+            except Exception as exc:
+                print(f"Early ack failed for {handler.__name__}: {exc}", flush=True)
+            elapsed = time.perf_counter() - started
+            observe_duration("callback_ack_seconds", elapsed, handler=handler.__name__)
+            if elapsed > CALLBACK_ACK_SLO_SECONDS:
+                increment_counter("callback_ack_slo_breaches_total", handler=handler.__name__)
+                print(
+                    f"Callback ack SLO breach in {handler.__name__}: {elapsed * 1000:.0f} ms",
+                    flush=True,
+                )
+            _callback_executor.submit(run_callback_continuation, handler, call)
+        return wrapper
+    return decorate
+
+
+def answer_callback(call, text: str | None = None, show_alert: bool = False) -> None:
+    """Итоговый ответ на callback; после раннего ack alert уходит сообщением."""
+    if not getattr(call, "early_acked", False):
+        bot.answer_callback_query(call.id, text, show_alert=show_alert)
+        return
+    # Второй answerCallbackQuery Telegram отклонит. Обычный тост уже не
+    # нужен — результат виден по сообщению, а предупреждение не теряем.
+    if not (text and show_alert):
+        return
+    try:
+        bot.send_message(
+            call.message.chat.id,
+            html.escape(text),
+            reply_to_message_id=call.message.message_id,
+        )
+    except Exception as exc:
+        print(f"Callback result delivery failed: {exc}", flush=True)
 
 
 def is_owner(user_id: int) -> bool:
@@ -911,42 +2175,106 @@ def payment_methods_keyboard(order_id: int) -> types.InlineKeyboardMarkup:
 
 def save_user_language(chat_id: int, lang_code: str) -> None:
     """Сохраняет язык в SQLite, чтобы Railway restart его не сбрасывал."""
+    now = utc_now_iso()
     conn_local = get_db_connection()
-    cursor_local = conn_local.cursor()
-    cursor_local.execute(
-        "UPDATE users SET language = ? WHERE chat_id = ?",
-        (lang_code, chat_id),
-    )
-    if cursor_local.rowcount == 0:
-        referral_code = generate_ref_code()
-        while True:
-            cursor_local.execute(
-                "SELECT 1 FROM users WHERE referral_code = ?",
-                (referral_code,),
-            )
-            if cursor_local.fetchone() is None:
-                break
-            referral_code = generate_ref_code()
-        now = utc_now_iso()
-        cursor_local.execute(
+    try:
+        with_new_referral_code(lambda code: conn_local.execute(
             """
             INSERT INTO users (
                 chat_id, points, referral_code, language,
                 registered_at, last_seen_at, is_active, status_updated_at
             )
             VALUES (?, 0, ?, ?, ?, ?, 1, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET language = excluded.language
             """,
-            (chat_id, referral_code, lang_code, now, now, now),
-        )
-    conn_local.commit()
-    cursor_local.close()
-    conn_local.close()
+            (chat_id, code, lang_code, now, now, now),
+        ))
+        conn_local.commit()
+    finally:
+        conn_local.close()
+
+
+# ─── Идентичность бота и реферальные ссылки ────────────────────────────────
+# getMe запрашивается один раз при старте и изредка обновляется в фоне;
+# ссылки приглашения строятся один раз на пользователя и сбрасываются,
+# только если у бота сменился username.
+BOT_IDENTITY_REFRESH_HOURS = 6
+REFERRAL_SHARE_TEXT = {
+    "ru": "Заказывай через этого бота — вот моя персональная ссылка:",
+    "en": "Order through this bot — here is my personal link:",
+}
+_bot_identity = None
+_bot_identity_lock = threading.Lock()
+
+
+@dataclass(frozen=True, slots=True)
+class ReferralLinks:
+    code: str
+    invite_link: str
+    share_url_ru: str
+    share_url_en: str
+
+    def share_url(self, lang: str) -> str:
+        return self.share_url_en if lang == "en" else self.share_url_ru
+
+
+_referral_links: dict[int, ReferralLinks] = {}
+
+
+def refresh_bot_identity():
+    """Запрашивает getMe; при смене username сбрасывает готовые ссылки."""
+    global _bot_identity
+    identity = bot.get_me()
+    with _bot_identity_lock:
+        if _bot_identity is not None and _bot_identity.username != identity.username:
+            _referral_links.clear()
+            print(f"[INFO] Bot username changed: @{identity.username}", flush=True)
+        _bot_identity = identity
+    return identity
+
+
+def refresh_bot_identity_job() -> None:
+    """Задача планировщика: при сбое остаётся прежняя идентичность."""
+    try:
+        refresh_bot_identity()
+    except Exception as e:
+        print(f"[WARN] getMe refresh failed: {e}", flush=True)
+
+
+def bot_username() -> str:
+    identity = _bot_identity
+    if identity is None:
+        identity = refresh_bot_identity()
+    return identity.username
+
+
+def build_referral_links(referral_code: str) -> ReferralLinks:
+    invite_link = f"https://t.me/{bot_username()}?start=ref={referral_code}"
+    share_urls = {
+        lang: "https://t.me/share/url?" + urlencode({"url": invite_link, "text": text})
+        for lang, text in REFERRAL_SHARE_TEXT.items()
+    }
+    return ReferralLinks(
+        code=referral_code,
+        invite_link=invite_link,
+        share_url_ru=share_urls["ru"],
+        share_url_en=share_urls["en"],
+    )
+
+
+def referral_links(chat_id: int, referral_code: str | None = None) -> ReferralLinks:
+    """Готовые ссылки пользователя; без кода он читается (или выдаётся) из БД."""
+    links = _referral_links.get(chat_id)
+    if links is not None and referral_code in (None, links.code):
+        return links
+    links = build_referral_links(referral_code or user_referral_code(chat_id))
+    _referral_links[chat_id] = links
+    return links
 
 
 def send_referral_info(chat_id: int, referral_code: str) -> None:
     """Отправляет реферальные данные на выбранном пользователем языке."""
-    bot_username = bot.get_me().username
-    invite_link = f"https://t.me/{bot_username}?start=ref={referral_code}"
+    invite_link = referral_links(chat_id, referral_code).invite_link
     if user_data.get(chat_id, {}).get("lang") == "en":
         text = (
             f"🎁 <b>Get {REFERRAL_BONUS_POINTS} points when your invited friend "
@@ -1036,6 +2364,8 @@ def broadcast_message_to_users(source_chat_id: int, source_message_id: int) -> t
     flush_status_updates()
     cursor_local.close()
     conn_local.close()
+    increment_counter("broadcast_messages_total", sent, outcome="sent")
+    increment_counter("broadcast_messages_total", failed, outcome="failed")
     return sent, failed
 
 
@@ -1045,10 +2375,126 @@ def generate_ref_code(length: int = 6) -> str:
     """
     return "".join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
+
+REFERRAL_CODE_ATTEMPTS = 10
+
+
+def with_new_referral_code(write):
+    """
+    Выполняет write(code) со свежими кодами, пока UNIQUE(referral_code) не
+    пропустит запись. Отдельный SELECT «свободен ли код» не нужен: гонку
+    двух регистраций всё равно решает только ограничение.
+    """
+    for _attempt in range(REFERRAL_CODE_ATTEMPTS):
+        try:
+            return write(generate_ref_code())
+        except sqlite3.IntegrityError as e:
+            if "referral_code" not in str(e):
+                raise
+    raise RuntimeError(f"No free referral code after {REFERRAL_CODE_ATTEMPTS} attempts")
+
+
+def register_user(chat_id: int, profile, referrer_code: str | None = None):
+    """
+    Регистрирует пользователя /start одним UPSERT … RETURNING.
+
+    Новая строка получает код из with_new_referral_code. У известного
+    пользователя обновляются профиль и статус. Возвращает
+    (language, referral_code, is_new_user, items_json сохранённой корзины).
+    """
+    username, first_name, last_name = telegram_profile_values(profile)
+    now = utc_now_iso()
+    conn_local = get_db_connection()
+    try:
+        row = with_new_referral_code(lambda code: conn_local.execute(
+            """
+            INSERT INTO users (
+                chat_id, points, referral_code, referred_by,
+                username, first_name, last_name,
+                registered_at, last_seen_at, is_active, status_updated_at
+            )
+            VALUES (
+                ?, 0, ?, (SELECT chat_id FROM users WHERE referral_code = ?),
+                ?, ?, ?, ?, ?, 1, ?
+            )
+            ON CONFLICT(chat_id) DO UPDATE SET
+                referral_code = COALESCE(users.referral_code, excluded.referral_code),
+                username = excluded.username,
+                first_name = excluded.first_name,
+                last_name = excluded.last_name,
+                last_seen_at = excluded.last_seen_at,
+                is_active = 1,
+                inactive_reason = NULL,
+                status_updated_at = excluded.status_updated_at
+            RETURNING
+                language,
+                referral_code,
+                registered_at = ?,
+                (SELECT items_json FROM user_carts WHERE user_carts.chat_id = users.chat_id)
+            """,
+            (
+                chat_id, code, referrer_code,
+                username, first_name, last_name,
+                now, now, now, now,
+            ),
+        ).fetchone())
+        conn_local.commit()
+    finally:
+        conn_local.close()
+    language, referral_code, is_new_user, items_json = row
+    return (
+        language if language in ("ru", "en") else None,
+        referral_code,
+        bool(is_new_user),
+        items_json,
+    )
+
+
+def user_referral_code(chat_id: int) -> str:
+    """Код пользователя; у старых записей без кода он выдаётся здесь."""
+    conn_local = get_db_connection()
+    try:
+        row = conn_local.execute(
+            "SELECT referral_code FROM users WHERE chat_id = ?",
+            (chat_id,),
+        ).fetchone()
+        referral_code = str(row[0]).strip() if row and row[0] else ""
+        if referral_code:
+            return referral_code
+        row = with_new_referral_code(lambda code: conn_local.execute(
+            "UPDATE users SET referral_code = COALESCE(referral_code, ?) "
+            "WHERE chat_id = ? RETURNING referral_code",
+            (code, chat_id),
+        ).fetchone())
+        conn_local.commit()
+        # Записи пользователя ещё нет: показываем код, как раньше, без сохранения.
+        return row[0] if row else generate_ref_code()
+    finally:
+        conn_local.close()
+
 # ─── Кешированные курсы валют ───────────────────────────────────────────────
 _RATE_CACHE: dict[str, float] | None = None
 _RATE_CACHE_TS: float = 0.0
 _RATE_TTL: int = 10 * 60  # 10 минут
+# Фоновое обновление чуть чаще TTL: экраны не ждут сетевой запрос курсов.
+RATES_REFRESH_MINUTES = 8
+# Версия набора курсов растёт при каждой замене _RATE_CACHE; по ней
+# инвалидируется кеш готовых строк конвертации.
+_RATES_VERSION = 0
+CONVERSION_MEMO_MAX_ENTRIES = 4096
+_conversion_memo: "OrderedDict[tuple[int, float, int], str]" = OrderedDict()
+_conversion_memo_lock = threading.Lock()
+
+
+def set_exchange_rates(rates: dict[str, float], fetched_at: float) -> None:
+    """Публикует проверенный набор курсов и сбрасывает кеш конвертаций."""
+    global _RATE_CACHE, _RATE_CACHE_TS, _RATES_VERSION
+    with _conversion_memo_lock:
+        if rates != _RATE_CACHE:
+            _RATES_VERSION += 1
+            _conversion_memo.clear()
+        _RATE_CACHE = rates
+        _RATE_CACHE_TS = fetched_at
 
 
 def valid_exchange_rates(rates: dict[str, float] | None) -> bool:
@@ -1100,17 +2546,18 @@ def load_saved_exchange_rates() -> dict[str, float]:
         connection.close()
     return result if valid_exchange_rates(result) else {}
 
-def fetch_rates() -> dict[str, float]:
+def fetch_rates(force: bool = False) -> dict[str, float]:
     """
     Возвращает курсы валют TRY → RUB, USD, UAH, EUR,
     кешируя результат на _RATE_TTL секунд.
     """
-    global _RATE_CACHE, _RATE_CACHE_TS
-
     now = time.time()
-    # Если кеш ещё «жив» — отдаём его
-    if valid_exchange_rates(_RATE_CACHE) and (now - _RATE_CACHE_TS) < _RATE_TTL:
+    # Если кеш ещё «жив» — отдаём его (в _RATE_CACHE попадают только
+    # проверенные наборы, см. set_exchange_rates)
+    if not force and _RATE_CACHE and (now - _RATE_CACHE_TS) < _RATE_TTL:
+        increment_counter("cache_requests_total", cache="rates", result="hit")
         return _RATE_CACHE
+    increment_counter("cache_requests_total", cache="rates", result="miss")
 
     # Иначе запрашиваем из внешних источников
     sources = [
@@ -1119,7 +2566,7 @@ def fetch_rates() -> dict[str, float]:
     ]
     for url, params in sources:
         try:
-            r = requests.get(url, params=params, timeout=5)
+            r = timed_http_request("rates", "GET", url, params=params, timeout=5)
             data = r.json()
             rates = data.get("rates") or data.get("conversion_rates")
             if rates:
@@ -1131,8 +2578,7 @@ def fetch_rates() -> dict[str, float]:
             else:
                 result = {}
             if valid_exchange_rates(result):
-                _RATE_CACHE = result
-                _RATE_CACHE_TS = now
+                set_exchange_rates(result, now)
                 save_exchange_rates(result)
                 return result
         except Exception:
@@ -1144,11 +2590,18 @@ def fetch_rates() -> dict[str, float]:
         return _RATE_CACHE
     saved_rates = load_saved_exchange_rates()
     if saved_rates:
-        _RATE_CACHE = saved_rates
-        _RATE_CACHE_TS = now
+        set_exchange_rates(saved_rates, now)
         return saved_rates
     return {"RUB": 0, "USD": 0, "EUR": 0, "UAH": 0}
 
+
+def refresh_exchange_rates() -> None:
+    """Задача планировщика: обновляет курсы до истечения _RATE_TTL."""
+    try:
+        fetch_rates(force=True)
+    except Exception as e:
+        print(f"[WARN] Exchange rates refresh failed: {e}", flush=True)
+
 def translate_to_en(text: str) -> str:
     """
     Переводит русский текст на английский через Google Translate API.
@@ -1166,7 +2619,7 @@ def translate_to_en(text: str) -> str:
             "q": text
         }
         # отправка POST вместо GET — так передаётся весь текст
-        res = requests.post(base_url, data=params, timeout=10)
+        res = timed_http_request("translate", "POST", base_url, data=params, timeout=10)
         data = res.json()
         # data[0] — список сегментов, каждый seg[0] содержит часть перевода
         return "".join(seg[0] for seg in data[0])
@@ -1204,17 +2657,14 @@ def get_inline_main_menu(chat_id: int, show_language: bool = False) -> types.Inl
     # Категории для пользователя:
     # показываем только те категории, где есть хотя бы один вкус со stock > 0.
     # Пустые категории НЕ удаляются из menu.json и остаются доступными в /change.
-    for cat, cat_data in menu.items():
-        flavors = cat_data.get("flavors", [])
-        total_stock = sum(int(item.get("stock", 0)) for item in flavors)
-
-        if total_stock <= 0:
+    for category in current_catalog().categories:
+        if category.total_stock <= 0:
             continue
 
-        price = format_money(cat_data.get("price", 0))
+        price = format_money(category.price)
         kb.add(types.InlineKeyboardButton(
-            text=f"{cat} · {price}₺",
-            callback_data=f"category|{category_token(cat)}"
+            text=f"{category.name} · {price}₺",
+            callback_data=f"category|{category.token}"
         ))
 
     # Кнопки корзины и дальнейших действий — только если в корзине есть товары
@@ -1229,6 +2679,10 @@ def get_inline_main_menu(chat_id: int, show_language: bool = False) -> types.Inl
             callback_data="view_cart"
         ))
 
+    kb.add(types.InlineKeyboardButton(
+        text=tr(chat_id, "🔎 Поиск вкуса", "🔎 Search flavors"),
+        callback_data="search",
+    ))
     kb.add(types.InlineKeyboardButton(
         text=tr(chat_id, "👤 Профиль", "👤 Profile"),
         callback_data="profile",
@@ -1283,24 +2737,15 @@ def back_to_main_keyboard(chat_id: int) -> types.InlineKeyboardMarkup:
 def get_inline_flavors(chat_id: int, cat: str) -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=1)
 
-    # Сохраняем в user_data текущий список «живых» вкусов
-    user_data[chat_id]["current_flavors"] = [
-        item for item in menu[cat]["flavors"]
-        if int(item.get("stock", 0)) > 0
-    ]
-
-    for idx, item in enumerate(user_data[chat_id]["current_flavors"]):
-        emoji  = item.get("emoji", "")
-        flavor = item["flavor"]
-        stock  = int(item.get("stock", 0))
+    category = current_catalog().by_name.get(cat)
+    stock_unit = tr(chat_id, "шт", "pcs")
+    for item in (category.in_stock if category else ()):
         # Берём средний рейтинг из menu.json, если он есть
-        rating = item.get("rating")
-        rating_str = f" ⭐{rating}" if rating else ""
-        stock_unit = tr(chat_id, "шт", "pcs")
-        label = f"{emoji} {flavor}{rating_str} · {stock} {stock_unit}"
+        rating_str = f" ⭐{item.rating}" if item.rating else ""
+        label = f"{item.emoji} {item.flavor}{rating_str} · {item.stock} {stock_unit}"
         kb.add(types.InlineKeyboardButton(
             text=label,
-            callback_data=f"product|{product_token(cat, flavor)}"
+            callback_data=f"product|{item.token}"
         ))
 
     kb.add(types.InlineKeyboardButton(
@@ -1329,12 +2774,13 @@ def show_main_menu(chat_id: int, call=None) -> None:
 
 
 def show_category_screen(chat_id: int, category: str, call=None) -> None:
-    if category not in menu:
+    category_record = current_catalog().by_name.get(category)
+    if category_record is None:
         show_main_menu(chat_id, call)
         return
 
     user_data[chat_id]["current_category"] = category
-    raw_price = menu[category].get("price", 0)
+    raw_price = category_record.price
     price = format_money(raw_price)
     # Показываем стоимость одной штуки по той же формуле и тем же курсам,
     # которые используются на финальном экране оформления.
@@ -1345,7 +2791,7 @@ def show_category_screen(chat_id: int, category: str, call=None) -> None:
         f"<b>{html.escape(category)}</b>\nPrice: <b>{price}₺</b>{conversion}\n\nChoose a flavor:",
     )
     keyboard = get_inline_flavors(chat_id, category)
-    photo_url = str(menu[category].get("photo_url", "") or "").strip()
+    photo_url = category_record.photo_url
 
     # Если пользователь уже находится на фото-карточке этой категории,
     # обновляем её подпись. Иначе выключаем старые кнопки и создаём карточку.
@@ -1376,7 +2822,7 @@ def show_category_screen(chat_id: int, category: str, call=None) -> None:
 def recover_catalog_screen(chat_id: int, call=None) -> None:
     """Возвращает пользователя с устаревшей кнопки в актуальный каталог."""
     category = user_data.get(chat_id, {}).get("current_category")
-    if category in menu:
+    if category in current_catalog().by_name:
         show_category_screen(chat_id, category, call)
     else:
         show_main_menu(chat_id, call)
@@ -1500,13 +2946,13 @@ def admin_model_inline_keyboard(
 ) -> types.InlineKeyboardMarkup:
     """Выбор одной модели для складского инструмента."""
     kb = types.InlineKeyboardMarkup(row_width=1)
-    for category in menu:
-        label = str(category)
+    for category in current_catalog().categories:
+        label = category.name
         if len(label) > 56:
             label = label[:53] + "…"
         kb.add(types.InlineKeyboardButton(
             text=label,
-            callback_data=f"{callback_prefix}|{category_token(category)}",
+            callback_data=f"{callback_prefix}|{category.token}",
         ))
     kb.add(types.InlineKeyboardButton(
         text="⬅️ Back to /change",
@@ -1543,10 +2989,11 @@ def parse_full_flavor_names(payload: str) -> list[str]:
 
 def send_full_flavor_list_prompt(chat_id: int, category: str) -> None:
     """Показывает полный сохранённый список вкусов одной модели."""
+    category_record = current_catalog().by_name.get(category)
     flavor_names = [
-        str(item.get("flavor", "")).strip()
-        for item in menu.get(category, {}).get("flavors", [])
-        if str(item.get("flavor", "")).strip()
+        item.flavor.strip()
+        for item in (category_record.flavors if category_record else ())
+        if item.flavor.strip()
     ]
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     kb.add("⬅️ Back", "❌ Cancel")
@@ -1606,21 +3053,22 @@ def actual_tastes_editor_keyboard(
     category: str,
     page: int,
 ) -> types.InlineKeyboardMarkup:
-    flavors = menu.get(category, {}).get("flavors", [])
+    category_record = current_catalog().by_name.get(category)
+    flavors = category_record.flavors if category_record else ()
     page_count = max((len(flavors) + ACTUAL_TASTES_PAGE_SIZE - 1) // ACTUAL_TASTES_PAGE_SIZE, 1)
     page = max(0, min(page, page_count - 1))
     start = page * ACTUAL_TASTES_PAGE_SIZE
     visible = flavors[start:start + ACTUAL_TASTES_PAGE_SIZE]
     kb = types.InlineKeyboardMarkup(row_width=3)
     for offset, item in enumerate(visible, start=start + 1):
-        flavor = str(item.get("flavor", "—"))
-        token = product_token(category, flavor)
+        flavor = item.flavor or "—"
+        token = item.token
         display_name = flavor if len(flavor) <= 52 else flavor[:49] + "…"
         kb.row(types.InlineKeyboardButton(
             text=f"{offset}. {display_name}",
             callback_data=f"actual_tastes_noop|{token}",
         ))
-        stock = max(int(item.get("stock", 0) or 0), 0)
+        stock = item.stock
         kb.row(
             types.InlineKeyboardButton(
                 text="➖",
@@ -1672,8 +3120,9 @@ def show_actual_tastes_editor(
     page: int = 0,
     call=None,
 ) -> None:
-    flavors = menu.get(category, {}).get("flavors", [])
-    total_stock = sum(max(int(item.get("stock", 0) or 0), 0) for item in flavors)
+    category_record = current_catalog().by_name.get(category)
+    flavors = category_record.flavors if category_record else ()
+    total_stock = category_record.total_stock if category_record else 0
     text = (
         f"<b>🔄 {html.escape(category)}</b>\n\n"
         f"Stored flavors: <b>{len(flavors)}</b>\n"
@@ -1783,14 +3232,15 @@ def handle_actual_tastes_quantity(call):
     if action not in {"inc", "dec"}:
         return bot.answer_callback_query(call.id, "Invalid stock action.", show_alert=True)
     with menu_lock:
-        resolved = resolve_product(token)
+        resolved = resolve_menu_item(token)
         if not resolved:
             return bot.answer_callback_query(call.id, "Flavor not found.", show_alert=True)
         category, item = resolved
         current_stock = max(int(item.get("stock", 0) or 0), 0)
         new_stock = current_stock + 1 if action == "inc" else max(current_stock - 1, 0)
-        item["stock"] = new_stock
-        save_menu_safely()
+        journal = StockJournal()
+        journal.set_stock(item, new_stock)
+        journal.save()
     bot.answer_callback_query(call.id, f"{item.get('flavor', 'Flavor')}: {new_stock} pcs")
     show_actual_tastes_editor(call.from_user.id, category, page, call)
 
@@ -1833,11 +3283,26 @@ def handle_actual_tastes_done(call):
 @bot.message_handler(commands=['start'])
 def cmd_start(message):
     chat_id = message.chat.id
-    init_user(chat_id)
+
+    # --- регистрация пользователя / обработка referral ---
+    text = message.text or ""
+    referrer_code = text.split("ref=", 1)[1] if "ref=" in text else None
+    saved_language, referral_code, is_new_user, items_json = register_user(
+        chat_id, message.from_user, referrer_code,
+    )
+    if _bot_identity is not None:
+        # Ссылки «Пригласить друга» готовы заранее, без getMe и запроса к БД.
+        referral_links(chat_id, referral_code)
 
     # /start возвращает в меню, но не уничтожает уже собранную корзину.
-    lang = user_data[chat_id].get("lang")
-    existing_cart = list(user_data[chat_id].get("cart", []))
+    # Если пользователь ещё не в памяти, корзина пришла тем же запросом.
+    previous = user_data.get(chat_id)
+    if previous is None:
+        lang, existing_cart = saved_language, parse_saved_cart(items_json)
+    else:
+        lang = saved_language or previous.get("lang")
+        existing_cart = list(previous.get("cart", []))
+    remember_language(chat_id, lang)
     user_data[chat_id] = {
         "lang": lang,
         "cart": existing_cart,
@@ -1868,104 +3333,38 @@ def cmd_start(message):
         "temp_review_rating": 0
     }
 
-    # --- регистрация пользователя / обработка referral ---
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT referral_code, referred_by, language FROM users WHERE chat_id = ?",
-        (chat_id,),
+    # --- если язык еще не выбран — показать выбор языка ---
+    if user_data[chat_id]["lang"] is None:
+        bot.send_message(
+            chat_id,
+            t(chat_id, "choose_language"),
+            reply_markup=get_inline_language_buttons(chat_id)
+        )
+        return
+
+    # У известного пользователя убираем reply-клавиатуру предыдущего шага.
+    # До первого выбора языка её ещё нет, поэтому лишнее русское сообщение
+    # перед двуязычным экраном больше не появляется.
+    bot.send_message(
+        chat_id,
+        tr(chat_id, "🔙 Вернулись в главное меню", "🔙 Back to the main menu"),
+        reply_markup=types.ReplyKeyboardRemove(),
     )
-    row = cur.fetchone()
-    is_new_user = row is None
-    username, first_name, last_name = telegram_profile_values(message.from_user)
-    now = utc_now_iso()
 
+    # Реферальная карточка показывается один раз при регистрации, а не при
+    # каждом возврате через /start.
     if is_new_user:
-        referred_by = None
-        text = message.text or ""
-
-        # если зашёл по ссылке ref
-        if "ref=" in text:
-            code = text.split("ref=")[1]
-            cur.execute("SELECT chat_id FROM users WHERE referral_code = ?", (code,))
-            r = cur.fetchone()
-            if r:
-                referred_by = r[0]
-
-        # генерируем уникальный код
-        new_code = generate_ref_code()
-        while True:
-            cur.execute("SELECT chat_id FROM users WHERE referral_code = ?", (new_code,))
-            if cur.fetchone() is None:
-                break
-            new_code = generate_ref_code()
+        send_referral_info(chat_id, referral_code)
 
-        cur.execute(
-            """
-            INSERT INTO users (
-                chat_id, points, referral_code, referred_by,
-                username, first_name, last_name,
-                registered_at, last_seen_at, is_active, status_updated_at
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?)
-            """,
-            (
-                chat_id, 0, new_code, referred_by,
-                username, first_name, last_name,
-                now, now, now,
-            ),
-        )
-        conn.commit()
+    # --- главное меню ---
+    show_main_menu(chat_id)
 
-        referral_code = new_code
-    else:
-        referral_code = row[0]  # уже существующий
-        cur.execute(
-            """
-            UPDATE users
-               SET username = ?,
-                   first_name = ?,
-                   last_name = ?,
-                   last_seen_at = ?,
-                   is_active = 1,
-                   inactive_reason = NULL,
-                   status_updated_at = ?
-             WHERE chat_id = ?
-            """,
-            (username, first_name, last_name, now, now, chat_id),
-        )
-        conn.commit()
-        if row[2] in ("ru", "en"):
-            user_data[chat_id]["lang"] = row[2]
-
-    cur.close()
-    conn.close()
-
-    # --- если язык еще не выбран — показать выбор языка ---
-    if user_data[chat_id]["lang"] is None:
-        bot.send_message(
-            chat_id,
-            t(chat_id, "choose_language"),
-            reply_markup=get_inline_language_buttons(chat_id)
-        )
-        return
-
-    # У известного пользователя убираем reply-клавиатуру предыдущего шага.
-    # До первого выбора языка её ещё нет, поэтому лишнее русское сообщение
-    # перед двуязычным экраном больше не появляется.
-    bot.send_message(
-        chat_id,
-        tr(chat_id, "🔙 Вернулись в главное меню", "🔙 Back to the main menu"),
-        reply_markup=types.ReplyKeyboardRemove(),
-    )
-
-    # Реферальная карточка показывается один раз при регистрации, а не при
-    # каждом возврате через /start.
-    if is_new_user:
-        send_referral_info(chat_id, referral_code)
-
-    # --- главное меню ---
-    show_main_menu(chat_id)
+    # --- ссылки из inline-поиска: ?start=p-<token> и ?start=search ---
+    payload = text.split(maxsplit=1)[1] if " " in text.strip() else ""
+    if payload.startswith(PRODUCT_START_PREFIX):
+        show_product_by_token(chat_id, payload[len(PRODUCT_START_PREFIX):])
+    elif payload == "search":
+        show_search_prompt(chat_id)
 
 # ------------------------------------------------------------------------
 #   15. Callback: выбор языка
@@ -2019,29 +3418,16 @@ def handle_set_lang(call):
     was_changing = user_data[chat_id].pop("changing_language", False)
     return_to = user_data[chat_id].pop("language_return", "menu")
     user_data[chat_id]["lang"] = lang_code
+    remember_language(chat_id, lang_code)
     save_user_language(chat_id, lang_code)
 
     initial_selection = previous_language not in ("ru", "en") and not was_changing
 
     bot.answer_callback_query(call.id, t(chat_id, "lang_set"))
-    try:
-        bot.edit_message_reply_markup(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            reply_markup=None,
-        )
-    except Exception:
-        pass
-
-    conn_local = get_db_connection()
-    cursor_local = conn_local.cursor()
-    cursor_local.execute("SELECT referral_code FROM users WHERE chat_id = ?", (chat_id,))
-    row = cursor_local.fetchone()
-    cursor_local.close()
-    conn_local.close()
+    disable_inline_keyboard(call)
 
-    if initial_selection and row:
-        send_referral_info(chat_id, row[0])
+    if initial_selection:
+        send_referral_info(chat_id, referral_links(chat_id).code)
 
     # При первой настройке главное меню отправляется последним сообщением,
     # чтобы оно не оказалось выше реферальной карточки и не потерялось.
@@ -2086,6 +3472,7 @@ def handle_go_back_to_categories(call):
         "wait_for_address": False,
         "wait_for_contact": False,
         "wait_for_comment": False,
+        "wait_for_search": False,
         "edit_cart_phase": None,
         "pending_discount": 0,
         "pending_points_spent": 0,
@@ -2102,29 +3489,14 @@ def handle_go_back_to_categories(call):
 # ------------------------------------------------------------------------
 #   18. Callback: выбор вкуса
 # ------------------------------------------------------------------------
-@ensure_user
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("product|"))
-def handle_flavor(call):
-    chat_id = call.from_user.id
-    init_user(chat_id)
-    _, token = call.data.split("|", 1)
-    resolved = resolve_product(token)
-    if not resolved:
-        bot.answer_callback_query(call.id, t(chat_id, "error_invalid"), show_alert=True)
-        recover_catalog_screen(chat_id, call)
-        return
-
-    cat, item = resolved
-    if int(item.get("stock", 0)) <= 0:
-        return bot.answer_callback_query(call.id, t(chat_id, "error_out_of_stock"), show_alert=True)
-
-    flavor = item["flavor"]
-    price = menu[cat]["price"]
-    stock = int(item.get("stock", 0))
+def product_screen(chat_id: int, cat: str, item: CatalogFlavor):
+    """Текст и клавиатура карточки вкуса."""
+    flavor = item.flavor
+    price = current_catalog().by_name[cat].price
+    stock = item.stock
     in_cart = cart_quantity(chat_id, cat, flavor)
-    bot.answer_callback_query(call.id)
 
-    desc = item.get(f"description_{user_data[chat_id]['lang']}", "")
+    desc = item.description(user_data[chat_id]['lang'])
     price_all = accepted_price_text(chat_id, price, 1)
     lines = [
         f"<b>{html.escape(str(flavor))}</b>",
@@ -2145,7 +3517,7 @@ def handle_flavor(call):
     kb.add(
         types.InlineKeyboardButton(
             text=f"➕ {t(chat_id, 'add_to_cart')}",
-            callback_data=f"cart_add|{token}"
+            callback_data=f"cart_add|{item.token}"
         ),
         types.InlineKeyboardButton(
             text=nav_text(chat_id, "flavors"),
@@ -2163,7 +3535,27 @@ def handle_flavor(call):
             callback_data="view_cart"
         ))
 
-    render_inline_screen(chat_id, caption, kb, call)
+    return caption, kb
+
+
+@ensure_user
+@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("product|"))
+def handle_flavor(call):
+    chat_id = call.from_user.id
+    init_user(chat_id)
+    _, token = call.data.split("|", 1)
+    resolved = resolve_product(token)
+    if not resolved:
+        bot.answer_callback_query(call.id, t(chat_id, "error_invalid"), show_alert=True)
+        recover_catalog_screen(chat_id, call)
+        return
+
+    cat, item = resolved
+    if item.stock <= 0:
+        return bot.answer_callback_query(call.id, t(chat_id, "error_out_of_stock"), show_alert=True)
+
+    bot.answer_callback_query(call.id)
+    render_inline_screen(chat_id, *product_screen(chat_id, cat, item), call)
 
 
 @ensure_user
@@ -2172,7 +3564,7 @@ def handle_back_to_flavors(call):
     chat_id = call.from_user.id
     bot.answer_callback_query(call.id)
     cat = user_data.get(chat_id, {}).get("current_category")
-    if not cat or cat not in menu:
+    if not cat or cat not in current_catalog().by_name:
         bot.send_message(
             chat_id,
             t(chat_id, "choose_category"),
@@ -2181,6 +3573,142 @@ def handle_back_to_flavors(call):
         return
     show_category_screen(chat_id, cat, call)
 
+
+# ─── Поиск по каталогу: кнопка главного меню и inline-режим ───────────────
+INLINE_SEARCH_LIMIT = 20
+INLINE_SEARCH_CACHE_SECONDS = 10
+PRODUCT_START_PREFIX = "p-"
+
+
+def search_prompt_text(chat_id: int) -> str:
+    return tr(
+        chat_id,
+        "<b>🔎 Поиск вкуса</b>\n\nНапишите название, часть названия или эмодзи, "
+        "например: <i>манго</i>, <i>ice</i>, 🍓",
+        "<b>🔎 Flavor search</b>\n\nType a name, part of a name or an emoji, "
+        "for example: <i>mango</i>, <i>ice</i>, 🍓",
+    )
+
+
+def search_results_keyboard(chat_id: int, results, query: str = "") -> types.InlineKeyboardMarkup:
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    stock_unit = tr(chat_id, "шт", "pcs")
+    for item in results:
+        kb.add(types.InlineKeyboardButton(
+            text=f"{item.emoji} {item.flavor} · {item.category} · {item.stock} {stock_unit}".strip(),
+            callback_data=f"product|{item.token}",
+        ))
+    if query.strip():
+        # Тот же запрос в inline-режиме: можно переслать вкус в любой чат.
+        kb.add(types.InlineKeyboardButton(
+            text=tr(chat_id, "↗️ Поделиться из любого чата", "↗️ Share from any chat"),
+            switch_inline_query=query.strip(),
+        ))
+    kb.add(types.InlineKeyboardButton(
+        text=nav_text(chat_id, "models"),
+        callback_data="go_back_to_categories",
+    ))
+    return kb
+
+
+def show_search_prompt(chat_id: int, call=None) -> None:
+    user_data[chat_id]["wait_for_search"] = True
+    render_inline_screen(
+        chat_id,
+        search_prompt_text(chat_id),
+        search_results_keyboard(chat_id, ()),
+        call,
+        allow_media_edit=False,
+    )
+
+
+def show_search_results(chat_id: int, query: str) -> None:
+    """Ответ на текстовый запрос: найденные вкусы кнопками, поиск остаётся открытым."""
+    results = search_catalog(query)
+    escaped = html.escape(query.strip())
+    if results:
+        text = tr(
+            chat_id,
+            f"<b>🔎 «{escaped}»</b>: найдено {len(results)}. Можно уточнить запрос.",
+            f"<b>🔎 “{escaped}”</b>: {len(results)} found. Type again to refine.",
+        )
+    else:
+        text = tr(
+            chat_id,
+            f"<b>🔎 «{escaped}»</b>: в наличии ничего не нашлось. Попробуйте другое слово.",
+            f"<b>🔎 “{escaped}”</b>: nothing in stock. Try another word.",
+        )
+    render_inline_screen(chat_id, text, search_results_keyboard(chat_id, results, query))
+
+
+def show_product_by_token(chat_id: int, token: str) -> bool:
+    """Карточка вкуса по ссылке из inline-поиска (t.me/<bot>?start=p-<token>)."""
+    resolved = resolve_product(token)
+    if not resolved or resolved[1].stock <= 0:
+        return False
+    render_inline_screen(chat_id, *product_screen(chat_id, *resolved))
+    return True
+
+
+@ensure_user
+@bot.callback_query_handler(func=lambda call: call.data == "search")
+def handle_search_button(call):
+    chat_id = call.from_user.id
+    init_user(chat_id)
+    bot.answer_callback_query(call.id)
+    show_search_prompt(chat_id, call)
+
+
+@bot.inline_handler(func=lambda query: True)
+def handle_inline_search(query):
+    user_id = query.from_user.id
+    # Inline-запрос может прийти от кого угодно в любом чате: язык берём из
+    # кеша или из Telegram, не заводя пользователя через init_user.
+    lang = chat_languages.get(user_id)
+    if lang is None:
+        lang = "en" if (query.from_user.language_code or "").startswith("en") else "ru"
+
+    def pick(ru_text: str, en_text: str) -> str:
+        return en_text if lang == "en" else ru_text
+
+    text = (query.query or "").strip()
+    results = search_catalog(text, INLINE_SEARCH_LIMIT) if text else []
+    catalog = current_catalog()
+    stock_unit = pick("шт", "pcs")
+    articles = []
+    for item in results:
+        price = catalog.by_name[item.category].price
+        message_text = (
+            f"<b>{html.escape(item.flavor)}</b>\n"
+            f"{html.escape(item.category)}\n"
+            f"{accepted_price_text(user_id, price, 1, lang)}"
+        )
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton(
+            text=pick("🛒 Открыть в боте", "🛒 Open in the bot"),
+            url=f"https://t.me/{bot_username()}?start={PRODUCT_START_PREFIX}{item.token}",
+        ))
+        articles.append(types.InlineQueryResultArticle(
+            id=item.token,
+            title=f"{item.emoji} {item.flavor}".strip(),
+            description=f"{item.category} · {format_money(price)}₺ · {item.stock} {stock_unit}",
+            input_message_content=types.InputTextMessageContent(message_text, parse_mode="HTML"),
+            reply_markup=kb,
+        ))
+    button = None
+    if not articles:
+        button = types.InlineQueryResultsButton(
+            text=pick("Открыть каталог в боте", "Open the catalog in the bot"),
+            start_parameter="search",
+        )
+    bot.answer_inline_query(
+        query.id,
+        articles,
+        cache_time=INLINE_SEARCH_CACHE_SECONDS,
+        is_personal=True,
+        button=button,
+    )
+
 # ------------------------------------------------------------------------
 #   19. Callback: добавить в корзину (без изменения stock)
 # ------------------------------------------------------------------------
@@ -2197,8 +3725,8 @@ def handle_add_to_cart(call):
         return
 
     cat, item = resolved
-    stock = int(item.get("stock", 0))
-    current_qty = cart_quantity(chat_id, cat, item["flavor"])
+    stock = item.stock
+    current_qty = cart_quantity(chat_id, cat, item.flavor)
     if stock <= current_qty:
         return bot.answer_callback_query(
             call.id,
@@ -2228,14 +3756,14 @@ def handle_add_to_cart(call):
         (
             cart_item for cart_item in cart
             if cart_item.get("category") == cat
-            and cart_item.get("flavor") == item["flavor"]
+            and cart_item.get("flavor") == item.flavor
         ),
         None,
     )
-    price = existing_item["price"] if existing_item else menu[cat]["price"]
+    price = existing_item["price"] if existing_item else current_catalog().by_name[cat].price
     cart.append({
         "category": cat,
-        "flavor": item["flavor"],
+        "flavor": item.flavor,
         "price": price
     })
     save_user_cart(chat_id)
@@ -2245,10 +3773,10 @@ def handle_add_to_cart(call):
     text = tr(
         chat_id,
         f"<b>✅ Добавлено в корзину</b>\n\n"
-        f"{html.escape(cat)}\n{html.escape(str(item['flavor']))}\n\n"
+        f"{html.escape(cat)}\n{html.escape(item.flavor)}\n\n"
         f"В корзине: {count} шт. на <b>{total_all}</b>",
         f"<b>✅ Added to cart</b>\n\n"
-        f"{html.escape(cat)}\n{html.escape(str(item['flavor']))}\n\n"
+        f"{html.escape(cat)}\n{html.escape(item.flavor)}\n\n"
         f"Cart: {count} pcs totaling <b>{total_all}</b>",
     )
     kb = types.InlineKeyboardMarkup(row_width=1)
@@ -2464,7 +3992,7 @@ def handle_cart_action(call):
 
     if action == "cart_inc":
         resolved = resolve_product(token)
-        stock = int(resolved[1].get("stock", 0)) if resolved else 0
+        stock = resolved[1].stock if resolved else 0
         if qty >= stock:
             return bot.answer_callback_query(
                 call.id,
@@ -2594,31 +4122,52 @@ def handle_stale_cart_button(call):
     send_cart(chat_id, call)
 
 
-def checkout_conversion_text(chat_id: int, total_after: int | float, qty: int) -> str:
+def checkout_conversion_text(
+    chat_id: int, total_after: int | float, qty: int, lang: str | None = None,
+) -> str:
     rates = fetch_rates()
+    # Строка зависит только от суммы, количества и набора курсов; язык на
+    # неё не влияет, поэтому одна запись обслуживает всех покупателей.
+    key = (_RATES_VERSION, float(total_after), qty)
+    with _conversion_memo_lock:
+        text = _conversion_memo.get(key)
+        if text is not None:
+            _conversion_memo.move_to_end(key)
+    if text is not None:
+        increment_counter("cache_requests_total", cache="conversion", result="hit")
+        return text
     if not all(rates.get(code, 0) for code in ("RUB", "USD", "EUR", "UAH")):
-        return tr(
-            chat_id,
-            " (≈ ₽—, €—, $—, ₴—; курсы временно недоступны)",
-            " (≈ ₽—, €—, $—, ₴—; rates temporarily unavailable)",
-        )
+        if (lang or chat_language(chat_id)) == "en":
+            return " (≈ ₽—, €—, $—, ₴—; rates temporarily unavailable)"
+        return " (≈ ₽—, €—, $—, ₴—; курсы временно недоступны)"
+    increment_counter("cache_requests_total", cache="conversion", result="miss")
+
     rub = round(total_after * rates["RUB"] + 500 * qty, 2)
     usd = round(total_after * rates["USD"] + 2 * qty, 2)
     eur = round(total_after * rates["EUR"] + 2 * qty, 2)
     uah = round(total_after * rates["UAH"] + 350 * qty, 2)
-    return (
+    text = (
         f" (≈ {format_money(rub)}₽, "
         f"€{format_money(eur)}, "
         f"${format_money(usd)}, "
         f"₴{format_money(uah)})"
     )
+    with _conversion_memo_lock:
+        # Курсы могли смениться, пока считали: устаревшую строку не кладём.
+        if key[0] == _RATES_VERSION and rates is _RATE_CACHE:
+            _conversion_memo[key] = text
+            while len(_conversion_memo) > CONVERSION_MEMO_MAX_ENTRIES:
+                _conversion_memo.popitem(last=False)
+    return text
 
 
-def accepted_price_text(chat_id: int, total_try: int | float, qty: int) -> str:
+def accepted_price_text(
+    chat_id: int, total_try: int | float, qty: int, lang: str | None = None,
+) -> str:
     """Цена в лирах и во всех валютах, которые принимает магазин."""
     return (
         f"{format_money(total_try)}₺"
-        f"{checkout_conversion_text(chat_id, total_try, max(int(qty), 0))}"
+        f"{checkout_conversion_text(chat_id, total_try, max(int(qty), 0), lang)}"
     )
 
 
@@ -3928,114 +5477,437 @@ def handle_comment_input(message):
 
 
 # ------------------------------------------------------------------------
-#   Callback: финальное оформление заказа (списание баллов, запись в БД)
+#   Outbox: доставка уведомлений о заказах фоновым пулом
 # ------------------------------------------------------------------------
-@ensure_user
-@bot.callback_query_handler(func=lambda call: call.data == "confirm_order")
-def finalize_order(call):
-    chat_id = call.from_user.id
-    data = user_data.get(chat_id, {})
-    bot.answer_callback_query(call.id)
-
-    cart = data.get("cart", [])
-    if not cart:
-        bot.send_message(chat_id, t(chat_id, "cart_empty"))
-        return
+# Строки outbox пишутся курсором транзакции заказа, поэтому уведомление
+# существует тогда и только тогда, когда заказ закоммичен. Каждый воркер
+# обслуживает свою часть адресатов (abs(destination) % OUTBOX_WORKERS) и берёт
+# только самое старое неотправленное сообщение адресата — порядок внутри
+# одного чата сохраняется, а медленный чат не задерживает остальные.
+OUTBOX_PRIORITY_CUSTOMER = 0
+OUTBOX_PRIORITY_ADMIN = 1
+OUTBOX_PRIORITY_REFERRAL = 2
+OUTBOX_WORKERS = max(int(os.getenv("OUTBOX_WORKERS", "3")), 1)
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BATCH_SIZE = 20
+OUTBOX_POLL_SECONDS = 5
+OUTBOX_RETENTION_DAYS = 7
+_outbox_wakeups = [threading.Event() for _ in range(OUTBOX_WORKERS)]
+# Воркер держит замок своей части, пока отправляет пачку и отмечает её в
+# базе; restore_backup берёт все замки и так приостанавливает отправку.
+_outbox_shard_locks = [threading.Lock() for _ in range(OUTBOX_WORKERS)]
+_outbox_started = False
+
+
+def enqueue_outbox_message(
+    cursor,
+    idempotency_key: str,
+    destination: int,
+    text: str,
+    *,
+    priority: int = OUTBOX_PRIORITY_ADMIN,
+    reply_markup=None,
+    translate_comment: str | None = None,
+) -> None:
+    """Кладёт сообщение в outbox внутри текущей транзакции вызывающего."""
+    payload = {"text": text}
+    if reply_markup is not None:
+        payload["reply_markup"] = reply_markup.to_json()
+    if translate_comment is not None:
+        # Перевод — сетевой вызов, поэтому он выполняется при отправке,
+        # а не под блокировкой склада.
+        payload["translate_comment"] = translate_comment
+    now = utc_now_iso()
+    cursor.execute(
+        "INSERT OR IGNORE INTO outbox "
+        "(idempotency_key, destination, priority, payload_json, status, attempts, "
+        "next_attempt_at, created_at) VALUES (?, ?, ?, ?, 'pending', 0, ?, ?)",
+        (
+            idempotency_key,
+            int(destination),
+            priority,
+            json.dumps(payload, ensure_ascii=False),
+            now,
+            now,
+        ),
+    )
 
-    # --- СЧИТАЕМ ИТОГИ ---
-    total_try = sum(i['price'] for i in cart)
-    pending_points = int(data.get("pending_points_spent", 0) or 0)
-    requested_promo_code = normalize_promo_code(data.get("promo_code", ""))
-    promo_code = ""
-    promo_discount = 0
-    comment = data.get("comment", "") or "—"
-    address = data.get("address", "")
-    contact = data.get("contact", "")
 
-    if not address or not contact:
-        bot.send_message(
-            chat_id,
-            tr(
-                chat_id,
-                "Не хватает адреса или контакта. Вернитесь назад и заполните данные.",
-                "Address or contact details are missing. Go back and complete them.",
-            ),
-            reply_markup=back_to_main_keyboard(chat_id),
-        )
-        return
+def wake_outbox() -> None:
+    """Будит воркеры outbox сразу после коммита новых сообщений."""
+    for wakeup in _outbox_wakeups:
+        wakeup.set()
 
-    if data.get("order_processing"):
-        bot.send_message(
-            chat_id,
-            tr(chat_id, "Заказ уже оформляется. Подождите немного.", "Your order is already being processed."),
-        )
-        return
-    data["order_processing"] = True
-    disable_inline_keyboard(call)
 
-    # Окончательная сумма пересчитывается внутри транзакции после повторной
-    # проверки промокода. Здесь задаём безопасные значения по умолчанию.
-    total_after = max(total_try - pending_points, 0)
+def outbox_retry_delay(exc: Exception, attempts: int) -> int:
+    result_json = getattr(exc, "result_json", None) or {}
+    retry_after = (result_json.get("parameters") or {}).get("retry_after")
+    if retry_after:
+        return int(retry_after) + 1
+    return min(5 * 2 ** attempts, 600)
 
-    # --- проверяем склад ---
-    needed = {}
-    for it in cart:
-        key = (it["category"], it["flavor"])
-        needed[key] = needed.get(key, 0) + 1
 
-    pts_earned = total_after // PURCHASE_POINTS_DIVISOR
-    items_json = json.dumps(cart, ensure_ascii=False)
-    now = utc_now_iso()
-    inviter = None
-    order_id = None
-    stock_changes = []
-    conn_local = None
+def deliver_outbox_row(outbox_id: int, destination: int, payload_json: str, attempts: int) -> None:
+    """Отправляет одну строку outbox и записывает результат."""
+    payload = json.loads(payload_json)
+    text = payload["text"]
+    if payload.get("translate_comment") is not None:
+        text += f"\n💬 Comment: {html.escape(translate_to_en(payload['translate_comment']))}"
 
+    error = None
     try:
-        # Один заказ целиком проходит под блокировкой: два одновременных клика
-        # не смогут продать один и тот же остаток.
-        with menu_lock:
-            selected_stock_items = []
-            for (cat0, flavor0), qty_needed in needed.items():
-                item_obj = next(
-                    (
-                        item
-                        for item in menu.get(cat0, {}).get("flavors", [])
-                        if item.get("flavor") == flavor0
-                    ),
-                    None,
-                )
-                if not item_obj or int(item_obj.get("stock", 0)) < qty_needed:
-                    data["order_processing"] = False
-                    bot.send_message(
-                        chat_id,
-                        tr(
-                            chat_id,
-                            f"😕 К сожалению, «{flavor0}» больше не доступен в нужном количестве.",
-                            f"😕 Unfortunately, “{flavor0}” is no longer available in the requested quantity.",
-                        ),
-                    )
-                    send_cart(chat_id)
-                    return
-                selected_stock_items.append((item_obj, qty_needed))
-
-            conn_local = get_db_connection()
-            cursor_local = conn_local.cursor()
-            cursor_local.execute("BEGIN IMMEDIATE")
-            cursor_local.execute(
-                "SELECT points, referred_by FROM users WHERE chat_id = ?",
-                (chat_id,),
-            )
-            user_row = cursor_local.fetchone()
-            current_points = int(user_row[0]) if user_row else 0
-            inviter = user_row[1] if user_row else None
+        bot.send_message(destination, text, reply_markup=payload.get("reply_markup"))
+    except Exception as exc:
+        error = exc
 
-            promo_id = None
-            if requested_promo_code:
-                cursor_local.execute(
-                    "SELECT promo_id, discount_amount, usage_limit, used_count, active, expires_at "
-                    "FROM promo_codes WHERE code = ?",
-                    (requested_promo_code,),
+    attempts += 1
+    now_dt = datetime.datetime.now(datetime.timezone.utc)
+    conn_local = get_db_connection()
+    cursor_local = conn_local.cursor()
+    if error is None:
+        cursor_local.execute(
+            "UPDATE outbox SET status = 'sent', attempts = ?, sent_at = ?, last_error = NULL "
+            "WHERE outbox_id = ?",
+            (attempts, now_dt.isoformat(), outbox_id),
+        )
+        increment_counter("outbox_messages_total", status="sent")
+    elif is_permanent_delivery_error(error) or attempts >= OUTBOX_MAX_ATTEMPTS:
+        cursor_local.execute(
+            "UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE outbox_id = ?",
+            (attempts, str(error)[:500], outbox_id),
+        )
+        increment_counter("outbox_messages_total", status="failed")
+        print(f"Outbox message {outbox_id} to {destination} failed permanently: {error}", flush=True)
+    else:
+        next_attempt = now_dt + datetime.timedelta(seconds=outbox_retry_delay(error, attempts))
+        cursor_local.execute(
+            "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE outbox_id = ?",
+            (attempts, next_attempt.isoformat(), str(error)[:500], outbox_id),
+        )
+        increment_counter("outbox_messages_total", status="retry")
+        print(f"Outbox message {outbox_id} to {destination} will be retried: {error}", flush=True)
+    conn_local.commit()
+    cursor_local.close()
+    conn_local.close()
+
+
+def drain_outbox_shard(shard: int) -> bool:
+    """Отправляет очередную пачку сообщений своей части адресатов."""
+    conn_local = get_db_connection()
+    cursor_local = conn_local.cursor()
+    cursor_local.execute(
+        """
+        SELECT o.outbox_id, o.destination, o.payload_json, o.attempts
+        FROM outbox o
+        WHERE o.status = 'pending'
+          AND abs(o.destination) % ? = ?
+          AND o.next_attempt_at <= ?
+          AND o.outbox_id = (
+              SELECT MIN(p.outbox_id) FROM outbox p
+              WHERE p.status = 'pending' AND p.destination = o.destination
+          )
+        ORDER BY o.priority, o.outbox_id
+        LIMIT ?
+        """,
+        (OUTBOX_WORKERS, shard, utc_now_iso(), OUTBOX_BATCH_SIZE),
+    )
+    rows = cursor_local.fetchall()
+    cursor_local.close()
+    conn_local.close()
+    for row in rows:
+        deliver_outbox_row(*row)
+    return bool(rows)
+
+
+def prune_sent_outbox() -> None:
+    cutoff = (
+        datetime.datetime.now(datetime.timezone.utc)
+        - datetime.timedelta(days=OUTBOX_RETENTION_DAYS)
+    ).isoformat()
+    conn_local = get_db_connection()
+    conn_local.execute("DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?", (cutoff,))
+    conn_local.commit()
+    conn_local.close()
+
+
+def outbox_worker(shard: int) -> None:
+    wakeup = _outbox_wakeups[shard]
+    last_prune = 0.0
+    while True:
+        wakeup.wait(timeout=OUTBOX_POLL_SECONDS)
+        wakeup.clear()
+        try:
+            while True:
+                with _outbox_shard_locks[shard]:
+                    if not drain_outbox_shard(shard):
+                        break
+            if shard == 0 and time.time() - last_prune > 3600:
+                prune_sent_outbox()
+                last_prune = time.time()
+        except Exception as exc:
+            print(f"Outbox worker {shard} error: {exc}", flush=True)
+
+
+def start_outbox_workers() -> None:
+    """Запускает пул отправителей outbox (один раз на процесс)."""
+    global _outbox_started
+    if _outbox_started:
+        return
+    _outbox_started = True
+    for shard in range(OUTBOX_WORKERS):
+        threading.Thread(
+            target=outbox_worker,
+            args=(shard,),
+            name=f"outbox-{shard}",
+            daemon=True,
+        ).start()
+    wake_outbox()
+
+
+def enqueue_order_notifications(
+    cursor,
+    *,
+    order_id: int,
+    chat_id: int,
+    from_user,
+    cart: list,
+    total_after,
+    promo_code: str,
+    promo_discount: int,
+    address: str,
+    contact: str,
+    comment: str,
+    inviter,
+) -> None:
+    """Пишет в outbox все уведомления о новом заказе."""
+    grouped_summary = {}
+    for item in cart:
+        key = (item["category"], item["flavor"], item["price"])
+        grouped_summary[key] = grouped_summary.get(key, 0) + 1
+    summary = "\n".join(
+        f"{html.escape(str(category))}: {html.escape(str(flavor))} × {qty} — "
+        f"{format_money(float(price) * qty)}₺"
+        for (category, flavor, price), qty in grouped_summary.items()
+    )
+
+    conversion_suffix = checkout_conversion_text(chat_id, total_after, len(cart))
+
+    username = getattr(from_user, "username", None)
+    first_name = getattr(from_user, "first_name", None)
+    customer_label = f"@{username}" if username else (first_name or str(chat_id))
+    safe_customer = html.escape(str(customer_label))
+    safe_address = html.escape(str(address))
+    safe_contact = html.escape(str(contact))
+    safe_comment = html.escape(str(comment))
+    safe_promo_code = html.escape(promo_code)
+    promo_line_ru = (
+        f"🎟 Промокод {safe_promo_code}: −{format_money(promo_discount)}₺\n"
+        if promo_code else ""
+    )
+    promo_line_en = (
+        f"🎟 Promo code {safe_promo_code}: −{format_money(promo_discount)}₺\n"
+        if promo_code else ""
+    )
+
+    # --- сообщение пользователю: первым в очереди ---
+    enqueue_outbox_message(
+        cursor,
+        f"order:{order_id}:customer_accepted",
+        chat_id,
+        t(chat_id, "order_accepted"),
+        priority=OUTBOX_PRIORITY_CUSTOMER,
+        reply_markup=types.ReplyKeyboardRemove(),
+    )
+    if user_data.get(chat_id, {}).get("lang") == "en":
+        user_order_summary = (
+            f"📋 Your order #{order_id}:\n\n"
+            f"{summary}\n\n"
+            f"{promo_line_en}"
+            f"Total: {format_money(total_after)}₺{conversion_suffix}\n"
+            f"📍 Address: {safe_address}\n"
+            f"📱 Contact: {safe_contact}\n"
+            f"💬 Comment: {safe_comment}"
+        )
+    else:
+        user_order_summary = (
+            f"📋 Ваш заказ №{order_id}:\n\n"
+            f"{summary}\n\n"
+            f"{promo_line_ru}"
+            f"Итог: {format_money(total_after)}₺{conversion_suffix}\n"
+            f"📍 Адрес: {safe_address}\n"
+            f"📱 Контакт: {safe_contact}\n"
+            f"💬 Комментарий: {safe_comment}"
+        )
+    enqueue_outbox_message(
+        cursor,
+        f"order:{order_id}:customer_summary",
+        chat_id,
+        user_order_summary,
+        priority=OUTBOX_PRIORITY_CUSTOMER,
+        reply_markup=back_to_main_keyboard(chat_id),
+    )
+
+    # --- уведомления админам ---
+    if PERSONAL_CHAT_ID:
+        full_rus = (
+            f"📥 Новый заказ №{order_id} от {safe_customer}:\n\n"
+            f"{summary}\n\n"
+            f"{promo_line_ru}"
+            f"Итог: {format_money(total_after)}₺{conversion_suffix}\n"
+            f"📍 Адрес: {safe_address}\n"
+            f"📱 Контакт: {safe_contact}\n"
+            f"💬 Комментарий: {safe_comment}"
+        )
+        enqueue_outbox_message(cursor, f"order:{order_id}:personal", PERSONAL_CHAT_ID, full_rus)
+
+    full_en = (
+        f"📥 New order #{order_id} from {safe_customer}:\n\n"
+        f"{summary}\n\n"
+        f"{promo_line_en}"
+        f"Total: {format_money(total_after)}₺{conversion_suffix}\n"
+        f"📍 Address: {safe_address}\n"
+        f"📱 Contact: {safe_contact}"
+    )
+    enqueue_outbox_message(
+        cursor,
+        f"order:{order_id}:group",
+        GROUP_CHAT_ID,
+        full_en,
+        reply_markup=admin_order_keyboard(order_id, chat_id),
+        translate_comment=str(comment),
+    )
+
+    if inviter:
+        init_user(inviter)
+        enqueue_outbox_message(
+            cursor,
+            f"order:{order_id}:referral:{inviter}",
+            inviter,
+            tr(
+                inviter,
+                f"🎉 Вам начислено {REFERRAL_BONUS_POINTS} бонусных баллов за приглашение нового клиента!",
+                f"🎉 You received {REFERRAL_BONUS_POINTS} bonus points for inviting a new customer!",
+            ),
+            priority=OUTBOX_PRIORITY_REFERRAL,
+        )
+
+
+# ------------------------------------------------------------------------
+#   Callback: финальное оформление заказа (списание баллов, запись в БД)
+# ------------------------------------------------------------------------
+@ensure_user
+@bot.callback_query_handler(func=lambda call: call.data == "confirm_order")
+@early_callback_ack(
+    lambda call: tr(call.from_user.id, "⏳ Оформляем заказ…", "⏳ Placing your order…")
+)
+def finalize_order(call):
+    chat_id = call.from_user.id
+    data = user_data.get(chat_id, {})
+
+    cart = data.get("cart", [])
+    if not cart:
+        bot.send_message(chat_id, t(chat_id, "cart_empty"))
+        return
+
+    # --- СЧИТАЕМ ИТОГИ ---
+    total_try = sum(i['price'] for i in cart)
+    pending_points = int(data.get("pending_points_spent", 0) or 0)
+    requested_promo_code = normalize_promo_code(data.get("promo_code", ""))
+    promo_code = ""
+    promo_discount = 0
+    comment = data.get("comment", "") or "—"
+    address = data.get("address", "")
+    contact = data.get("contact", "")
+
+    if not address or not contact:
+        bot.send_message(
+            chat_id,
+            tr(
+                chat_id,
+                "Не хватает адреса или контакта. Вернитесь назад и заполните данные.",
+                "Address or contact details are missing. Go back and complete them.",
+            ),
+            reply_markup=back_to_main_keyboard(chat_id),
+        )
+        return
+
+    if data.get("order_processing"):
+        bot.send_message(
+            chat_id,
+            tr(chat_id, "Заказ уже оформляется. Подождите немного.", "Your order is already being processed."),
+        )
+        return
+    data["order_processing"] = True
+    disable_inline_keyboard(call)
+
+    # Окончательная сумма пересчитывается внутри транзакции после повторной
+    # проверки промокода. Здесь задаём безопасные значения по умолчанию.
+    total_after = max(total_try - pending_points, 0)
+
+    # --- проверяем склад ---
+    needed = {}
+    for it in cart:
+        key = (it["category"], it["flavor"])
+        needed[key] = needed.get(key, 0) + 1
+
+    pts_earned = total_after // PURCHASE_POINTS_DIVISOR
+    items_json = json.dumps(cart, ensure_ascii=False)
+    now = utc_now_iso()
+    inviter = None
+    order_id = None
+    stock_journal = StockJournal()
+    conn_local = None
+
+    # Курсы нужны для текста уведомлений внутри транзакции; прогреваем кеш
+    # заранее, чтобы сетевой запрос не выполнялся под блокировкой склада.
+    fetch_rates()
+
+    try:
+        # Один заказ целиком проходит под блокировкой: два одновременных клика
+        # не смогут продать один и тот же остаток.
+        with menu_lock:
+            selected_stock_items = []
+            for (cat0, flavor0), qty_needed in needed.items():
+                item_obj = next(
+                    (
+                        item
+                        for item in menu.get(cat0, {}).get("flavors", [])
+                        if item.get("flavor") == flavor0
+                    ),
+                    None,
+                )
+                if not item_obj or int(item_obj.get("stock", 0)) < qty_needed:
+                    data["order_processing"] = False
+                    increment_counter("orders_total", outcome="out_of_stock")
+                    bot.send_message(
+                        chat_id,
+                        tr(
+                            chat_id,
+                            f"😕 К сожалению, «{flavor0}» больше не доступен в нужном количестве.",
+                            f"😕 Unfortunately, “{flavor0}” is no longer available in the requested quantity.",
+                        ),
+                    )
+                    send_cart(chat_id)
+                    return
+                selected_stock_items.append((item_obj, qty_needed))
+
+            conn_local = get_db_connection()
+            cursor_local = conn_local.cursor()
+            cursor_local.execute("BEGIN IMMEDIATE")
+            cursor_local.execute(
+                "SELECT points, referred_by FROM users WHERE chat_id = ?",
+                (chat_id,),
+            )
+            user_row = cursor_local.fetchone()
+            current_points = int(user_row[0]) if user_row else 0
+            inviter = user_row[1] if user_row else None
+
+            promo_id = None
+            if requested_promo_code:
+                cursor_local.execute(
+                    "SELECT promo_id, discount_amount, usage_limit, used_count, active, expires_at "
+                    "FROM promo_codes WHERE code = ?",
+                    (requested_promo_code,),
                 )
                 promo_row = cursor_local.fetchone()
                 if promo_row and promo_is_expired(promo_row[5]):
@@ -4067,15 +5939,13 @@ def finalize_order(call):
             pts_earned = int(total_after) // PURCHASE_POINTS_DIVISOR
 
             for item_obj, qty_needed in selected_stock_items:
-                old_stock = int(item_obj.get("stock", 0))
-                stock_changes.append((item_obj, old_stock))
-                item_obj["stock"] = old_stock - qty_needed
-            save_menu_safely()
+                stock_journal.set_stock(item_obj, int(item_obj.get("stock", 0)) - qty_needed)
+            stock_journal.save()
 
             cursor_local.execute(
                 "INSERT INTO orders "
                 "(chat_id, items_json, total, timestamp, points_spent, points_earned, "
-                "promo_code, promo_discount) VALUES (?,?,?,?,?,?,?,?)",
+                "promo_code, promo_discount, history_summary) VALUES (?,?,?,?,?,?,?,?,?)",
                 (
                     chat_id,
                     items_json,
@@ -4085,6 +5955,7 @@ def finalize_order(call):
                     pts_earned,
                     promo_code or None,
                     promo_discount,
+                    order_history_summary(items_json),
                 ),
             )
             order_id = cursor_local.lastrowid
@@ -4121,14 +5992,8 @@ def finalize_order(call):
             # Если Railway перезапустится сразу после commit, оформленный заказ
             # уже не появится в корзине повторно.
             cursor_local.execute(
-                """
-                INSERT INTO user_carts (chat_id, items_json, updated_at)
-                VALUES (?, '[]', ?)
-                ON CONFLICT(chat_id) DO UPDATE SET
-                    items_json = excluded.items_json,
-                    updated_at = excluded.updated_at
-                """,
-                (chat_id, now),
+                "DELETE FROM user_carts WHERE chat_id = ?",
+                (chat_id,),
             )
             if inviter:
                 cursor_local.execute(
@@ -4139,7 +6004,24 @@ def finalize_order(call):
                     "UPDATE users SET referred_by = NULL WHERE chat_id = ?",
                     (chat_id,),
                 )
+            # Уведомления фиксируются вместе с заказом: после commit их
+            # доставит outbox, даже если процесс сразу перезапустится.
+            enqueue_order_notifications(
+                cursor_local,
+                order_id=order_id,
+                chat_id=chat_id,
+                from_user=call.from_user,
+                cart=cart,
+                total_after=total_after,
+                promo_code=promo_code,
+                promo_discount=promo_discount,
+                address=address,
+                contact=contact,
+                comment=comment,
+                inviter=inviter,
+            )
             conn_local.commit()
+            stock_journal.commit()
             cursor_local.close()
             conn_local.close()
             conn_local = None
@@ -4147,11 +6029,8 @@ def finalize_order(call):
         if conn_local is not None:
             conn_local.rollback()
             conn_local.close()
-        with menu_lock:
-            for item_obj, old_stock in stock_changes:
-                item_obj["stock"] = old_stock
-            if stock_changes:
-                save_menu_safely()
+        stock_journal.rollback(f"Order for {chat_id}")
+        increment_counter("orders_total", outcome="promo_rejected")
         data["order_processing"] = False
         points_to_restore = int(
             data.get("points_before_promo", data.get("pending_points_spent", 0)) or 0
@@ -4183,11 +6062,8 @@ def finalize_order(call):
         if conn_local is not None:
             conn_local.rollback()
             conn_local.close()
-        with menu_lock:
-            for item_obj, old_stock in stock_changes:
-                item_obj["stock"] = old_stock
-            if stock_changes:
-                save_menu_safely()
+        stock_journal.rollback(f"Order for {chat_id}")
+        increment_counter("orders_total", outcome="points_rejected")
         data["order_processing"] = False
         data["pending_discount"] = 0
         data["pending_points_spent"] = 0
@@ -4205,14 +6081,8 @@ def finalize_order(call):
         if conn_local is not None:
             conn_local.rollback()
             conn_local.close()
-        with menu_lock:
-            for item_obj, old_stock in stock_changes:
-                item_obj["stock"] = old_stock
-            if stock_changes:
-                try:
-                    save_menu_safely()
-                except Exception as restore_exc:
-                    print(f"Failed to restore menu after order error: {restore_exc}")
+        stock_journal.rollback(f"Order for {chat_id}")
+        increment_counter("orders_total", outcome="failed")
         data["order_processing"] = False
         print(f"Order confirmation failed for {chat_id}: {exc}")
         bot.send_message(
@@ -4249,110 +6119,8 @@ def finalize_order(call):
     data.pop("return_to_review_after_comment", None)
     user_data[chat_id] = data
     save_user_cart(chat_id)
-
-    if inviter:
-        try:
-            init_user(inviter)
-            bot.send_message(
-                inviter,
-                tr(
-                    inviter,
-                    f"🎉 Вам начислено {REFERRAL_BONUS_POINTS} бонусных баллов за приглашение нового клиента!",
-                    f"🎉 You received {REFERRAL_BONUS_POINTS} bonus points for inviting a new customer!",
-                ),
-            )
-        except Exception as exc:
-            print(f"Referral notification failed for {inviter}: {exc}")
-
-    # --- уведомления ---
-    grouped_summary = {}
-    for item in cart:
-        key = (item["category"], item["flavor"], item["price"])
-        grouped_summary[key] = grouped_summary.get(key, 0) + 1
-    summary = "\n".join(
-        f"{html.escape(str(category))}: {html.escape(str(flavor))} × {qty} — "
-        f"{format_money(float(price) * qty)}₺"
-        for (category, flavor, price), qty in grouped_summary.items()
-    )
-
-    conversion_suffix = checkout_conversion_text(chat_id, total_after, len(cart))
-
-    username = getattr(call.from_user, "username", None)
-    first_name = getattr(call.from_user, "first_name", None)
-    customer_label = f"@{username}" if username else (first_name or str(chat_id))
-    safe_customer = html.escape(str(customer_label))
-    safe_address = html.escape(str(address))
-    safe_contact = html.escape(str(contact))
-    safe_comment = html.escape(str(comment))
-    translated_comment = html.escape(translate_to_en(str(comment)))
-    safe_promo_code = html.escape(promo_code)
-    promo_line_ru = (
-        f"🎟 Промокод {safe_promo_code}: −{format_money(promo_discount)}₺\n"
-        if promo_code else ""
-    )
-    promo_line_en = (
-        f"🎟 Promo code {safe_promo_code}: −{format_money(promo_discount)}₺\n"
-        if promo_code else ""
-    )
-
-    full_rus = (
-        f"📥 Новый заказ №{order_id} от {safe_customer}:\n\n"
-        f"{summary}\n\n"
-        f"{promo_line_ru}"
-        f"Итог: {format_money(total_after)}₺{conversion_suffix}\n"
-        f"📍 Адрес: {safe_address}\n"
-        f"📱 Контакт: {safe_contact}\n"
-        f"💬 Комментарий: {safe_comment}"
-    )
-    if PERSONAL_CHAT_ID:
-        try:
-            bot.send_message(PERSONAL_CHAT_ID, full_rus)
-        except Exception as exc:
-            print(f"Personal order notification failed for order {order_id}: {exc}")
-
-    full_en = (
-        f"📥 New order #{order_id} from {safe_customer}:\n\n"
-        f"{summary}\n\n"
-        f"{promo_line_en}"
-        f"Total: {format_money(total_after)}₺{conversion_suffix}\n"
-        f"📍 Address: {safe_address}\n"
-        f"📱 Contact: {safe_contact}\n"
-        f"💬 Comment: {translated_comment}"
-    )
-    kb_admin = admin_order_keyboard(order_id, chat_id)
-
-    try:
-        bot.send_message(GROUP_CHAT_ID, full_en, reply_markup=kb_admin)
-    except Exception as exc:
-        print(f"Group order notification failed for order {order_id}: {exc}")
-
-    # --- сообщение пользователю ---
-    bot.send_message(
-        chat_id,
-        t(chat_id, "order_accepted"),
-        reply_markup=types.ReplyKeyboardRemove(),
-    )
-    if user_data.get(chat_id, {}).get("lang") == "en":
-        user_order_summary = (
-            f"📋 Your order #{order_id}:\n\n"
-            f"{summary}\n\n"
-            f"{promo_line_en}"
-            f"Total: {format_money(total_after)}₺{conversion_suffix}\n"
-            f"📍 Address: {safe_address}\n"
-            f"📱 Contact: {safe_contact}\n"
-            f"💬 Comment: {safe_comment}"
-        )
-    else:
-        user_order_summary = (
-            f"📋 Ваш заказ №{order_id}:\n\n"
-            f"{summary}\n\n"
-            f"{promo_line_ru}"
-            f"Итог: {format_money(total_after)}₺{conversion_suffix}\n"
-            f"📍 Адрес: {safe_address}\n"
-            f"📱 Контакт: {safe_contact}\n"
-            f"💬 Комментарий: {safe_comment}"
-        )
-    bot.send_message(chat_id, user_order_summary, reply_markup=back_to_main_keyboard(chat_id))
+    wake_outbox()
+    increment_counter("orders_total", outcome="created")
 
 
 # ------------------------------------------------------------------------
@@ -4401,6 +6169,7 @@ def cmd_change(message):
 
     # Инициализируем данные пользователя, если нужно
     if chat_id not in user_data:
+        remember_language(chat_id, "ru")
         user_data[chat_id] = {
             "lang": "ru",
             "cart": [],
@@ -4524,12 +6293,12 @@ def profile_back_keyboard(chat_id: int) -> types.InlineKeyboardMarkup:
 
 def show_profile(chat_id: int, call=None) -> None:
     init_user(chat_id)
-    conn_local = get_db_connection()
+    conn_local = get_reporting_connection()
     cursor_local = conn_local.cursor()
     cursor_local.execute("SELECT points FROM users WHERE chat_id = ?", (chat_id,))
     row = cursor_local.fetchone()
     points = int(row[0]) if row else 0
-    cursor_local.execute("SELECT COUNT(*) FROM orders WHERE chat_id = ?", (chat_id,))
+    cursor_local.execute("SELECT COUNT(*) FROM all_orders WHERE chat_id = ?", (chat_id,))
     order_count = int(cursor_local.fetchone()[0])
     cursor_local.close()
     conn_local.close()
@@ -4600,45 +6369,9 @@ def show_points_info(chat_id: int, call=None) -> None:
 
 def show_referral_info(chat_id: int, call=None) -> None:
     """Показывает персональную ссылку и точные условия реферального бонуса."""
-    conn_local = get_db_connection()
-    cursor_local = conn_local.cursor()
-    cursor_local.execute(
-        "SELECT referral_code FROM users WHERE chat_id = ?",
-        (chat_id,),
-    )
-    row = cursor_local.fetchone()
-
-    referral_code = str(row[0]).strip() if row and row[0] else ""
-    if not referral_code:
-        referral_code = generate_ref_code()
-        while True:
-            cursor_local.execute(
-                "SELECT 1 FROM users WHERE referral_code = ?",
-                (referral_code,),
-            )
-            if cursor_local.fetchone() is None:
-                break
-            referral_code = generate_ref_code()
-        cursor_local.execute(
-            "UPDATE users SET referral_code = ? WHERE chat_id = ?",
-            (referral_code, chat_id),
-        )
-        conn_local.commit()
-
-    cursor_local.close()
-    conn_local.close()
-
-    bot_username = bot.get_me().username
-    invite_link = f"https://t.me/{bot_username}?start=ref={referral_code}"
-    share_text = tr(
-        chat_id,
-        "Заказывай через этого бота — вот моя персональная ссылка:",
-        "Order through this bot — here is my personal link:",
-    )
-    share_url = "https://t.me/share/url?" + urlencode({
-        "url": invite_link,
-        "text": share_text,
-    })
+    links = referral_links(chat_id)
+    invite_link = links.invite_link
+    share_url = links.share_url(chat_language(chat_id))
 
     text = tr(
         chat_id,
@@ -4676,18 +6409,110 @@ def show_referral_info(chat_id: int, call=None) -> None:
     )
 
 
-def show_order_history(chat_id: int, call=None) -> None:
+HISTORY_PAGE_SIZE = 10
+HISTORY_COLUMNS = "order_id, timestamp, total, promo_code, promo_discount, history_summary"
+
+
+def order_history_summary(items_json: str | None) -> str:
+    """Готовая строка «вкус × количество» для истории (HTML-экранирована)."""
+    try:
+        items = json.loads(items_json or "[]")
+    except (json.JSONDecodeError, TypeError):
+        items = []
+    grouped = {}
+    for item in items if isinstance(items, list) else []:
+        if isinstance(item, dict):
+            flavor = str(item.get("flavor", "—"))
+            grouped[flavor] = grouped.get(flavor, 0) + 1
+    return ", ".join(
+        f"{html.escape(flavor)} × {qty}" for flavor, qty in grouped.items()
+    ) or "—"
+
+
+def backfill_order_summaries(batch_size: int = 500) -> int:
+    """Один раз заполняет history_summary у заказов, созданных до столбца."""
+    filled = 0
     conn_local = get_db_connection()
-    cursor_local = conn_local.cursor()
-    cursor_local.execute(
-        "SELECT order_id, items_json, total, timestamp, promo_code, promo_discount "
-        "FROM orders "
-        "WHERE chat_id = ? ORDER BY timestamp DESC LIMIT 10",
-        (chat_id,),
-    )
-    rows = cursor_local.fetchall()
-    cursor_local.close()
-    conn_local.close()
+    try:
+        while True:
+            rows = conn_local.execute(
+                "SELECT order_id, items_json FROM orders "
+                "WHERE history_summary IS NULL LIMIT ?",
+                (batch_size,),
+            ).fetchall()
+            if not rows:
+                break
+            conn_local.executemany(
+                "UPDATE orders SET history_summary = ? WHERE order_id = ?",
+                [(order_history_summary(items_json), order_id) for order_id, items_json in rows],
+            )
+            conn_local.commit()
+            filled += len(rows)
+    finally:
+        conn_local.close()
+    if filled:
+        print(f"[INFO] Order history summaries backfilled: {filled}", flush=True)
+    return filled
+
+
+backfill_order_summaries()
+
+
+def order_history_page(chat_id: int, *, before: int | None = None, after: int | None = None):
+    """
+    Страница истории по ключу (keyset): заказы старше before или новее after.
+    Возвращает (строки от новых к старым, есть_новее, есть_старее).
+    Читает all_orders: в историю входят и заказы из archive.db.
+    """
+    conn_local = get_reporting_connection()
+    try:
+        if after is not None:
+            rows = conn_local.execute(
+                f"SELECT {HISTORY_COLUMNS} FROM all_orders "
+                "WHERE chat_id = ? AND order_id > ? ORDER BY order_id ASC LIMIT ?",
+                (chat_id, after, HISTORY_PAGE_SIZE + 1),
+            ).fetchall()
+            has_newer = len(rows) > HISTORY_PAGE_SIZE
+            return rows[:HISTORY_PAGE_SIZE][::-1], has_newer, True
+        rows = conn_local.execute(
+            f"SELECT {HISTORY_COLUMNS} FROM all_orders "
+            "WHERE chat_id = ? AND order_id < ? ORDER BY order_id DESC LIMIT ?",
+            (chat_id, before if before is not None else 2 ** 63 - 1, HISTORY_PAGE_SIZE + 1),
+        ).fetchall()
+        return rows[:HISTORY_PAGE_SIZE], before is not None, len(rows) > HISTORY_PAGE_SIZE
+    finally:
+        conn_local.close()
+
+
+def order_history_keyboard(chat_id: int, rows, has_newer: bool, has_older: bool):
+    kb = profile_back_keyboard(chat_id)
+    buttons = []
+    if rows and has_newer:
+        buttons.append(types.InlineKeyboardButton(
+            text=tr(chat_id, "◀️ Новее", "◀️ Newer"),
+            callback_data=f"history|after|{rows[0][0]}",
+        ))
+    if rows and has_older:
+        buttons.append(types.InlineKeyboardButton(
+            text=tr(chat_id, "Старее ▶️", "Older ▶️"),
+            callback_data=f"history|before|{rows[-1][0]}",
+        ))
+    if buttons:
+        kb.keyboard.insert(0, buttons)
+    return kb
+
+
+def show_order_history(
+    chat_id: int,
+    call=None,
+    *,
+    before: int | None = None,
+    after: int | None = None,
+) -> None:
+    rows, has_newer, has_older = order_history_page(chat_id, before=before, after=after)
+    if not rows and (before is not None or after is not None):
+        # Страница опустела (например, заказ отменён) — начинаем с новых.
+        rows, has_newer, has_older = order_history_page(chat_id)
 
     if not rows:
         text = tr(
@@ -4696,19 +6521,13 @@ def show_order_history(chat_id: int, call=None) -> None:
             "<b>📦 My orders</b>\n\nYou do not have any orders yet.",
         )
     else:
-        blocks = [tr(chat_id, "<b>📦 Последние заказы</b>", "<b>📦 Recent orders</b>")]
-        for order_id, items_json, total, timestamp, promo_code, promo_discount in rows:
-            try:
-                items = json.loads(items_json)
-            except (json.JSONDecodeError, TypeError):
-                items = []
-            grouped = {}
-            for item in items:
-                flavor = str(item.get("flavor", "—"))
-                grouped[flavor] = grouped.get(flavor, 0) + 1
-            summary = ", ".join(
-                f"{html.escape(flavor)} × {qty}" for flavor, qty in grouped.items()
-            ) or "—"
+        title = (
+            tr(chat_id, "<b>📦 Последние заказы</b>", "<b>📦 Recent orders</b>")
+            if not has_newer else
+            tr(chat_id, "<b>📦 Мои заказы</b>", "<b>📦 My orders</b>")
+        )
+        blocks = [title]
+        for order_id, timestamp, total, promo_code, promo_discount, summary in rows:
             date = str(timestamp).split("T")[0]
             promo_history_line = (
                 f"🎟 {html.escape(str(promo_code))}: "
@@ -4717,7 +6536,7 @@ def show_order_history(chat_id: int, call=None) -> None:
             )
             blocks.append(
                 f"<b>#{order_id} · {html.escape(date)}</b>\n"
-                f"{summary}\n"
+                f"{summary or '—'}\n"
                 f"{promo_history_line}"
                 f"{tr(chat_id, 'Итого', 'Total')}: {format_money(total)}₺"
             )
@@ -4726,7 +6545,7 @@ def show_order_history(chat_id: int, call=None) -> None:
     render_inline_screen(
         chat_id,
         text,
-        profile_back_keyboard(chat_id),
+        order_history_keyboard(chat_id, rows, has_newer, has_older),
         call,
         allow_media_edit=False,
     )
@@ -4810,6 +6629,23 @@ def handle_profile_history(call):
     show_order_history(call.from_user.id, call)
 
 
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("history|"))
+def handle_history_page(call):
+    chat_id = call.from_user.id
+    init_user(chat_id)
+    bot.answer_callback_query(call.id)
+    try:
+        _, direction, raw_order_id = call.data.split("|", 2)
+        order_id = int(raw_order_id)
+    except ValueError:
+        show_order_history(chat_id, call)
+        return
+    if direction == "after":
+        show_order_history(chat_id, call, after=order_id)
+    else:
+        show_order_history(chat_id, call, before=order_id)
+
+
 @bot.callback_query_handler(func=lambda call: call.data == "profile_payment")
 def handle_profile_payment(call):
     if not is_owner(call.from_user.id) or call.message.chat.id != ADMIN_ID:
@@ -4961,23 +6797,17 @@ def cmd_total(message):
     lines = []
     total_pcs = 0
 
-    for cat, cat_data in menu.items():
-        cat_lines = []
-        cat_total = 0
-
-        for itm in cat_data.get("flavors", []):
-            stock = int(itm.get("stock", 0))
-            if stock <= 0:
-                continue  # ⬅️ скрываем нулевые вкусы
-
-            flavor = itm.get("flavor", "—")
-            cat_total += stock
-            total_pcs += stock
-            cat_lines.append(f"  • {flavor} — {stock} pcs")
+    for category in current_catalog().categories:
+        # ⬅️ нулевые вкусы скрыты: in_stock содержит только stock > 0
+        cat_lines = [
+            f"  • {itm.flavor or '—'} — {itm.stock} pcs"
+            for itm in category.in_stock
+        ]
+        total_pcs += category.total_stock
 
         # если в категории есть хоть что-то — показываем
         if cat_lines:
-            lines.append(f"<b>{cat}</b>:")
+            lines.append(f"<b>{category.name}</b>:")
             lines.extend(cat_lines)
             lines.append("")
 
@@ -4998,14 +6828,14 @@ def cmd_stocknow(message: types.Message):
     if message.chat.id != GROUP_CHAT_ID:
         return bot.reply_to(message, "❌ This command is available only in the admin group.")
 
-    conn = get_db_connection()
+    conn, as_of = get_analytics_connection()
     cur = conn.cursor()
     cur.execute("SELECT SUM(count) FROM delivered_counts")
     total = cur.fetchone()[0] or 0
     cur.close()
     conn.close()
 
-    bot.reply_to(message, f"✅ Total delivered: {total} pcs.")
+    bot.reply_to(message, f"✅ Total delivered: {total} pcs.\n{data_as_of_line(as_of)}")
 
 
 
@@ -5044,6 +6874,153 @@ def cmd_envcheck(message):
     bot.send_message(chat_id, text)
 
 
+# Профилирование под реальной нагрузкой без редеплоя: /profile 50 — следующие
+# 50 апдейтов, /profile 30s — 30 секунд, /profile off — остановить досрочно.
+# Каждый вызов хендлера (и его фонового продолжения) идёт через свой
+# cProfile.Profile, результаты складываются в один pstats.Stats.
+PROFILE_DEFAULT_UPDATES = 50
+PROFILE_MAX_UPDATES = 1000
+PROFILE_MAX_SECONDS = 600
+PROFILE_GRACE_SECONDS = 2.0
+PROFILE_TOP_FUNCTIONS = 40
+
+_profile_lock = threading.Lock()
+_profile_session: dict | None = None
+
+
+def profiled_call(function, *args, **kwargs):
+    """Вызывает function; во время сессии /profile — под cProfile."""
+    session = _profile_session
+    if session is None:
+        return function(*args, **kwargs)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        with _profile_lock:
+            if not session["finished"]:
+                if session["stats"] is None:
+                    session["stats"] = pstats.Stats(profiler, stream=io.StringIO())
+                else:
+                    session["stats"].add(profiler)
+                session["calls"] += 1
+
+
+def count_profiled_updates(count: int) -> None:
+    """
+    Учитывает принятые апдейты в сессии /profile. Считается на приёме, а не
+    в хендлерах: один callback проходит несколько хендлеров (ContinueHandling).
+    """
+    session = _profile_session
+    if session is None or not count:
+        return
+    with _profile_lock:
+        if session["finished"] or session["finishing"]:
+            return
+        session["updates"] += count
+        limit = session["limit_updates"]
+        if not limit or session["updates"] < limit:
+            return
+        session["finishing"] = True
+    # Даём хендлерам последних апдейтов и фоновым продолжениям
+    # (finalize_order и т.п.) досчитаться.
+    threading.Timer(PROFILE_GRACE_SECONDS, finish_profile_session, args=(session,)).start()
+
+
+def start_profile_session(chat_id: int, *, updates: int = 0, seconds: int = 0) -> bool:
+    global _profile_session
+    with _profile_lock:
+        if _profile_session is not None:
+            return False
+        session = {
+            "chat_id": chat_id,
+            "limit_updates": updates,
+            "started": time.perf_counter(),
+            "stats": None,
+            "calls": 0,
+            "updates": 0,
+            "finishing": False,
+            "finished": False,
+        }
+        _profile_session = session
+    if seconds:
+        threading.Timer(seconds, finish_profile_session, args=(session,)).start()
+    return True
+
+
+def finish_profile_session(session: dict) -> None:
+    """Закрывает сессию и отправляет владельцу топ функций по cumulative."""
+    global _profile_session
+    with _profile_lock:
+        if session["finished"]:
+            return
+        session["finished"] = True
+        if _profile_session is session:
+            _profile_session = None
+        stats = session["stats"]
+    elapsed = time.perf_counter() - session["started"]
+    summary = (
+        f"🧪 Профиль готов — апдейтов: {session['updates']}, "
+        f"вызовов: {session['calls']}, время: {elapsed:.1f} с.\n"
+        f"Версия: <code>{html.escape(BOT_VERSION)}</code>"
+    )
+    if stats is None:
+        bot.send_message(session["chat_id"], summary + "\n\nЗа это время хендлеры не вызывались.")
+        return
+    stats.stream = io.StringIO()
+    stats.strip_dirs().sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+    report = stats.stream.getvalue()
+    document = io.BytesIO(report.encode("utf-8"))
+    bot.send_document(
+        session["chat_id"],
+        document,
+        caption=summary,
+        visible_file_name=f"profile-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.txt",
+    )
+
+
+@ensure_user
+@bot.message_handler(commands=['profile'])
+def cmd_profile(message):
+    """Владелец включает cProfile на N апдейтов или N секунд."""
+    chat_id = message.chat.id
+    if not is_owner(message.from_user.id) or message.chat.type != "private":
+        bot.send_message(chat_id, "У вас нет доступа к этой команде.")
+        return
+
+    args = (message.text or "").split()[1:]
+    argument = args[0].lower() if args else str(PROFILE_DEFAULT_UPDATES)
+    if argument in ("off", "stop"):
+        session = _profile_session
+        if session is None:
+            bot.send_message(chat_id, "Профилирование не запущено.")
+        else:
+            finish_profile_session(session)
+        return
+
+    match = re.fullmatch(r"(\d+)(s?)", argument)
+    if not match or int(match.group(1)) <= 0:
+        bot.send_message(
+            chat_id,
+            "Использование: <code>/profile 50</code> (апдейты), "
+            "<code>/profile 30s</code> (секунды) или <code>/profile off</code>.",
+        )
+        return
+    amount = int(match.group(1))
+    if match.group(2):
+        amount = min(amount, PROFILE_MAX_SECONDS)
+        started = start_profile_session(chat_id, seconds=amount)
+        scope = f"секунд: {amount}"
+    else:
+        amount = min(amount, PROFILE_MAX_UPDATES)
+        started = start_profile_session(chat_id, updates=amount)
+        scope = f"апдейтов: {amount}"
+    if not started:
+        bot.send_message(chat_id, "Профилирование уже идёт. Остановить: <code>/profile off</code>.")
+        return
+    bot.send_message(chat_id, f"🧪 Профилирование включено ({scope}). Отчёт придёт файлом.")
+
+
 def reject_payment_callback(call) -> bool:
     """Разрешает платёжные кнопки только владельцу в админ-группе."""
     if is_owner(call.from_user.id) and call.message.chat.id == GROUP_CHAT_ID:
@@ -5245,6 +7222,52 @@ def send_delivered_customer_message(
     )
 
 
+# Чаты с заказами в статусе awaiting_proof. Источник правды — orders:
+# индекс обновляется после коммита каждой смены payment_status и заново
+# строится из БД при старте, поэтому рестарт или сбой его не портят.
+# Фильтр фото/файлов от всех клиентов обходится поиском в словаре.
+_awaiting_proof_orders: dict[int, set[int]] = {}
+_awaiting_proof_lock = threading.Lock()
+
+
+def mark_awaiting_proof(chat_id: int, order_id: int) -> None:
+    with _awaiting_proof_lock:
+        _awaiting_proof_orders.setdefault(chat_id, set()).add(order_id)
+
+
+def clear_awaiting_proof(chat_id: int, *order_ids: int) -> None:
+    with _awaiting_proof_lock:
+        orders = _awaiting_proof_orders.get(chat_id)
+        if orders is not None:
+            orders.difference_update(order_ids)
+            if not orders:
+                del _awaiting_proof_orders[chat_id]
+
+
+def awaiting_proof_orders(chat_id: int) -> set[int]:
+    """Копия заказов чата из индекса ожидающих чек."""
+    with _awaiting_proof_lock:
+        return set(_awaiting_proof_orders.get(chat_id, ()))
+
+
+def rebuild_awaiting_proof_index() -> int:
+    """Заполняет индекс из orders; возвращает число ожидающих заказов."""
+    conn_local = get_db_connection()
+    try:
+        rows = conn_local.execute(
+            "SELECT chat_id, order_id FROM orders WHERE payment_status = 'awaiting_proof'"
+        ).fetchall()
+    finally:
+        conn_local.close()
+    index: dict[int, set[int]] = {}
+    for chat_id, order_id in rows:
+        index.setdefault(int(chat_id), set()).add(int(order_id))
+    with _awaiting_proof_lock:
+        _awaiting_proof_orders.clear()
+        _awaiting_proof_orders.update(index)
+    return len(rows)
+
+
 def pending_payment_proof_order(
     chat_id: int,
     preferred_order_id: int | None = None,
@@ -5292,17 +7315,10 @@ def has_pending_payment_proof(message) -> bool:
     """Фильтр: фото/файл пришёл от клиента с ожидающим оплату заказом."""
     if getattr(getattr(message, "chat", None), "type", None) != "private":
         return False
-    chat_id = message.chat.id
-    preferred = user_data.get(chat_id, {}).get("awaiting_payment_proof_order_id")
-    try:
-        preferred_id = int(preferred) if preferred is not None else None
-    except (TypeError, ValueError):
-        preferred_id = None
-    try:
-        return pending_payment_proof_order(chat_id, preferred_id) is not None
-    except sqlite3.Error as exc:
-        print(f"Payment proof lookup failed for {chat_id}: {exc}", flush=True)
-        return False
+    return message.chat.id in _awaiting_proof_orders
+
+
+rebuild_awaiting_proof_index()
 
 
 def valid_payment_proof_document(message) -> bool:
@@ -5386,8 +7402,12 @@ def handle_payment_proof_upload(message):
         preferred_id = int(preferred) if preferred is not None else None
     except (TypeError, ValueError):
         preferred_id = None
+    # Снимок до запроса: заказ, отмеченный handle_deliver_currency уже после
+    # SELECT, в снимок не попадёт и из индекса не выпадет.
+    checked_orders = awaiting_proof_orders(chat_id)
     order_row = pending_payment_proof_order(chat_id, preferred_id)
     if not order_row:
+        clear_awaiting_proof(chat_id, *checked_orders)
         return bot.send_message(
             chat_id,
             tr(
@@ -5431,6 +7451,7 @@ def handle_payment_proof_upload(message):
         )
         proof_id = int(cursor_local.lastrowid)
         conn_local.commit()
+        clear_awaiting_proof(chat_id, order_id)
     except Exception as exc:
         conn_local.rollback()
         print(f"Payment proof DB save failed for order {order_id}: {exc}", flush=True)
@@ -5489,6 +7510,7 @@ def handle_payment_proof_upload(message):
                 (order_id,),
             )
             conn_local.commit()
+            mark_awaiting_proof(chat_id, order_id)
         except sqlite3.Error as db_exc:
             conn_local.rollback()
             print(
@@ -5558,13 +7580,12 @@ def reject_payment_proof_callback(call) -> bool:
 @bot.callback_query_handler(
     func=lambda call: call.data and call.data.startswith("proof_accept|")
 )
+@early_callback_ack("⏳ Подтверждаем оплату…", guard=reject_payment_proof_callback)
 def handle_payment_proof_accept(call):
-    if reject_payment_proof_callback(call):
-        return
     try:
         proof_id = int(call.data.split("|", 1)[1])
     except (ValueError, IndexError):
-        return bot.answer_callback_query(call.id, "Некорректный чек.", show_alert=True)
+        return answer_callback(call, "Некорректный чек.", show_alert=True)
 
     conn_local = get_db_connection()
     cursor_local = conn_local.cursor()
@@ -5578,8 +7599,8 @@ def handle_payment_proof_accept(call):
         conn_local.rollback()
         cursor_local.close()
         conn_local.close()
-        return bot.answer_callback_query(
-            call.id,
+        return answer_callback(
+            call,
             "Этот чек уже обработан.",
             show_alert=True,
         )
@@ -5598,6 +7619,7 @@ def handle_payment_proof_accept(call):
     conn_local.commit()
     cursor_local.close()
     conn_local.close()
+    clear_awaiting_proof(customer_chat_id, order_id)
 
     caption = (call.message.caption or "").replace(
         "Статус: ⏳ Ожидает проверки",
@@ -5630,8 +7652,8 @@ def handle_payment_proof_accept(call):
         notification_sent = False
         print(f"Payment confirmation delivery failed for order {order_id}: {exc}", flush=True)
 
-    bot.answer_callback_query(
-        call.id,
+    answer_callback(
+        call,
         "Оплата подтверждена" if notification_sent else "Подтверждено; клиент не получил сообщение",
         show_alert=not notification_sent,
     )
@@ -5680,6 +7702,7 @@ def handle_payment_proof_retry(call):
     conn_local.commit()
     cursor_local.close()
     conn_local.close()
+    mark_awaiting_proof(customer_chat_id, order_id)
 
     caption = (call.message.caption or "").replace(
         "Статус: ⏳ Ожидает проверки",
@@ -5723,7 +7746,7 @@ def handle_payment_proof_retry(call):
 
 # в самом верху вашего файла, сразу после импорта и констант:
 
-def compose_sold_report() -> str:
+def compose_sold_report(max_age: float = ANALYTICS_MAX_AGE_SECONDS, snapshot=None) -> str:
     """
     Отчёт за сегодня:
     - список доставок
@@ -5731,9 +7754,10 @@ def compose_sold_report() -> str:
     - общая выручка, выплаты курьеру, остаток
     - остатки по категориям и общий остаток
     - общее количество проданных штук
+    Доставки читаются из аналитической реплики не старше max_age секунд
+    или из готового снимка snapshot = (conn, as_of); его закрывает вызывающий.
     """
     import datetime, pytz, json
-    from sqlite3 import connect
 
     # 1️⃣ Начало текущего дня по Москве → UTC
     moscow_tz = pytz.timezone("Europe/Moscow")
@@ -5741,8 +7765,8 @@ def compose_sold_report() -> str:
     start_msk = now_msk.replace(hour=0, minute=0, second=0, microsecond=0)
     start_utc = start_msk.astimezone(pytz.utc).isoformat()
 
-    # 2️⃣ Достаём сегодняшние доставки из БД
-    conn = connect(DB_PATH, check_same_thread=False)
+    # 2️⃣ Достаём сегодняшние доставки из реплики
+    conn, as_of = snapshot or get_analytics_connection(max_age)
     cur = conn.cursor()
     cur.execute("""
         SELECT dl.timestamp, dl.order_id, dl.currency, dl.qty, o.items_json, o.total
@@ -5753,19 +7777,16 @@ def compose_sold_report() -> str:
     """, (start_utc,))
     rows = cur.fetchall()
     cur.close()
-    conn.close()
+    if snapshot is None:
+        conn.close()
 
     if not rows:
-        total_stock = sum(
-            int(itm.get("stock", 0))
-            for cat in menu.values()
-            for itm in cat.get("flavors", [])
-            if int(itm.get("stock", 0)) > 0
-        )
+        total_stock = current_catalog().total_stock
 
         return (
             "📊 Deliveries today: 0\n"
-            f"📦 Stock remaining: {total_stock} pcs"
+            f"📦 Stock remaining: {total_stock} pcs\n"
+            + data_as_of_line(as_of)
         )
 
     # 3️⃣ Собираем данные по доставкам
@@ -5800,12 +7821,11 @@ def compose_sold_report() -> str:
     remaining = cash_revenue - courier_pay
 
     # 5️⃣ Остатки по категориям (без разбивки по вкусам)
-    total_stock_left = 0
+    catalog = current_catalog()
+    total_stock_left = catalog.total_stock
     stock_lines = ["\n📦 Current stock by category:"]
-    for cat, cat_data in menu.items():
-        cat_total = sum(int(itm.get("stock", 0)) for itm in cat_data.get("flavors", []))
-        total_stock_left += cat_total
-        stock_lines.append(f"• {cat}: {cat_total} pcs")
+    for category in catalog.categories:
+        stock_lines.append(f"• {category.name}: {category.total_stock} pcs")
 
     # 6️⃣ Итоги
     stock_lines.append(f"\n🧾 Sold today: {total_sold_today} pcs")
@@ -5820,44 +7840,749 @@ def compose_sold_report() -> str:
         + f"\n🏃‍♂️ Courier earnings: {courier_pay}₺"
         + f"\n💰 Remaining revenue: {remaining}₺"
         + "\n\n" + "\n".join(stock_lines)
+        + "\n\n" + data_as_of_line(as_of)
     )
     return report
 
 
 
-def send_daily_sold_report():
+# ─── Обслуживание SQLite ───
+MAINTENANCE_VACUUM_PAGES_PER_STEP = 256
+MAINTENANCE_MAX_VACUUM_STEPS = 200
+MAINTENANCE_PAUSE_SECONDS = 0.05
+MAINTENANCE_ANALYSIS_LIMIT = 1000
+_last_maintenance: dict | None = None
+
+
+def database_stats() -> dict:
+    """Размер файлов базы и доля свободных страниц (фрагментация)."""
+    conn_local = get_db_connection()
+    try:
+        page_size = conn_local.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn_local.execute("PRAGMA page_count").fetchone()[0]
+        freelist = conn_local.execute("PRAGMA freelist_count").fetchone()[0]
+        auto_vacuum = conn_local.execute("PRAGMA auto_vacuum").fetchone()[0]
+    finally:
+        conn_local.close()
+    wal_path = DB_PATH + "-wal"
+    return {
+        "db_bytes": os.path.getsize(DB_PATH) if os.path.exists(DB_PATH) else 0,
+        "wal_bytes": os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+        "page_size": page_size,
+        "page_count": page_count,
+        "freelist_count": freelist,
+        "fragmentation": freelist / page_count if page_count else 0.0,
+        "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}.get(auto_vacuum, str(auto_vacuum)),
+    }
+
+
+def run_database_maintenance() -> dict:
     """
-    Функция, которую будет вызывать APScheduler.
+    Ночное обслуживание: ANALYZE с ограничением, PRAGMA optimize,
+    incremental_vacuum пачками, checkpoint WAL и quick_check.
+    Каждый шаг — отдельная короткая операция, между шагами пауза.
     """
-    text = compose_sold_report()
-    # отправляем в вашу группу
-    bot.send_message(GROUP_CHAT_ID, text)
+    started = time.perf_counter()
+    before = database_stats()
+    result = {"before": before, "vacuumed_pages": 0}
+    conn_local = get_db_connection()
+    try:
+        # analysis_limit ограничивает ANALYZE выборкой строк на индекс.
+        conn_local.execute(f"PRAGMA analysis_limit = {MAINTENANCE_ANALYSIS_LIMIT}")
+        conn_local.execute("ANALYZE")
+        conn_local.execute("PRAGMA optimize")
+        conn_local.commit()
 
-@ensure_user
-@bot.message_handler(commands=['sold'])
-def cmd_sold(message):
-    if not is_owner(message.from_user.id):
-        return bot.reply_to(message, "У вас нет доступа.")
-    report = compose_sold_report()
-    # при ручном вызове шлём в тот же чат, откуда команда
-    bot.send_message(message.chat.id, report)
+        for _ in range(MAINTENANCE_MAX_VACUUM_STEPS):
+            freelist = conn_local.execute("PRAGMA freelist_count").fetchone()[0]
+            if not freelist:
+                break
+            # execute() делает один шаг (одну страницу) у PRAGMA без
+            # результата, executescript() доводит её до конца.
+            conn_local.executescript(
+                f"PRAGMA incremental_vacuum({MAINTENANCE_VACUUM_PAGES_PER_STEP});"
+            )
+            result["vacuumed_pages"] += freelist - conn_local.execute(
+                "PRAGMA freelist_count"
+            ).fetchone()[0]
+            time.sleep(MAINTENANCE_PAUSE_SECONDS)
+
+        busy, wal_frames, checkpointed = conn_local.execute(
+            "PRAGMA wal_checkpoint(TRUNCATE)"
+        ).fetchone()
+        result["checkpoint"] = {
+            "busy": bool(busy),
+            "wal_frames": wal_frames,
+            "checkpointed": checkpointed,
+        }
+        problems = [row[0] for row in conn_local.execute("PRAGMA quick_check").fetchall()]
+        result["quick_check"] = "ok" if problems == ["ok"] else "; ".join(problems[:5])
+    finally:
+        conn_local.close()
+    result["after"] = database_stats()
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    result["finished_at"] = utc_now_iso()
+    observe_duration("sqlite_maintenance_seconds", result["seconds"])
+    return result
 
 
-# 1) Определяем отдельный хендлер прямо рядом с /convert, /points и т.д.
-@ensure_user
-@bot.message_handler(commands=['stats'])
-def cmd_stats(message: types.Message):
-    user_id = message.from_user.id
-    if not is_owner(user_id):
+def run_database_maintenance_job() -> None:
+    """Обёртка для планировщика; сбой quick_check сразу уходит в группу."""
+    global _last_maintenance
+    try:
+        result = run_database_maintenance()
+    except Exception as exc:
+        print(f"[WARN] Database maintenance failed: {type(exc).__name__}: {exc}", flush=True)
+        _last_maintenance = {"error": f"{type(exc).__name__}: {exc}", "finished_at": utc_now_iso()}
+        return
+    _last_maintenance = result
+    print(
+        f"[INFO] Database maintenance: vacuumed {result['vacuumed_pages']} pages, "
+        f"quick_check={result['quick_check']}, {result['seconds']}s",
+        flush=True,
+    )
+    if result["quick_check"] != "ok":
+        try:
+            bot.send_message(
+                GROUP_CHAT_ID,
+                f"⚠️ Database quick_check failed:\n{result['quick_check']}",
+            )
+        except Exception as exc:
+            print(f"[WARN] quick_check alert not sent: {exc}", flush=True)
+
+
+def _format_bytes(size: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def compose_database_report() -> str:
+    """Размер и фрагментация базы плюс итог последнего обслуживания."""
+    stats = database_stats()
+    lines = [
+        "🗄 Database",
+        f"File: {_format_bytes(stats['db_bytes'])} · WAL: {_format_bytes(stats['wal_bytes'])}",
+        f"Pages: {stats['page_count']} × {stats['page_size']} B · "
+        f"free: {stats['freelist_count']} ({stats['fragmentation']:.1%})",
+        f"auto_vacuum: {stats['auto_vacuum']}",
+    ]
+    if os.path.exists(ARCHIVE_DB_PATH):
+        lines.append(f"Archive: {_format_bytes(os.path.getsize(ARCHIVE_DB_PATH))}")
+    last = _last_maintenance
+    if last is None:
+        lines.append("Maintenance: not run since restart")
+    elif "error" in last:
+        lines.append(f"Maintenance failed ({last['finished_at'][:16]}): {last['error']}")
+    else:
+        lines.append(
+            f"Maintenance ({last['finished_at'][:16]} UTC): "
+            f"{last['seconds']}s, vacuumed {last['vacuumed_pages']} pages, "
+            f"quick_check: {last['quick_check']}"
+        )
+    return "\n".join(lines)
+
+
+def send_daily_sold_report():
+    """
+    Функция, которую будет вызывать APScheduler.
+    """
+    # Итог дня — по свежему снимку, а не по копии пятиминутной давности;
+    # текст и графики строятся по одному и тому же снимку.
+    snapshot = get_analytics_connection(max_age=0)
+    try:
+        text = compose_sold_report(snapshot=snapshot)
+        # отправляем в вашу группу
+        bot.send_message(GROUP_CHAT_ID, text)
+        send_sales_charts(GROUP_CHAT_ID, snapshot=snapshot)
+    finally:
+        snapshot[0].close()
+    try:
+        bot.send_message(GROUP_CHAT_ID, compose_database_report())
+    except Exception as exc:
+        print(f"[WARN] Database report not sent: {type(exc).__name__}: {exc}", flush=True)
+
+@ensure_user
+@bot.message_handler(commands=['sold'])
+def cmd_sold(message):
+    if not is_owner(message.from_user.id):
         return bot.reply_to(message, "У вас нет доступа.")
+    report = compose_sold_report()
+    # при ручном вызове шлём в тот же чат, откуда команда
+    bot.send_message(message.chat.id, report)
+    threading.Thread(
+        target=send_sales_charts,
+        args=(message.chat.id,),
+        name="sales-charts",
+        daemon=True,
+    ).start()
+
+
+# ─── Графики продаж ───
+# PNG строится в sales_charts.render_sales_charts в отдельном процессе:
+# pandas и matplotlib занимают CPU, а в процессе бота держали бы GIL и
+# тормозили хендлеры. Готовые картинки кешируются по (отчёт, день, версия
+# данных); версия меняется только с новыми доставками, поэтому повторный
+# /sold отдаёт тот же PNG без рендера.
+CHART_CACHE_MAX_ENTRIES = 16
+CHART_RENDER_TIMEOUT_SECONDS = 60
+_chart_cache: OrderedDict = OrderedDict()
+
+
+def chart_pool() -> ProcessPoolExecutor:
+    """Пул, поднятый start_chart_pool(); без него графики не строятся."""
+    pool = _chart_pool
+    if pool is None:
+        raise RuntimeError("chart worker is not running")
+    return pool
+
+
+def stop_chart_pool() -> None:
+    """
+    Закрывает пул после падения воркера (BrokenProcessPool). Новый fork из
+    процесса с воркерами telebot, планировщиком, outbox и /metrics
+    небезопасен (см. start_chart_pool), поэтому графики выключаются до
+    рестарта бота; текстовые отчёты работают как прежде.
+    """
+    global _chart_pool
+    with _chart_pool_lock:
+        pool, _chart_pool = _chart_pool, None
+        _chart_cache.clear()
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
 
-    conn = get_db_connection()
+
+def sales_chart_window() -> tuple[str, str]:
+    """(сегодняшний день по Москве, начало окна графика в UTC ISO)."""
+    moscow_tz = pytz.timezone("Europe/Moscow")
+    today = datetime.datetime.now(moscow_tz).date()
+    first_day = today - datetime.timedelta(days=sales_charts.CHART_DAYS - 1)
+    start_msk = moscow_tz.localize(datetime.datetime.combine(first_day, datetime.time()))
+    return today.isoformat(), start_msk.astimezone(pytz.utc).isoformat()
+
+
+def sales_chart_png(report: str = "sold", max_age: float = ANALYTICS_MAX_AGE_SECONDS, snapshot=None):
+    """PNG графиков из реплики или снимка (conn, as_of); возвращает (png, as_of)."""
+    day, start_utc = sales_chart_window()
+    conn, as_of = snapshot or get_analytics_connection(max_age)
+    try:
+        version = tuple(conn.execute(
+            "SELECT COUNT(*), MAX(id), SUM(qty) FROM all_delivered_log WHERE timestamp >= ?",
+            (start_utc,),
+        ).fetchone())
+        key = (report, day, version)
+        with _chart_pool_lock:
+            future = _chart_cache.get(key)
+            if future is not None:
+                _chart_cache.move_to_end(key)
+        # Попадание — запись была до этого вызова, даже если рендер ещё идёт.
+        cached = future is not None
+        if future is None:
+            rows = conn.execute(
+                """
+                SELECT dl.id, dl.timestamp, dl.currency, dl.qty, dl.order_id, o.total, o.items_json
+                  FROM all_delivered_log dl
+                  LEFT JOIN all_orders o ON o.order_id = dl.order_id
+                 WHERE dl.timestamp >= ?
+                """,
+                (start_utc,),
+            ).fetchall()
+            future = chart_pool().submit(sales_charts.render_sales_charts, rows, day)
+            with _chart_pool_lock:
+                # Параллельный /sold мог успеть раньше — берём его рендер.
+                future = _chart_cache.setdefault(key, future)
+                while len(_chart_cache) > CHART_CACHE_MAX_ENTRIES:
+                    _chart_cache.popitem(last=False)
+    finally:
+        if snapshot is None:
+            conn.close()
+    increment_counter("cache_requests_total", cache="sales_charts", result="hit" if cached else "miss")
+    try:
+        return future.result(timeout=CHART_RENDER_TIMEOUT_SECONDS), as_of
+    except BaseException:
+        with _chart_pool_lock:
+            if _chart_cache.get(key) is future:
+                del _chart_cache[key]
+        raise
+
+
+def send_sales_charts(chat_id: int, max_age: float = ANALYTICS_MAX_AGE_SECONDS, snapshot=None) -> None:
+    """Отправляет графики фото; любая ошибка только логируется."""
+    try:
+        png, as_of = sales_chart_png(max_age=max_age, snapshot=snapshot)
+        bot.send_photo(
+            chat_id,
+            io.BytesIO(png),
+            caption="📈 Sales charts\n" + data_as_of_line(as_of),
+        )
+    except BrokenProcessPool as exc:
+        stop_chart_pool()
+        print(f"[WARN] Chart worker crashed, sales charts disabled until restart: {exc}", flush=True)
+    except Exception as exc:
+        print(f"[WARN] Sales charts not sent: {type(exc).__name__}: {exc}", flush=True)
+
+
+# ─── Архив старых заказов (archive.db) ───
+# Доставленные и закрытые по оплате заказы старше ARCHIVE_AFTER_DAYS дней
+# вместе с delivered_log и payment_proofs переезжают в archive.db.
+# Оперативная база остаётся маленькой, а отчёты и история читают оба файла
+# через get_reporting_connection().
+ARCHIVE_AFTER_DAYS = max(int(os.getenv("ARCHIVE_AFTER_DAYS", "90") or 0), 0)
+ARCHIVE_BATCH_SIZE = 200
+ARCHIVE_PAUSE_SECONDS = 0.05
+
+
+def _archivable_order_ids(conn, cutoff: str) -> list[int]:
+    rows = conn.execute(
+        """
+        SELECT o.order_id
+          FROM main.orders o
+         WHERE (
+                   o.delivered_at < ?
+                   OR (o.delivered_at IS NULL AND o.timestamp < ?
+                       AND EXISTS (SELECT 1 FROM main.delivered_log dl
+                                    WHERE dl.order_id = o.order_id))
+               )
+           AND COALESCE(o.payment_status, 'not_required')
+               IN ('confirmed', 'cash', 'not_required')
+           AND NOT EXISTS (
+                   SELECT 1 FROM main.payment_proofs p
+                    WHERE p.order_id = o.order_id
+                      AND p.status IN ('uploading', 'pending')
+               )
+         ORDER BY o.order_id
+         LIMIT ?
+        """,
+        (cutoff, cutoff, ARCHIVE_BATCH_SIZE),
+    ).fetchall()
+    return [row[0] for row in rows]
+
+
+def archive_old_orders(after_days: int | None = None) -> dict:
+    """
+    Переносит старые закрытые заказы в archive.db пачками. Каждая пачка —
+    две короткие транзакции: копия в архив, затем удаление из основной
+    базы. Транзакция в WAL не атомарна между файлами, поэтому удаляются
+    только строки, уже лежащие в архиве; сбой между шагами оставляет
+    дубликат, который следующий запуск перезапишет (INSERT OR REPLACE).
+    """
+    after_days = ARCHIVE_AFTER_DAYS if after_days is None else after_days
+    stats = {table: 0 for table in ARCHIVED_TABLES}
+    if after_days <= 0:
+        return stats
+    started = time.perf_counter()
+    cutoff = (
+        datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=after_days)
+    ).isoformat()
+    conn_local = get_db_connection()
+    try:
+        conn_local.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_PATH,))
+        columns = {
+            table: ", ".join(
+                f'"{row[1]}"' for row in conn_local.execute(f"PRAGMA main.table_info({table})")
+            )
+            for table in ARCHIVED_TABLES
+        }
+        keys = {
+            "orders": "order_id",
+            "delivered_log": "id",
+            "payment_proofs": "proof_id",
+        }
+        while True:
+            order_ids = _archivable_order_ids(conn_local, cutoff)
+            if not order_ids:
+                break
+            placeholders = ",".join("?" * len(order_ids))
+            for table in ARCHIVED_TABLES:
+                conn_local.execute(
+                    f"INSERT OR REPLACE INTO archive.{table} ({columns[table]}) "
+                    f"SELECT {columns[table]} FROM main.{table} "
+                    f"WHERE order_id IN ({placeholders})",
+                    order_ids,
+                )
+            conn_local.commit()
+            for table in reversed(ARCHIVED_TABLES):
+                cursor = conn_local.execute(
+                    f"DELETE FROM main.{table} "
+                    f"WHERE order_id IN ({placeholders}) "
+                    f"AND ({keys[table]}) IN (SELECT {keys[table]} FROM archive.{table})",
+                    order_ids,
+                )
+                stats[table] += cursor.rowcount
+            conn_local.commit()
+            if len(order_ids) < ARCHIVE_BATCH_SIZE:
+                break
+            time.sleep(ARCHIVE_PAUSE_SECONDS)
+    finally:
+        conn_local.close()
+    if stats["orders"]:
+        increment_counter("archived_orders_total", stats["orders"])
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    return stats
+
+
+def archive_old_orders_job() -> None:
+    try:
+        stats = archive_old_orders()
+    except Exception as exc:
+        print(f"[WARN] Order archiving failed: {type(exc).__name__}: {exc}", flush=True)
+        return
+    print(
+        "[INFO] Archived: "
+        + ", ".join(f"{table}={stats[table]}" for table in ARCHIVED_TABLES)
+        + f", {stats.get('seconds', 0)}s",
+        flush=True,
+    )
+
+
+# ─── Резервные копии базы и каталога ───
+# База копируется онлайн через SQLite backup API: по BACKUP_PAGES_PER_STEP
+# страниц за шаг с паузой, так что checkout между шагами не ждёт. Каталог
+# берётся из памяти под menu_lock — это то же состояние, что видит бот.
+BACKUP_DIR = os.getenv("BACKUP_DIR", "").strip() or os.path.join(DATA_DIR, "backups")
+BACKUP_KEEP = max(int(os.getenv("BACKUP_KEEP", "14") or 1), 1)
+BACKUP_INTERVAL_HOURS = 6
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP_SECONDS = 0.005
+BACKUP_PREFIX = "backup-"
+_backup_lock = threading.Lock()
+
+
+class BackupError(Exception):
+    """Архив не прошёл проверку или не может быть восстановлен."""
+
+
+def _table_counts(conn) -> dict[str, int]:
+    tables = [
+        row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master "
+            "WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        )
+    ]
+    return {
+        table: conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+        for table in tables
+    }
+
+
+def list_backups() -> list[str]:
+    """Имена архивов, от новых к старым."""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    return sorted(
+        (name for name in os.listdir(BACKUP_DIR)
+         if name.startswith(BACKUP_PREFIX) and name.endswith(".zip")),
+        reverse=True,
+    )
+
+
+def rotate_backups(keep: int | None = None) -> list[str]:
+    removed = list_backups()[BACKUP_KEEP if keep is None else keep:]
+    for name in removed:
+        os.remove(os.path.join(BACKUP_DIR, name))
+    return removed
+
+
+def _copy_database(target_path: str, source_path: str = DB_PATH) -> None:
+    source = sqlite3.connect(source_path, check_same_thread=False)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(
+            target,
+            pages=BACKUP_PAGES_PER_STEP,
+            sleep=BACKUP_STEP_SLEEP_SECONDS,
+        )
+    finally:
+        target.close()
+        source.close()
+
+
+def verify_backup(path: str) -> dict:
+    """
+    Пробное восстановление: распаковывает архив во временный каталог,
+    проверяет integrity_check, сверяет число строк с манифестом и читает
+    menu.json. При любой несостыковке — BackupError.
+    """
+    with tempfile.TemporaryDirectory(prefix="restore-check-") as work_dir:
+        try:
+            with zipfile.ZipFile(path) as archive:
+                manifest = json.loads(archive.read("manifest.json"))
+                restored_menu = json.loads(archive.read("menu.json"))
+                databases = [
+                    (member, manifest_key)
+                    for member, manifest_key in (
+                        ("database.db", "tables"),
+                        ("archive.db", "archive_tables"),
+                    )
+                    if member in archive.namelist()
+                ]
+                for member, _manifest_key in databases:
+                    archive.extract(member, work_dir)
+        except (KeyError, zipfile.BadZipFile, json.JSONDecodeError) as exc:
+            raise BackupError(f"{os.path.basename(path)}: {exc}") from exc
+        if not isinstance(restored_menu, dict):
+            raise BackupError("menu.json is not an object")
+        if not databases or databases[0][0] != "database.db":
+            raise BackupError("database.db is missing")
+        for member, manifest_key in databases:
+            conn_check = sqlite3.connect(os.path.join(work_dir, member))
+            try:
+                integrity = conn_check.execute("PRAGMA integrity_check").fetchone()[0]
+                counts = _table_counts(conn_check)
+            finally:
+                conn_check.close()
+            if integrity != "ok":
+                raise BackupError(f"{member} integrity_check: {integrity}")
+            if counts != manifest.get(manifest_key):
+                raise BackupError(f"{member}: row counts differ from manifest")
+    return manifest
+
+
+def create_backup(reason: str = "scheduled") -> dict:
+    """Снимает базу и каталог в сжатый архив, проверяет его и чистит старые."""
+    with _backup_lock:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        started = time.perf_counter()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        # Миллисекунды в имени: копия «перед восстановлением» может быть снята
+        # в ту же секунду, что и восстанавливаемый архив.
+        stamp = now.strftime("%Y%m%dT%H%M%S") + f".{now.microsecond // 1000:03d}Z"
+        name = f"{BACKUP_PREFIX}{stamp}.zip"
+        path = os.path.join(BACKUP_DIR, name)
+        with tempfile.TemporaryDirectory(prefix="backup-", dir=BACKUP_DIR) as work_dir:
+            db_copy = os.path.join(work_dir, "database.db")
+            _copy_database(db_copy)
+            # Архив копируется после основной базы: заказ, перенесённый
+            # между двумя копиями, окажется в обеих, а не потеряется.
+            archive_copy = None
+            if os.path.exists(ARCHIVE_DB_PATH):
+                archive_copy = os.path.join(work_dir, "archive.db")
+                _copy_database(archive_copy, ARCHIVE_DB_PATH)
+            with menu_lock:
+                menu_bytes = json.dumps(menu, ensure_ascii=False, indent=2).encode("utf-8")
+            conn_copy = sqlite3.connect(db_copy)
+            try:
+                counts = _table_counts(conn_copy)
+            finally:
+                conn_copy.close()
+            manifest = {
+                "created_at": utc_now_iso(),
+                "reason": reason,
+                "bot_version": BOT_VERSION,
+                "tables": counts,
+                "menu_sha256": hashlib.sha256(menu_bytes).hexdigest(),
+            }
+            if archive_copy:
+                conn_copy = sqlite3.connect(archive_copy)
+                try:
+                    manifest["archive_tables"] = _table_counts(conn_copy)
+                finally:
+                    conn_copy.close()
+            temporary_path = os.path.join(work_dir, name)
+            with zipfile.ZipFile(temporary_path, "w", zipfile.ZIP_DEFLATED) as archive:
+                archive.write(db_copy, "database.db")
+                if archive_copy:
+                    archive.write(archive_copy, "archive.db")
+                archive.writestr("menu.json", menu_bytes)
+                archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+            os.replace(temporary_path, path)
+        try:
+            verify_backup(path)
+        except BackupError:
+            os.remove(path)
+            raise
+        removed = rotate_backups()
+    seconds = round(time.perf_counter() - started, 3)
+    observe_duration("backup_seconds", seconds)
+    return {
+        "name": name,
+        "bytes": os.path.getsize(path),
+        "seconds": seconds,
+        "rotated": len(removed),
+        "tables": counts,
+    }
+
+
+def create_backup_job() -> None:
+    try:
+        info = create_backup()
+    except Exception as exc:
+        print(f"[WARN] Backup failed: {type(exc).__name__}: {exc}", flush=True)
+        try:
+            bot.send_message(GROUP_CHAT_ID, f"⚠️ Backup failed: {type(exc).__name__}: {exc}")
+        except Exception:
+            pass
+        return
+    print(
+        f"[INFO] Backup {info['name']}: {_format_bytes(info['bytes'])}, "
+        f"{info['seconds']}s, rotated {info['rotated']}",
+        flush=True,
+    )
+
+
+def _keep_live_outbox(restored: sqlite3.Connection, live_path: str) -> int:
+    """
+    Переносит outbox живой базы в восстанавливаемую копию. Outbox — журнал
+    уже сделанных отправок, а не данные магазина: без этого всё отправленное
+    после снятия копии снова стало бы pending и ушло покупателям и в группу
+    повторно. Возвращает число перенесённых строк.
+    """
+    restored.execute("ATTACH DATABASE ? AS live", (live_path,))
+    try:
+        columns = ", ".join(
+            row[1] for row in restored.execute("PRAGMA live.table_info(outbox)")
+        )
+        with restored:
+            restored.execute("DELETE FROM main.outbox")
+            moved = restored.execute(
+                f"INSERT INTO main.outbox ({columns}) SELECT {columns} FROM live.outbox"
+            ).rowcount
+    finally:
+        restored.execute("DETACH DATABASE live")
+    return moved
+
+
+def restore_backup(name: str) -> dict:
+    """
+    Восстанавливает базу, archive.db и menu.json из архива. Перед этим
+    архив проходит verify_backup, а текущее состояние сохраняется отдельной
+    копией. Outbox остаётся живым (см. _keep_live_outbox). Кеши, построенные
+    по базе, сбрасываются и перестраиваются, реплика отчётов снимается заново.
+    Состояние покупателей в памяти (корзины, незавершённые оформления)
+    сбрасывается: оно относится к базе до восстановления. Возвращает
+    manifest, имя страховочной копии и число сброшенных сессий.
+    """
+    path = os.path.join(BACKUP_DIR, os.path.basename(name))
+    if not os.path.isfile(path):
+        raise BackupError(f"{name} not found")
+    manifest = verify_backup(path)
+    safety = create_backup(reason=f"before restore of {os.path.basename(name)}")
+    with tempfile.TemporaryDirectory(prefix="restore-") as work_dir:
+        with zipfile.ZipFile(path) as archive:
+            members = [
+                (member, live_path)
+                for member, live_path in (
+                    ("archive.db", ARCHIVE_DB_PATH),
+                    ("database.db", DB_PATH),
+                )
+                if member in archive.namelist()
+            ]
+            for member, _live_path in members:
+                archive.extract(member, work_dir)
+            restored_menu = json.loads(archive.read("menu.json"))
+        with ExitStack() as paused:
+            # От переноса outbox до подмены базы ни одна строка не должна
+            # стать отправленной (иначе вернётся pending и уйдёт повторно),
+            # а корзины из памяти — записаться в базу, которую сейчас заменят.
+            paused.enter_context(menu_lock)
+            for shard_lock in _outbox_shard_locks:
+                paused.enter_context(shard_lock)
+            paused.enter_context(_cart_store_lock)
+            for member, live_path in members:
+                source = sqlite3.connect(os.path.join(work_dir, member))
+                live = sqlite3.connect(live_path, check_same_thread=False)
+                try:
+                    if member == "database.db":
+                        _keep_live_outbox(source, live_path)
+                    # Копия целиком одним шагом: живая база меняется атомарно.
+                    source.backup(live)
+                finally:
+                    live.close()
+                    source.close()
+            menu.clear()
+            menu.update(restored_menu)
+            save_menu_safely()
+            reset_sessions = sum(
+                1
+                for data in list(user_data.values())
+                if data.get("cart")
+                or any(value for key, value in data.items() if key.startswith("wait_for_"))
+            )
+            user_data.clear()
+    # Копия могла быть снята старой версией со своей схемой архива.
+    ensure_archive_schema()
+    chat_languages.clear()
+    _referral_links.clear()
+    clear_render_cache()
+    rebuild_awaiting_proof_index()
+    try:
+        # Иначе /sold, /stats и /export до 15 минут показывали бы данные
+        # до восстановления.
+        refresh_analytics_replica()
+    except Exception as exc:
+        print(f"[WARN] Analytics replica refresh after restore failed: {exc}", flush=True)
+    print(f"[INFO] Restored {name} (safety copy {safety['name']})", flush=True)
+    return {"manifest": manifest, "safety": safety["name"], "reset_sessions": reset_sessions}
+
+
+def _backups_overview() -> str:
+    names = list_backups()
+    if not names:
+        return "No backups yet."
+    lines = [
+        f"{name} · {_format_bytes(os.path.getsize(os.path.join(BACKUP_DIR, name)))}"
+        for name in names
+    ]
+    return "Backups (newest first):\n" + "\n".join(lines)
+
+
+@bot.message_handler(commands=['backup'])
+def cmd_backup(message: types.Message):
+    if not is_owner(message.from_user.id):
+        return bot.reply_to(message, "❌ You do not have access to this command.")
+    try:
+        info = create_backup(reason="manual")
+    except Exception as exc:
+        return bot.reply_to(message, f"❌ Backup failed: {type(exc).__name__}: {exc}")
+    bot.reply_to(
+        message,
+        f"✅ {info['name']} · {_format_bytes(info['bytes'])} · {info['seconds']}s\n"
+        f"Orders: {info['tables'].get('orders', 0)} · Users: {info['tables'].get('users', 0)}",
+    )
+
+
+@bot.message_handler(commands=['restore'])
+def cmd_restore(message: types.Message):
+    if not is_owner(message.from_user.id):
+        return bot.reply_to(message, "❌ You do not have access to this command.")
+    if message.chat.id != GROUP_CHAT_ID:
+        return bot.reply_to(message, "❌ This command is available only in the admin group.")
+    parts = message.text.strip().split()
+    if len(parts) != 2:
+        return bot.reply_to(
+            message,
+            "Usage: /restore <backup name>\n\n" + _backups_overview(),
+        )
+    try:
+        result = restore_backup(parts[1])
+    except Exception as exc:
+        return bot.reply_to(message, f"❌ Restore failed: {type(exc).__name__}: {exc}")
+    bot.reply_to(
+        message,
+        f"✅ Restored {os.path.basename(parts[1])} "
+        f"(taken {result['manifest']['created_at'][:16]} UTC).\n"
+        f"Current state saved as {result['safety']}.\n"
+        f"Open carts and checkouts reset: {result['reset_sessions']}.",
+    )
+
+
+# 1) Определяем отдельный хендлер прямо рядом с /convert, /points и т.д.
+@ensure_user
+@bot.message_handler(commands=['stats'])
+def cmd_stats(message: types.Message):
+    user_id = message.from_user.id
+    if not is_owner(user_id):
+        return bot.reply_to(message, "У вас нет доступа.")
+
+    conn, as_of = get_analytics_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM orders")
+    cursor.execute("SELECT COUNT(*) FROM all_orders")
     total_orders = cursor.fetchone()[0]
-    cursor.execute("SELECT SUM(total) FROM orders")
+    cursor.execute("SELECT SUM(total) FROM all_orders")
     total_revenue = cursor.fetchone()[0] or 0
-    cursor.execute("SELECT items_json FROM orders")
+    cursor.execute("SELECT items_json FROM all_orders")
     all_items = cursor.fetchall()
     cursor.close()
     conn.close()
@@ -5875,7 +8600,8 @@ def cmd_stats(message: types.Message):
         f"Всего заказов: {total_orders}\n"
         f"Общая выручка: {total_revenue}₺\n\n"
         f"Топ-5 продаваемых вкусов:\n" +
-        "\n".join(lines)
+        "\n".join(lines) +
+        "\n\n" + data_as_of_line(as_of, "ru")
     )
     bot.send_message(message.chat.id, report)
 
@@ -5886,7 +8612,7 @@ def cmd_users(message):
     if not is_owner(message.from_user.id) or message.chat.type != "private":
         return bot.reply_to(message, "У вас нет доступа.")
 
-    conn = get_db_connection()
+    conn, as_of = get_analytics_connection()
     cur = conn.cursor()
 
     cur.execute(
@@ -5976,9 +8702,250 @@ def cmd_users(message):
             "или когда снова откроют бота.",
         ])
 
+    lines.extend(["", data_as_of_line(as_of, "ru")])
+
     bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
 
 
+# ─── Выгрузка данных (/export) ───
+# /export [orders|users|deliveries|promos|all] [csv|parquet] — архив с
+# таблицами владельцу в личку. Данные читаются из аналитической реплики
+# (вместе с archive.db) через pandas.read_sql порциями по EXPORT_CHUNK_ROWS
+# строк и дописываются в файл по мере чтения, так что память не растёт с
+# историей. pandas импортируется лениво; для Parquet нужен pyarrow.
+EXPORT_CHUNK_ROWS = 5000
+EXPORT_MAX_DOCUMENT_BYTES = 50 * 1024 * 1024
+EXPORT_FORMATS = ("csv", "parquet")
+
+
+@dataclass(frozen=True, slots=True)
+class ExportDataset:
+    file_stem: str
+    query: str
+    dtypes: MappingProxyType
+
+
+EXPORT_DATASETS = {
+    "orders": ExportDataset(
+        "order_items",
+        "SELECT order_id, chat_id, timestamp, total, points_spent, points_earned, "
+        "promo_code, promo_discount, delivery_currency, delivered_at, payment_status, "
+        "items_json FROM all_orders ORDER BY order_id",
+        MappingProxyType({
+            "order_id": "Int64", "chat_id": "Int64", "timestamp": "string",
+            "total": "Int64", "points_spent": "Int64", "points_earned": "Int64",
+            "promo_code": "string", "promo_discount": "Int64",
+            "delivery_currency": "string", "delivered_at": "string",
+            "payment_status": "string", "line_no": "Int64",
+            "category": "string", "flavor": "string", "price": "Float64",
+        }),
+    ),
+    "users": ExportDataset(
+        "users",
+        "SELECT chat_id, points, referral_code, referred_by, language, username, "
+        "first_name, last_name, last_address, last_contact, registered_at, "
+        "last_seen_at, is_active, inactive_reason, status_updated_at "
+        "FROM users ORDER BY chat_id",
+        MappingProxyType({
+            "chat_id": "Int64", "points": "Int64", "referral_code": "string",
+            "referred_by": "Int64", "language": "string", "username": "string",
+            "first_name": "string", "last_name": "string", "last_address": "string",
+            "last_contact": "string", "registered_at": "string",
+            "last_seen_at": "string", "is_active": "Int64",
+            "inactive_reason": "string", "status_updated_at": "string",
+        }),
+    ),
+    "deliveries": ExportDataset(
+        "delivered_log",
+        "SELECT id, order_id, currency, qty, timestamp FROM all_delivered_log ORDER BY id",
+        MappingProxyType({
+            "id": "Int64", "order_id": "Int64", "currency": "string",
+            "qty": "Int64", "timestamp": "string",
+        }),
+    ),
+    "promos": ExportDataset(
+        "promo_redemptions",
+        "SELECT r.promo_id, p.code, r.chat_id, r.order_id, r.discount_amount, "
+        "r.redeemed_at FROM promo_redemptions r "
+        "LEFT JOIN promo_codes p ON p.promo_id = r.promo_id ORDER BY r.redeemed_at",
+        MappingProxyType({
+            "promo_id": "Int64", "code": "string", "chat_id": "Int64",
+            "order_id": "Int64", "discount_amount": "Int64", "redeemed_at": "string",
+        }),
+    ),
+}
+_export_lock = threading.Lock()
+
+
+def _order_line_items(items_json) -> list[dict]:
+    items = parse_saved_cart(items_json)
+    if not items:
+        return [{}]
+    return [
+        {"line_no": line_no, "category": item["category"],
+         "flavor": item["flavor"], "price": item["price"]}
+        for line_no, item in enumerate(items, start=1)
+    ]
+
+
+def _expand_order_items(chunk, pd):
+    """Строка заказа → строка на каждую позицию (заказ без позиций — одна)."""
+    lines = chunk.pop("items_json").map(_order_line_items)
+    exploded = chunk.assign(_line=lines).explode("_line", ignore_index=True)
+    details = pd.DataFrame.from_records(exploded.pop("_line").tolist())
+    return pd.concat([exploded, details], axis=1)
+
+
+def export_dataset(conn, name: str, fmt: str, directory: str) -> tuple[str, int]:
+    """Пишет один набор в CSV/Parquet порциями; возвращает (путь, строк)."""
+    import pandas as pd
+
+    dataset = EXPORT_DATASETS[name]
+    path = os.path.join(directory, f"{dataset.file_stem}.{fmt}")
+    columns = list(dataset.dtypes)
+    rows = 0
+    writer = None
+    file_obj = open(path, "w", encoding="utf-8", newline="") if fmt == "csv" else None
+    try:
+        for chunk in pd.read_sql(dataset.query, conn, chunksize=EXPORT_CHUNK_ROWS):
+            if name == "orders":
+                chunk = _expand_order_items(chunk, pd)
+            # Явные типы: иначе колонка из одних NULL в первой порции даст
+            # другую схему Parquet, чем в следующих.
+            chunk = chunk.reindex(columns=columns).astype(dict(dataset.dtypes))
+            if fmt == "csv":
+                chunk.to_csv(file_obj, header=rows == 0, index=False)
+            else:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema, compression="zstd")
+                writer.write_table(table.cast(writer.schema))
+            rows += len(chunk)
+        if fmt == "csv" and rows == 0:
+            file_obj.write(",".join(columns) + "\n")
+    finally:
+        if file_obj is not None:
+            file_obj.close()
+        if writer is not None:
+            writer.close()
+    if fmt == "parquet" and writer is None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        empty = pd.DataFrame(columns=columns).astype(dict(dataset.dtypes))
+        pq.write_table(pa.Table.from_pandas(empty, preserve_index=False), path)
+    return path, rows
+
+
+def build_export_archive(names: list[str], fmt: str, directory: str) -> dict:
+    """Выгружает наборы из реплики и складывает их в один zip."""
+    started = time.perf_counter()
+    conn, as_of = get_analytics_connection()
+    counts = {}
+    try:
+        paths = []
+        for name in names:
+            path, counts[name] = export_dataset(conn, name, fmt, directory)
+            paths.append(path)
+    finally:
+        conn.close()
+    stamp = as_of.astimezone(pytz.timezone("Europe/Moscow")).strftime("%Y%m%d-%H%M%S")
+    archive_path = os.path.join(directory, f"vozol-export-{stamp}.zip")
+    # Parquet уже сжат внутри, CSV хорошо жмётся deflate.
+    compression = zipfile.ZIP_DEFLATED if fmt == "csv" else zipfile.ZIP_STORED
+    with zipfile.ZipFile(archive_path, "w", compression) as archive:
+        for path in paths:
+            archive.write(path, os.path.basename(path))
+            os.remove(path)
+    seconds = time.perf_counter() - started
+    observe_duration("export_seconds", seconds, format=fmt)
+    return {
+        "path": archive_path,
+        "rows": counts,
+        "as_of": as_of,
+        "seconds": round(seconds, 2),
+        "bytes": os.path.getsize(archive_path),
+    }
+
+
+def run_export(chat_id: int, names: list[str], fmt: str) -> None:
+    """Фоновая выгрузка: файл уходит документом, ошибки — сообщением."""
+    try:
+        with tempfile.TemporaryDirectory(prefix="export-") as work_dir:
+            result = build_export_archive(names, fmt, work_dir)
+            if result["bytes"] > EXPORT_MAX_DOCUMENT_BYTES:
+                bot.send_message(
+                    chat_id,
+                    f"❌ Архив {_format_bytes(result['bytes'])} — больше лимита Telegram. "
+                    "Выгрузите наборы по одному или в parquet.",
+                )
+                return
+            caption = (
+                "📤 " + ", ".join(
+                    f"{EXPORT_DATASETS[name].file_stem}: {rows}"
+                    for name, rows in result["rows"].items()
+                )
+                + f"\n⏱ {result['seconds']} с · {_format_bytes(result['bytes'])}\n"
+                + data_as_of_line(result["as_of"], "ru")
+            )
+            with open(result["path"], "rb") as document:
+                bot.send_document(
+                    chat_id,
+                    document,
+                    caption=caption,
+                    visible_file_name=os.path.basename(result["path"]),
+                )
+    except Exception as exc:
+        print(f"[WARN] Export failed: {type(exc).__name__}: {exc}", flush=True)
+        bot.send_message(chat_id, f"❌ Выгрузка не удалась: {type(exc).__name__}: {exc}")
+    finally:
+        _export_lock.release()
+
+
+@bot.message_handler(commands=['export'])
+def cmd_export(message: types.Message):
+    chat_id = message.chat.id
+    if not is_owner(message.from_user.id) or message.chat.type != "private":
+        return bot.reply_to(message, "У вас нет доступа.")
+
+    args = [arg.lower() for arg in (message.text or "").split()[1:]]
+    fmt = next((arg for arg in args if arg in EXPORT_FORMATS), "csv")
+    requested = [arg for arg in args if arg not in EXPORT_FORMATS]
+    unknown = [arg for arg in requested if arg not in EXPORT_DATASETS and arg != "all"]
+    if unknown:
+        return bot.reply_to(
+            message,
+            "Использование: /export [orders|users|deliveries|promos|all] [csv|parquet]\n"
+            f"Неизвестно: {html.escape(', '.join(unknown))}",
+        )
+    names = [name for name in EXPORT_DATASETS if not requested or "all" in requested or name in requested]
+
+    try:
+        import pandas  # noqa: F401
+        if fmt == "parquet":
+            import pyarrow  # noqa: F401
+    except ImportError as exc:
+        return bot.reply_to(message, f"❌ Выгрузка недоступна: не установлен {exc.name}.")
+
+    if not _export_lock.acquire(blocking=False):
+        return bot.reply_to(message, "⏳ Предыдущая выгрузка ещё не закончилась.")
+    # Замок отпускает run_export; пока поток не запущен — мы сами.
+    try:
+        bot.reply_to(message, f"⏳ Готовлю выгрузку ({', '.join(names)}, {fmt})…")
+        threading.Thread(
+            target=run_export,
+            args=(chat_id, names, fmt),
+            name="export",
+            daemon=True,
+        ).start()
+    except BaseException:
+        _export_lock.release()
+        raise
+
+
 @ensure_user
 @bot.message_handler(commands=['help'])
 def cmd_help(message: types.Message):
@@ -5991,6 +8958,10 @@ def cmd_help(message: types.Message):
           "/stock &lt;N&gt;  — Set overall delivered count & clear log\n"
           "/sold       — Today's deliveries report (MSK-based)\n"
           "/total      — Show stock levels for all flavors\n"
+          "/backup     — Back up the database and catalog now\n"
+          "/restore &lt;name&gt; — Restore a backup (lists backups without a name)\n"
+          "/export [orders|users|deliveries|promos|all] [csv|parquet] — Export data (private chat)\n"
+          "/profile &lt;N|Ns|off&gt; — Profile the next N updates or N seconds (private chat)\n"
           "/help       — This help message"
         )
         bot.send_message(message.chat.id, help_text, parse_mode="HTML")
@@ -6002,935 +8973,871 @@ def cmd_help(message: types.Message):
 # ------------------------------------------------------------------------
 #   35. Универсальный хендлер (всё остальное, включая /change логику)
 # ------------------------------------------------------------------------
-@ensure_user
-@bot.message_handler(content_types=['text', 'location', 'venue', 'contact'])
-def universal_handler(message):
-    chat_id = message.chat.id
-    text = message.text or ""
-    if chat_id not in user_data:
-        init_user(chat_id)
-    data = user_data[chat_id]
+# Фазы режима /change и шаги покупателя регистрируются в таблицах, поэтому
+# маршрутизация сообщения — один поиск по словарю, а не цепочка if.
+EDIT_PHASE_HANDLERS: dict = {}
+EDIT_MENU_ACTIONS: dict = {}
+CUSTOMER_STEP_HANDLERS: dict = {}
+# Язык → (версия переводов, «текст кнопки → шаг»); строится лениво.
+_customer_navigation_steps: dict[str, tuple[int, dict[str, str]]] = {}
 
-    # ─── Режим редактирования меню (/change) ────────────────────────────────────────
-    if data.get('edit_phase'):
-        if not is_owner(message.from_user.id):
-            data['edit_phase'] = None
-            user_data[chat_id] = data
-            bot.send_message(chat_id, "У вас нет доступа к админскому меню.")
-            return
 
-        phase = data['edit_phase']
-
-        # 1) Главное меню редактирования (всё на английском)
-        if phase == 'choose_action':
-            # Cancel
-            # ИСПРАВЛЁННЫЙ ВАРИАНТ
-
-            # Cancel
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                data['edit_cat'] = None
-                # 1) Сначала убираем любую reply-клавиатуру
-                bot.send_message(chat_id,
-                                 "Editing cancelled.",
-                                 reply_markup=types.ReplyKeyboardRemove())
-                # 2) Затем показываем inline-меню
-                bot.send_message(chat_id,
-                                 t(chat_id, "choose_category"),
-                                 reply_markup=get_inline_main_menu(chat_id))
-                user_data[chat_id] = data
-                return
+def edit_phase_handler(phase: str):
+    """Регистрирует обработчик фазы режима редактирования."""
+    def register(handler):
+        EDIT_PHASE_HANDLERS[phase] = handler
+        return handler
+    return register
 
-            # Back
-            if text == "⬅️ Back":
-                data['edit_phase'] = None
-                data['edit_cat'] = None
-                bot.send_message(chat_id,
-                                 "Returned to main menu.",
-                                 reply_markup=types.ReplyKeyboardRemove())
-                bot.send_message(chat_id,
-                                 t(chat_id, "choose_category"),
-                                 reply_markup=get_inline_main_menu(chat_id))
-                return
 
-            if text == "➕ Add Category":
-                data['edit_phase'] = 'add_category'
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Enter new category name:", reply_markup=kb)
-                user_data[chat_id] = data
-                return
+def edit_menu_action(label: str):
+    """Регистрирует кнопку главного меню редактирования."""
+    def register(handler):
+        EDIT_MENU_ACTIONS[label] = handler
+        return handler
+    return register
 
-            if text == "➖ Remove Category":
-                data['edit_phase'] = 'remove_category'
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                for cat_key in menu:
-                    kb.add(cat_key)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Select category to remove:", reply_markup=kb)
-                user_data[chat_id] = data
-                return
 
-            if text == "✏️ Rename Category":
-                data['edit_phase'] = 'rename_category_select'
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                for cat_key in menu:
-                    kb.add(cat_key)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Выберите категорию для переименования:", reply_markup=kb)
-                user_data[chat_id] = data
-                return
+def customer_step_handler(step: str):
+    """Регистрирует обработчик шага покупателя в fallback-хендлере."""
+    def register(handler):
+        CUSTOMER_STEP_HANDLERS[step] = handler
+        return handler
+    return register
 
-            if text == "💲 Fix Price":
-                data['edit_phase'] = 'choose_fix_price_cat'
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                for cat_key in menu:
-                    kb.add(cat_key)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Select category to fix price for:", reply_markup=kb)
-                user_data[chat_id] = data
-                return
 
-            if text == "📋 Full Flavor List":
-                data['edit_phase'] = 'choose_action'
-                data.pop('edit_cat', None)
-                user_data[chat_id] = data
-                full_flavor_models_screen(chat_id)
-                return
+def edit_back_keyboard() -> types.ReplyKeyboardMarkup:
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    kb.add("⬅️ Back", "❌ Cancel")
+    return kb
 
-            if text == "🔄 Actual Tastes":
-                actual_tastes_models_screen(chat_id)
-                return
 
-            if text == "🖼️ Add Category Picture":
-                data['edit_phase'] = 'choose_category_for_picture'
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                for cat_key in menu:
-                    kb.add(cat_key)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Select category to update picture for:", reply_markup=kb)
-                user_data[chat_id] = data
-                return
+def edit_category_keyboard() -> types.ReplyKeyboardMarkup:
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    for category in current_catalog().categories:
+        kb.add(category.name)
+    kb.add("⬅️ Back", "❌ Cancel")
+    return kb
 
-            if text == "PROMO CREATE":
-                data['edit_phase'] = 'promo_create_code'
-                clear_promo_creation_state(data)
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(
-                    chat_id,
-                    "Enter the promo code name (2–32 letters, numbers, - or _):",
-                    reply_markup=kb,
-                )
-                user_data[chat_id] = data
-                return
 
-            if text == "MESSAGE":
-                data['edit_phase'] = 'broadcast_message'
-                data.pop('broadcast_source_message_id', None)
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(
-                    chat_id,
-                    "Write the message that should be sent to all bot users:",
-                    reply_markup=kb,
-                )
-                user_data[chat_id] = data
-                return
+def promo_days_keyboard() -> types.ReplyKeyboardMarkup:
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    kb.add("1", "3", "7", "14", "30")
+    kb.add("⬅️ Back", "❌ Cancel")
+    return kb
 
-            bot.send_message(chat_id, "Choose action:", reply_markup=edit_action_keyboard())
-            return
 
-        # Создание промокода: код → лимит пользователей → скидка → 1–30 дней.
-        if phase == 'promo_create_code':
-            if text == "⬅️ Back":
-                data['edit_phase'] = 'choose_action'
-                clear_promo_creation_state(data)
-                bot.send_message(chat_id, "Back to editing menu:", reply_markup=edit_action_keyboard())
-                user_data[chat_id] = data
-                return
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                clear_promo_creation_state(data)
-                bot.send_message(chat_id, "Editing cancelled.", reply_markup=types.ReplyKeyboardRemove())
-                show_main_menu(chat_id)
-                user_data[chat_id] = data
-                return
+def back_to_edit_menu(chat_id: int, data: dict) -> None:
+    """Возвращает владельца в главное меню редактирования."""
+    data['edit_phase'] = 'choose_action'
+    bot.send_message(chat_id, "Back to editing menu:", reply_markup=edit_action_keyboard())
+    user_data[chat_id] = data
 
-            promo_code = normalize_promo_code(text)
-            if not is_valid_promo_code(promo_code):
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(
-                    chat_id,
-                    "Invalid code. Use 2–32 letters, numbers, - or _:",
-                    reply_markup=kb,
-                )
-                return
 
-            connection = get_db_connection()
-            cursor = connection.cursor()
-            cursor.execute(
-                "SELECT active, used_count, usage_limit, expires_at "
-                "FROM promo_codes WHERE code = ?",
-                (promo_code,),
-            )
-            existing = cursor.fetchone()
-            if existing and promo_is_expired(existing[3]) and int(existing[0]):
-                cursor.execute(
-                    "UPDATE promo_codes SET active = 0 WHERE code = ?",
-                    (promo_code,),
-                )
-                connection.commit()
-            cursor.close()
-            connection.close()
-            if (
-                existing
-                and int(existing[0])
-                and int(existing[1]) < int(existing[2])
-                and not promo_is_expired(existing[3])
-            ):
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(
-                    chat_id,
-                    "This promo code is already active. Enter another name:",
-                    reply_markup=kb,
-                )
-                return
+def cancel_edit_mode(chat_id: int, data: dict, notice: str = "Editing cancelled.") -> None:
+    """Выходит из режима /change и показывает обычное inline-меню."""
+    data['edit_phase'] = None
+    data['edit_cat'] = None
+    # 1) Сначала убираем любую reply-клавиатуру
+    bot.send_message(chat_id, notice, reply_markup=types.ReplyKeyboardRemove())
+    # 2) Затем показываем inline-меню
+    bot.send_message(chat_id, t(chat_id, "choose_category"), reply_markup=get_inline_main_menu(chat_id))
+    user_data[chat_id] = data
 
-            data['promo_create_code'] = promo_code
-            data['edit_phase'] = 'promo_create_limit'
-            kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-            kb.add("⬅️ Back", "❌ Cancel")
-            bot.send_message(
-                chat_id,
-                "How many different users may use this promo code? Enter a positive integer:",
-                reply_markup=kb,
-            )
-            user_data[chat_id] = data
-            return
 
-        if phase == 'promo_create_limit':
-            if text == "⬅️ Back":
-                data['edit_phase'] = 'promo_create_code'
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Enter the promo code name:", reply_markup=kb)
-                user_data[chat_id] = data
-                return
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                clear_promo_creation_state(data)
-                bot.send_message(chat_id, "Editing cancelled.", reply_markup=types.ReplyKeyboardRemove())
-                show_main_menu(chat_id)
-                user_data[chat_id] = data
-                return
-            if not text.isdigit() or int(text) <= 0:
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Enter a positive integer, for example 10:", reply_markup=kb)
-                return
+def cancel_promo_creation(chat_id: int, data: dict) -> None:
+    data['edit_phase'] = None
+    clear_promo_creation_state(data)
+    bot.send_message(chat_id, "Editing cancelled.", reply_markup=types.ReplyKeyboardRemove())
+    show_main_menu(chat_id)
+    user_data[chat_id] = data
 
-            data['promo_create_limit'] = int(text)
-            data['edit_phase'] = 'promo_create_discount'
-            kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-            kb.add("⬅️ Back", "❌ Cancel")
-            bot.send_message(
-                chat_id,
-                "Enter the fixed discount amount in TRY, for example 100:",
-                reply_markup=kb,
-            )
-            user_data[chat_id] = data
-            return
 
-        if phase == 'promo_create_discount':
-            if text == "⬅️ Back":
-                data['edit_phase'] = 'promo_create_limit'
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Enter the usage limit:", reply_markup=kb)
-                user_data[chat_id] = data
-                return
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                clear_promo_creation_state(data)
-                bot.send_message(chat_id, "Editing cancelled.", reply_markup=types.ReplyKeyboardRemove())
-                show_main_menu(chat_id)
-                user_data[chat_id] = data
-                return
-            if not text.isdigit() or int(text) <= 0:
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Enter a positive TRY amount, for example 100:", reply_markup=kb)
-                return
+# 1) Главное меню редактирования (всё на английском)
+@edit_phase_handler('choose_action')
+def edit_phase_choose_action(message, chat_id: int, text: str, data: dict) -> None:
+    action = EDIT_MENU_ACTIONS.get(text)
+    if action is None:
+        bot.send_message(chat_id, "Choose action:", reply_markup=edit_action_keyboard())
+        return
+    action(chat_id, data)
 
-            data['promo_create_discount'] = int(text)
-            data['edit_phase'] = 'promo_create_days'
-            kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-            kb.add("1", "3", "7", "14", "30")
-            kb.add("⬅️ Back", "❌ Cancel")
-            bot.send_message(
-                chat_id,
-                "How many days should the promo code remain valid? Enter a number from 1 to 30:",
-                reply_markup=kb,
-            )
-            user_data[chat_id] = data
-            return
 
-        if phase == 'promo_create_days':
-            if text == "⬅️ Back":
-                data['edit_phase'] = 'promo_create_discount'
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Enter the fixed discount amount in TRY:", reply_markup=kb)
-                user_data[chat_id] = data
-                return
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                clear_promo_creation_state(data)
-                bot.send_message(chat_id, "Editing cancelled.", reply_markup=types.ReplyKeyboardRemove())
-                show_main_menu(chat_id)
-                user_data[chat_id] = data
-                return
-            if not text.isdigit() or not 1 <= int(text) <= 30:
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("1", "3", "7", "14", "30")
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Enter a whole number from 1 to 30:", reply_markup=kb)
-                return
+@edit_menu_action("❌ Cancel")
+def edit_action_cancel(chat_id: int, data: dict) -> None:
+    cancel_edit_mode(chat_id, data)
 
-            promo_code = data.get('promo_create_code')
-            usage_limit = int(data.get('promo_create_limit', 0) or 0)
-            discount_amount = int(data.get('promo_create_discount', 0) or 0)
-            validity_days = int(text)
-            if not promo_code or usage_limit <= 0 or discount_amount <= 0:
-                data['edit_phase'] = 'promo_create_code'
-                clear_promo_creation_state(data)
-                bot.send_message(chat_id, "Promo data was lost. Enter the code again.")
-                user_data[chat_id] = data
-                return
 
-            created_at_dt = datetime.datetime.now(datetime.timezone.utc)
-            expires_at_dt = created_at_dt + datetime.timedelta(days=validity_days)
-            created_at = created_at_dt.isoformat()
-            expires_at = expires_at_dt.isoformat()
-            connection = get_db_connection()
-            cursor = connection.cursor()
+@edit_menu_action("⬅️ Back")
+def edit_action_back(chat_id: int, data: dict) -> None:
+    cancel_edit_mode(chat_id, data, "Returned to main menu.")
+
+
+@edit_menu_action("➕ Add Category")
+def edit_action_add_category(chat_id: int, data: dict) -> None:
+    data['edit_phase'] = 'add_category'
+    bot.send_message(chat_id, "Enter new category name:", reply_markup=edit_back_keyboard())
+    user_data[chat_id] = data
+
+
+@edit_menu_action("➖ Remove Category")
+def edit_action_remove_category(chat_id: int, data: dict) -> None:
+    data['edit_phase'] = 'remove_category'
+    bot.send_message(chat_id, "Select category to remove:", reply_markup=edit_category_keyboard())
+    user_data[chat_id] = data
+
+
+@edit_menu_action("✏️ Rename Category")
+def edit_action_rename_category(chat_id: int, data: dict) -> None:
+    data['edit_phase'] = 'rename_category_select'
+    bot.send_message(chat_id, "Выберите категорию для переименования:", reply_markup=edit_category_keyboard())
+    user_data[chat_id] = data
+
+
+@edit_menu_action("💲 Fix Price")
+def edit_action_fix_price(chat_id: int, data: dict) -> None:
+    data['edit_phase'] = 'choose_fix_price_cat'
+    bot.send_message(chat_id, "Select category to fix price for:", reply_markup=edit_category_keyboard())
+    user_data[chat_id] = data
+
+
+@edit_menu_action("📋 Full Flavor List")
+def edit_action_full_flavor_list(chat_id: int, data: dict) -> None:
+    data['edit_phase'] = 'choose_action'
+    data.pop('edit_cat', None)
+    user_data[chat_id] = data
+    full_flavor_models_screen(chat_id)
+
+
+@edit_menu_action("🔄 Actual Tastes")
+def edit_action_actual_tastes(chat_id: int, data: dict) -> None:
+    actual_tastes_models_screen(chat_id)
+
+
+@edit_menu_action("🖼️ Add Category Picture")
+def edit_action_category_picture(chat_id: int, data: dict) -> None:
+    data['edit_phase'] = 'choose_category_for_picture'
+    bot.send_message(chat_id, "Select category to update picture for:", reply_markup=edit_category_keyboard())
+    user_data[chat_id] = data
+
+
+@edit_menu_action("PROMO CREATE")
+def edit_action_promo_create(chat_id: int, data: dict) -> None:
+    data['edit_phase'] = 'promo_create_code'
+    clear_promo_creation_state(data)
+    bot.send_message(
+        chat_id,
+        "Enter the promo code name (2–32 letters, numbers, - or _):",
+        reply_markup=edit_back_keyboard(),
+    )
+    user_data[chat_id] = data
+
+
+@edit_menu_action("MESSAGE")
+def edit_action_broadcast(chat_id: int, data: dict) -> None:
+    data['edit_phase'] = 'broadcast_message'
+    data.pop('broadcast_source_message_id', None)
+    bot.send_message(
+        chat_id,
+        "Write the message that should be sent to all bot users:",
+        reply_markup=edit_back_keyboard(),
+    )
+    user_data[chat_id] = data
+
+
+# Создание промокода: код → лимит пользователей → скидка → 1–30 дней.
+@edit_phase_handler('promo_create_code')
+def edit_phase_promo_code(message, chat_id: int, text: str, data: dict) -> None:
+    if text == "⬅️ Back":
+        clear_promo_creation_state(data)
+        back_to_edit_menu(chat_id, data)
+        return
+    if text == "❌ Cancel":
+        cancel_promo_creation(chat_id, data)
+        return
+
+    promo_code = normalize_promo_code(text)
+    if not is_valid_promo_code(promo_code):
+        bot.send_message(
+            chat_id,
+            "Invalid code. Use 2–32 letters, numbers, - or _:",
+            reply_markup=edit_back_keyboard(),
+        )
+        return
+
+    connection = get_db_connection()
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT active, used_count, usage_limit, expires_at "
+        "FROM promo_codes WHERE code = ?",
+        (promo_code,),
+    )
+    existing = cursor.fetchone()
+    if existing and promo_is_expired(existing[3]) and int(existing[0]):
+        cursor.execute(
+            "UPDATE promo_codes SET active = 0 WHERE code = ?",
+            (promo_code,),
+        )
+        connection.commit()
+    cursor.close()
+    connection.close()
+    if (
+        existing
+        and int(existing[0])
+        and int(existing[1]) < int(existing[2])
+        and not promo_is_expired(existing[3])
+    ):
+        bot.send_message(
+            chat_id,
+            "This promo code is already active. Enter another name:",
+            reply_markup=edit_back_keyboard(),
+        )
+        return
+
+    data['promo_create_code'] = promo_code
+    data['edit_phase'] = 'promo_create_limit'
+    bot.send_message(
+        chat_id,
+        "How many different users may use this promo code? Enter a positive integer:",
+        reply_markup=edit_back_keyboard(),
+    )
+    user_data[chat_id] = data
+
+
+@edit_phase_handler('promo_create_limit')
+def edit_phase_promo_limit(message, chat_id: int, text: str, data: dict) -> None:
+    if text == "⬅️ Back":
+        data['edit_phase'] = 'promo_create_code'
+        bot.send_message(chat_id, "Enter the promo code name:", reply_markup=edit_back_keyboard())
+        user_data[chat_id] = data
+        return
+    if text == "❌ Cancel":
+        cancel_promo_creation(chat_id, data)
+        return
+    if not text.isdigit() or int(text) <= 0:
+        bot.send_message(chat_id, "Enter a positive integer, for example 10:", reply_markup=edit_back_keyboard())
+        return
+
+    data['promo_create_limit'] = int(text)
+    data['edit_phase'] = 'promo_create_discount'
+    bot.send_message(
+        chat_id,
+        "Enter the fixed discount amount in TRY, for example 100:",
+        reply_markup=edit_back_keyboard(),
+    )
+    user_data[chat_id] = data
+
+
+@edit_phase_handler('promo_create_discount')
+def edit_phase_promo_discount(message, chat_id: int, text: str, data: dict) -> None:
+    if text == "⬅️ Back":
+        data['edit_phase'] = 'promo_create_limit'
+        bot.send_message(chat_id, "Enter the usage limit:", reply_markup=edit_back_keyboard())
+        user_data[chat_id] = data
+        return
+    if text == "❌ Cancel":
+        cancel_promo_creation(chat_id, data)
+        return
+    if not text.isdigit() or int(text) <= 0:
+        bot.send_message(chat_id, "Enter a positive TRY amount, for example 100:", reply_markup=edit_back_keyboard())
+        return
+
+    data['promo_create_discount'] = int(text)
+    data['edit_phase'] = 'promo_create_days'
+    bot.send_message(
+        chat_id,
+        "How many days should the promo code remain valid? Enter a number from 1 to 30:",
+        reply_markup=promo_days_keyboard(),
+    )
+    user_data[chat_id] = data
+
+
+@edit_phase_handler('promo_create_days')
+def edit_phase_promo_days(message, chat_id: int, text: str, data: dict) -> None:
+    if text == "⬅️ Back":
+        data['edit_phase'] = 'promo_create_discount'
+        bot.send_message(chat_id, "Enter the fixed discount amount in TRY:", reply_markup=edit_back_keyboard())
+        user_data[chat_id] = data
+        return
+    if text == "❌ Cancel":
+        cancel_promo_creation(chat_id, data)
+        return
+    if not text.isdigit() or not 1 <= int(text) <= 30:
+        bot.send_message(chat_id, "Enter a whole number from 1 to 30:", reply_markup=promo_days_keyboard())
+        return
+
+    promo_code = data.get('promo_create_code')
+    usage_limit = int(data.get('promo_create_limit', 0) or 0)
+    discount_amount = int(data.get('promo_create_discount', 0) or 0)
+    validity_days = int(text)
+    if not promo_code or usage_limit <= 0 or discount_amount <= 0:
+        data['edit_phase'] = 'promo_create_code'
+        clear_promo_creation_state(data)
+        bot.send_message(chat_id, "Promo data was lost. Enter the code again.")
+        user_data[chat_id] = data
+        return
+
+    created_at_dt = datetime.datetime.now(datetime.timezone.utc)
+    expires_at_dt = created_at_dt + datetime.timedelta(days=validity_days)
+    created_at = created_at_dt.isoformat()
+    expires_at = expires_at_dt.isoformat()
+    connection = get_db_connection()
+    cursor = connection.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(
+            "SELECT promo_id, active, used_count, usage_limit, expires_at "
+            "FROM promo_codes WHERE code = ?",
+            (promo_code,),
+        )
+        existing = cursor.fetchone()
+        if (
+            existing
+            and int(existing[1])
+            and int(existing[2]) < int(existing[3])
+            and not promo_is_expired(existing[4], created_at_dt)
+        ):
+            raise PromoCodeError("promo_already_active")
+        if existing:
+            # История старой кампании остаётся в promo_redemptions по
+            # старому promo_id; новая кампания получает новый ID.
+            cursor.execute("DELETE FROM promo_codes WHERE promo_id = ?", (existing[0],))
+        cursor.execute(
+            "INSERT INTO promo_codes "
+            "(code, discount_amount, usage_limit, used_count, active, created_at, "
+            "validity_days, expires_at) "
+            "VALUES (?, ?, ?, 0, 1, ?, ?, ?)",
+            (
+                promo_code,
+                discount_amount,
+                usage_limit,
+                created_at,
+                validity_days,
+                expires_at,
+            ),
+        )
+        connection.commit()
+    except (PromoCodeError, sqlite3.IntegrityError):
+        connection.rollback()
+        data['edit_phase'] = 'promo_create_code'
+        clear_promo_creation_state(data)
+        bot.send_message(
+            chat_id,
+            "This promo code became active already. Enter another name.",
+            reply_markup=edit_back_keyboard(),
+        )
+        user_data[chat_id] = data
+        return
+    except sqlite3.Error as exc:
+        connection.rollback()
+        print(f"Promo creation failed for {promo_code}: {exc}", flush=True)
+        bot.send_message(
+            chat_id,
+            "Could not save the promo code. Please try the duration again.",
+            reply_markup=promo_days_keyboard(),
+        )
+        return
+    finally:
+        if connection:
             try:
-                cursor.execute("BEGIN IMMEDIATE")
-                cursor.execute(
-                    "SELECT promo_id, active, used_count, usage_limit, expires_at "
-                    "FROM promo_codes WHERE code = ?",
-                    (promo_code,),
-                )
-                existing = cursor.fetchone()
-                if (
-                    existing
-                    and int(existing[1])
-                    and int(existing[2]) < int(existing[3])
-                    and not promo_is_expired(existing[4], created_at_dt)
-                ):
-                    raise PromoCodeError("promo_already_active")
-                if existing:
-                    # История старой кампании остаётся в promo_redemptions по
-                    # старому promo_id; новая кампания получает новый ID.
-                    cursor.execute("DELETE FROM promo_codes WHERE promo_id = ?", (existing[0],))
-                cursor.execute(
-                    "INSERT INTO promo_codes "
-                    "(code, discount_amount, usage_limit, used_count, active, created_at, "
-                    "validity_days, expires_at) "
-                    "VALUES (?, ?, ?, 0, 1, ?, ?, ?)",
-                    (
-                        promo_code,
-                        discount_amount,
-                        usage_limit,
-                        created_at,
-                        validity_days,
-                        expires_at,
-                    ),
-                )
-                connection.commit()
-            except (PromoCodeError, sqlite3.IntegrityError):
-                connection.rollback()
-                data['edit_phase'] = 'promo_create_code'
-                clear_promo_creation_state(data)
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(
-                    chat_id,
-                    "This promo code became active already. Enter another name.",
-                    reply_markup=kb,
-                )
-                user_data[chat_id] = data
-                return
-            except sqlite3.Error as exc:
-                connection.rollback()
-                print(f"Promo creation failed for {promo_code}: {exc}", flush=True)
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("1", "3", "7", "14", "30")
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(
-                    chat_id,
-                    "Could not save the promo code. Please try the duration again.",
-                    reply_markup=kb,
-                )
-                return
-            finally:
-                if connection:
-                    try:
-                        cursor.close()
-                        connection.close()
-                    except Exception:
-                        pass
-
-            expires_local = expires_at_dt.astimezone(pytz.timezone("Europe/Istanbul"))
-            clear_promo_creation_state(data)
-            data['edit_phase'] = 'choose_action'
-            bot.send_message(
-                chat_id,
-                f"✅ Promo code {promo_code} created: {discount_amount}₺ discount, "
-                f"{usage_limit} different users, valid for {validity_days} days.\n"
-                f"Expires: {expires_local.strftime('%d.%m.%Y %H:%M')} (Türkiye time).",
-                reply_markup=edit_action_keyboard(),
-            )
-            user_data[chat_id] = data
-            return
+                cursor.close()
+                connection.close()
+            except Exception:
+                pass
 
-        # 1.1) Текст массовой рассылки
-        if phase == 'broadcast_message':
-            if text == "⬅️ Back":
-                data['edit_phase'] = 'choose_action'
-                bot.send_message(chat_id, "Back to editing menu:", reply_markup=edit_action_keyboard())
-                user_data[chat_id] = data
-                return
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                data.pop('broadcast_source_message_id', None)
-                bot.send_message(chat_id, "Editing cancelled.", reply_markup=types.ReplyKeyboardRemove())
-                bot.send_message(
-                    chat_id,
-                    t(chat_id, "choose_category"),
-                    reply_markup=get_inline_main_menu(chat_id),
-                )
-                user_data[chat_id] = data
-                return
-            if message.content_type != 'text' or not text.strip():
-                bot.send_message(chat_id, "Please send a non-empty text message.")
-                return
+    expires_local = expires_at_dt.astimezone(pytz.timezone("Europe/Istanbul"))
+    clear_promo_creation_state(data)
+    data['edit_phase'] = 'choose_action'
+    bot.send_message(
+        chat_id,
+        f"✅ Promo code {promo_code} created: {discount_amount}₺ discount, "
+        f"{usage_limit} different users, valid for {validity_days} days.\n"
+        f"Expires: {expires_local.strftime('%d.%m.%Y %H:%M')} (Türkiye time).",
+        reply_markup=edit_action_keyboard(),
+    )
+    user_data[chat_id] = data
 
-            data['broadcast_source_message_id'] = message.message_id
-            data['edit_phase'] = 'broadcast_confirm'
-            kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-            kb.add("✅ SEND TO ALL", "✏️ EDIT MESSAGE")
-            kb.add("⬅️ Back", "❌ Cancel")
-            bot.send_message(
-                chat_id,
-                f"Preview:\n\n{html.escape(text)}\n\nSend this message to every registered user?",
-                reply_markup=kb,
-            )
-            user_data[chat_id] = data
-            return
 
-        # 1.2) Подтверждение массовой рассылки
-        if phase == 'broadcast_confirm':
-            if text in ("⬅️ Back", "✏️ EDIT MESSAGE"):
-                data['edit_phase'] = 'broadcast_message'
-                data.pop('broadcast_source_message_id', None)
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Write the new message:", reply_markup=kb)
-                user_data[chat_id] = data
-                return
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                data.pop('broadcast_source_message_id', None)
-                bot.send_message(chat_id, "Editing cancelled.", reply_markup=types.ReplyKeyboardRemove())
-                bot.send_message(
-                    chat_id,
-                    t(chat_id, "choose_category"),
-                    reply_markup=get_inline_main_menu(chat_id),
-                )
-                user_data[chat_id] = data
-                return
-            if text != "✅ SEND TO ALL":
-                bot.send_message(chat_id, "Confirm the broadcast or edit the message.")
-                return
+# 1.1) Текст массовой рассылки
+@edit_phase_handler('broadcast_message')
+def edit_phase_broadcast_message(message, chat_id: int, text: str, data: dict) -> None:
+    if text == "⬅️ Back":
+        back_to_edit_menu(chat_id, data)
+        return
+    if text == "❌ Cancel":
+        data.pop('broadcast_source_message_id', None)
+        cancel_edit_mode(chat_id, data)
+        return
+    if message.content_type != 'text' or not text.strip():
+        bot.send_message(chat_id, "Please send a non-empty text message.")
+        return
 
-            source_message_id = data.get('broadcast_source_message_id')
-            if not source_message_id:
-                data['edit_phase'] = 'broadcast_message'
-                bot.send_message(chat_id, "Message was not saved. Please write it again.")
-                user_data[chat_id] = data
-                return
+    data['broadcast_source_message_id'] = message.message_id
+    data['edit_phase'] = 'broadcast_confirm'
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    kb.add("✅ SEND TO ALL", "✏️ EDIT MESSAGE")
+    kb.add("⬅️ Back", "❌ Cancel")
+    bot.send_message(
+        chat_id,
+        f"Preview:\n\n{html.escape(text)}\n\nSend this message to every registered user?",
+        reply_markup=kb,
+    )
+    user_data[chat_id] = data
 
-            bot.send_message(chat_id, "⏳ Sending broadcast...", reply_markup=types.ReplyKeyboardRemove())
-            sent, failed = broadcast_message_to_users(chat_id, source_message_id)
-            data.pop('broadcast_source_message_id', None)
-            data['edit_phase'] = 'choose_action'
-            bot.send_message(
-                chat_id,
-                f"✅ Broadcast finished. Sent: {sent}. Failed: {failed}.",
-                reply_markup=edit_action_keyboard(),
-            )
-            user_data[chat_id] = data
-            return
 
-        # 2) Добавить категорию
-        if phase == 'add_category':
-            #TODO
-            if text == "⬅️ Back":
-                data['edit_phase'] = 'choose_action'
-                bot.send_message(chat_id, "Back to editing menu:", reply_markup=edit_action_keyboard())
-                user_data[chat_id] = data
-                return
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                data['edit_cat'] = None
-                # 1) Убираем reply-клавиатуру
-                bot.send_message(chat_id,
-                                 "Editing cancelled.",
-                                 reply_markup=types.ReplyKeyboardRemove())
-                # 2) Показываем inline-меню
-                bot.send_message(chat_id,
-                                 t(chat_id, "choose_category"),
-                                 reply_markup=get_inline_main_menu(chat_id))
-                user_data[chat_id] = data
-                return
+# 1.2) Подтверждение массовой рассылки
+@edit_phase_handler('broadcast_confirm')
+def edit_phase_broadcast_confirm(message, chat_id: int, text: str, data: dict) -> None:
+    if text in ("⬅️ Back", "✏️ EDIT MESSAGE"):
+        data['edit_phase'] = 'broadcast_message'
+        data.pop('broadcast_source_message_id', None)
+        bot.send_message(chat_id, "Write the new message:", reply_markup=edit_back_keyboard())
+        user_data[chat_id] = data
+        return
+    if text == "❌ Cancel":
+        data.pop('broadcast_source_message_id', None)
+        cancel_edit_mode(chat_id, data)
+        return
+    if text != "✅ SEND TO ALL":
+        bot.send_message(chat_id, "Confirm the broadcast or edit the message.")
+        return
 
-            new_cat = text.strip()
-            if not new_cat or new_cat in menu:
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Invalid or existing name. Try again:", reply_markup=kb)
-                return
+    source_message_id = data.get('broadcast_source_message_id')
+    if not source_message_id:
+        data['edit_phase'] = 'broadcast_message'
+        bot.send_message(chat_id, "Message was not saved. Please write it again.")
+        user_data[chat_id] = data
+        return
 
-            with menu_lock:
-                menu[new_cat] = {
-                    "price": 1300,
-                    "flavors": [],
-                }
-                save_menu_safely()
+    bot.send_message(chat_id, "⏳ Sending broadcast...", reply_markup=types.ReplyKeyboardRemove())
+    sent, failed = broadcast_message_to_users(chat_id, source_message_id)
+    data.pop('broadcast_source_message_id', None)
+    data['edit_phase'] = 'choose_action'
+    bot.send_message(
+        chat_id,
+        f"✅ Broadcast finished. Sent: {sent}. Failed: {failed}.",
+        reply_markup=edit_action_keyboard(),
+    )
+    user_data[chat_id] = data
 
-            data['edit_phase'] = 'choose_action'
-            bot.send_message(chat_id, f"Category '{new_cat}' added.", reply_markup=edit_action_keyboard())
-            user_data[chat_id] = data
-            return
 
-        # 3) Выбор категории для загрузки картинки
-        if phase == 'choose_category_for_picture':
-            if text == "⬅️ Back":
-                data['edit_phase'] = 'choose_action'
-                bot.send_message(chat_id, "Back to editing menu:", reply_markup=edit_action_keyboard())
-                user_data[chat_id] = data
-                return
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                data['edit_cat'] = None
-                # 1) Убираем reply-клавиатуру
-                bot.send_message(chat_id,
-                                 "Editing cancelled.",
-                                 reply_markup=types.ReplyKeyboardRemove())
-                # 2) Показываем inline-меню
-                bot.send_message(chat_id,
-                                 t(chat_id, "choose_category"),
-                                 reply_markup=get_inline_main_menu(chat_id))
-                user_data[chat_id] = data
-                return
+# 2) Добавить категорию
+@edit_phase_handler('add_category')
+def edit_phase_add_category(message, chat_id: int, text: str, data: dict) -> None:
+    if text == "⬅️ Back":
+        back_to_edit_menu(chat_id, data)
+        return
+    if text == "❌ Cancel":
+        cancel_edit_mode(chat_id, data)
+        return
 
-            if text in menu:
-                data['edit_cat'] = text
-                data['edit_phase'] = 'enter_category_picture_url'
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Please send RAW URL for the new category picture:", reply_markup=kb)
-                user_data[chat_id] = data
-                return
-            else:
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Select a valid category from the list:", reply_markup=kb)
-                return
+    new_cat = text.strip()
+    with menu_lock:
+        added = bool(new_cat) and new_cat not in menu
+        if added:
+            journal = StockJournal()
+            journal.set_category(new_cat, {
+                "price": 1300,
+                "flavors": [],
+            })
+            journal.save()
+    if not added:
+        bot.send_message(chat_id, "Invalid or existing name. Try again:", reply_markup=edit_back_keyboard())
+        return
 
-        # 4) Ввод URL для картинки категории
-        if phase == 'enter_category_picture_url':
-            if text == "⬅️ Back":
-                data['edit_phase'] = 'choose_action'
-                bot.send_message(chat_id, "Back to editing menu:", reply_markup=edit_action_keyboard())
-                user_data[chat_id] = data
-                return
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                data['edit_cat'] = None
-                # 1) Убираем reply-клавиатуру
-                bot.send_message(chat_id,
-                                 "Editing cancelled.",
-                                 reply_markup=types.ReplyKeyboardRemove())
-                # 2) Показываем inline-меню
-                bot.send_message(chat_id,
-                                 t(chat_id, "choose_category"),
-                                 reply_markup=get_inline_main_menu(chat_id))
-                user_data[chat_id] = data
-                return
+    data['edit_phase'] = 'choose_action'
+    bot.send_message(chat_id, f"Category '{new_cat}' added.", reply_markup=edit_action_keyboard())
+    user_data[chat_id] = data
 
-            new_url = text.strip()
-            cat0 = data.get('edit_cat')
-            if cat0 and new_url:
-                if isinstance(menu.get(cat0), dict):
-                    menu[cat0]['photo_url'] = new_url
-                    save_menu_safely()
-                    bot.send_message(chat_id, f"Picture for category '{cat0}' updated.",
-                                     reply_markup=edit_action_keyboard())
-                else:
-                    bot.send_message(chat_id, "Error: category not found.", reply_markup=edit_action_keyboard())
-            else:
-                bot.send_message(chat_id, "Invalid URL. Try again or press Cancel.",
-                                 reply_markup=edit_action_keyboard())
 
-            data.pop('edit_cat', None)
-            data['edit_phase'] = 'choose_action'
-            user_data[chat_id] = data
-            return
+# 3) Выбор категории для загрузки картинки
+@edit_phase_handler('choose_category_for_picture')
+def edit_phase_picture_category(message, chat_id: int, text: str, data: dict) -> None:
+    if text == "⬅️ Back":
+        back_to_edit_menu(chat_id, data)
+        return
+    if text == "❌ Cancel":
+        cancel_edit_mode(chat_id, data)
+        return
 
+    if text not in current_catalog().by_name:
+        bot.send_message(chat_id, "Select a valid category from the list:", reply_markup=edit_back_keyboard())
+        return
+    data['edit_cat'] = text
+    data['edit_phase'] = 'enter_category_picture_url'
+    bot.send_message(chat_id, "Please send RAW URL for the new category picture:", reply_markup=edit_back_keyboard())
+    user_data[chat_id] = data
 
-        # 5) Удалить категорию
-        if phase == 'remove_category':
-            if text == "⬅️ Back":
-                data['edit_phase'] = 'choose_action'
-                bot.send_message(chat_id, "Back to editing menu:", reply_markup=edit_action_keyboard())
-                user_data[chat_id] = data
-                return
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                data['edit_cat'] = None
-                # 1) Убираем reply-клавиатуру
-                bot.send_message(chat_id,
-                                 "Editing cancelled.",
-                                 reply_markup=types.ReplyKeyboardRemove())
-                # 2) Показываем inline-меню
-                bot.send_message(chat_id,
-                                 t(chat_id, "choose_category"),
-                                 reply_markup=get_inline_main_menu(chat_id))
-                user_data[chat_id] = data
-                return
 
-            if text in menu:
-                del menu[text]
-                save_menu_safely()
-                data['edit_phase'] = 'choose_action'
-                bot.send_message(chat_id, f"Category '{text}' removed.", reply_markup=edit_action_keyboard())
-                user_data[chat_id] = data
-            else:
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Select a valid category.", reply_markup=kb)
-            return
+# 4) Ввод URL для картинки категории
+@edit_phase_handler('enter_category_picture_url')
+def edit_phase_picture_url(message, chat_id: int, text: str, data: dict) -> None:
+    if text == "⬅️ Back":
+        back_to_edit_menu(chat_id, data)
+        return
+    if text == "❌ Cancel":
+        cancel_edit_mode(chat_id, data)
+        return
 
-        # ——————————————————————————————————————————
-        if phase == 'rename_category_select':
-            if text == "⬅️ Back":
-                data['edit_phase'] = 'choose_action'
-                bot.send_message(chat_id, "Back to editing menu:", reply_markup=edit_action_keyboard())
-                user_data[chat_id] = data
-                return
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                bot.send_message(chat_id, "Editing cancelled.", reply_markup=types.ReplyKeyboardRemove())
-                bot.send_message(chat_id, t(chat_id, "choose_category"), reply_markup=get_inline_main_menu(chat_id))
-                user_data[chat_id] = data
-                return
-            if text in menu:
-                data['edit_cat'] = text
-                data['edit_phase'] = 'rename_category_enter'
-                bot.send_message(
-                    chat_id,
-                    f"Enter new name for category «{text}»:",
-                    reply_markup=types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                    .add("⬅️ Back", "❌ Cancel")
-                )
-                user_data[chat_id] = data
-                return
-            # Если ввели несуществующую категорию
-            bot.send_message(chat_id, "Select a valid category or press Cancel.")
-            return
-        # ——————————————————————————————————————————
-        if phase == 'rename_category_enter':
-            old_name = data.get('edit_cat')
-            if text == "⬅️ Back":
-                data['edit_phase'] = 'rename_category_select'
-                # показать список категорий заново
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                for cat_key in menu:
-                    kb.add(cat_key)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Select a category to rename:", reply_markup=kb)
-                user_data[chat_id] = data
-                return
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                bot.send_message(chat_id, "Editing cancelled.", reply_markup=types.ReplyKeyboardRemove())
-                bot.send_message(chat_id, t(chat_id, "choose_category"), reply_markup=get_inline_main_menu(chat_id))
-                user_data[chat_id] = data
-                return
-            new_name = text.strip()
-            if not new_name or new_name in menu:
-                bot.send_message(chat_id, "Invalid or already existing name. Try again:")
-                return
-            # Переименование
-            menu[new_name] = menu.pop(old_name)
-            save_menu_safely()
-            bot.send_message(chat_id, f"Category “{old_name}” renamed to “{new_name}”.",
+    new_url = text.strip()
+    cat0 = data.get('edit_cat')
+    if cat0 and new_url:
+        with menu_lock:
+            updated = isinstance(menu.get(cat0), dict)
+            if updated:
+                journal = StockJournal()
+                journal.set_field(menu[cat0], 'photo_url', new_url)
+                journal.save()
+        if updated:
+            bot.send_message(chat_id, f"Picture for category '{cat0}' updated.",
                              reply_markup=edit_action_keyboard())
-            data['edit_phase'] = 'choose_action'
-            data.pop('edit_cat', None)
-            user_data[chat_id] = data
-            return
+        else:
+            bot.send_message(chat_id, "Error: category not found.", reply_markup=edit_action_keyboard())
+    else:
+        bot.send_message(chat_id, "Invalid URL. Try again or press Cancel.",
+                         reply_markup=edit_action_keyboard())
 
-        # 7) Выбрать категорию для Fix Price
-        if phase == 'choose_fix_price_cat':
-            if text == "⬅️ Back":
-                data['edit_phase'] = 'choose_action'
-                bot.send_message(chat_id, "Back to editing menu:", reply_markup=edit_action_keyboard())
-                user_data[chat_id] = data
-                return
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                data['edit_cat'] = None
-                # 1) Убираем reply-клавиатуру
-                bot.send_message(chat_id,
-                                 "Editing cancelled.",
-                                 reply_markup=types.ReplyKeyboardRemove())
-                # 2) Показываем inline-меню
-                bot.send_message(chat_id,
-                                 t(chat_id, "choose_category"),
-                                 reply_markup=get_inline_main_menu(chat_id))
-                user_data[chat_id] = data
-                return
+    data.pop('edit_cat', None)
+    data['edit_phase'] = 'choose_action'
+    user_data[chat_id] = data
 
-            if text in menu:
-                data['edit_cat'] = text
-                data['edit_phase'] = 'enter_new_price'
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, f"Enter new price in ₺ for category '{text}':", reply_markup=kb)
-                user_data[chat_id] = data
-            else:
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Choose a category from the list.", reply_markup=kb)
-            return
 
-        # 8) Ввод новой цены для категории
-        if phase == 'enter_new_price':
-            if text == "⬅️ Back":
-                data['edit_phase'] = 'choose_action'
-                bot.send_message(chat_id, "Back to editing menu:", reply_markup=edit_action_keyboard())
-                user_data[chat_id] = data
-                return
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                data['edit_cat'] = None
-                # 1) Убираем reply-клавиатуру
-                bot.send_message(chat_id,
-                                 "Editing cancelled.",
-                                 reply_markup=types.ReplyKeyboardRemove())
-                # 2) Показываем inline-меню
-                bot.send_message(chat_id,
-                                 t(chat_id, "choose_category"),
-                                 reply_markup=get_inline_main_menu(chat_id))
-                user_data[chat_id] = data
-                return
+# 5) Удалить категорию
+@edit_phase_handler('remove_category')
+def edit_phase_remove_category(message, chat_id: int, text: str, data: dict) -> None:
+    if text == "⬅️ Back":
+        back_to_edit_menu(chat_id, data)
+        return
+    if text == "❌ Cancel":
+        cancel_edit_mode(chat_id, data)
+        return
 
-            cat0 = data.get('edit_cat')
-            try:
-                new_price = float(text.strip())
-            except:
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(chat_id, "Invalid price format. Enter a number, e.g. 1500:", reply_markup=kb)
-                return
+    with menu_lock:
+        removed = text in menu
+        if removed:
+            journal = StockJournal()
+            journal.set_category(text, None)
+            journal.save()
+    if not removed:
+        bot.send_message(chat_id, "Select a valid category.", reply_markup=edit_back_keyboard())
+        return
+    data['edit_phase'] = 'choose_action'
+    bot.send_message(chat_id, f"Category '{text}' removed.", reply_markup=edit_action_keyboard())
+    user_data[chat_id] = data
+
+
+# 6) Переименовать категорию: выбор → новое имя
+@edit_phase_handler('rename_category_select')
+def edit_phase_rename_select(message, chat_id: int, text: str, data: dict) -> None:
+    if text == "⬅️ Back":
+        back_to_edit_menu(chat_id, data)
+        return
+    if text == "❌ Cancel":
+        cancel_edit_mode(chat_id, data)
+        return
+    if text not in current_catalog().by_name:
+        # Если ввели несуществующую категорию
+        bot.send_message(chat_id, "Select a valid category or press Cancel.")
+        return
+    data['edit_cat'] = text
+    data['edit_phase'] = 'rename_category_enter'
+    bot.send_message(chat_id, f"Enter new name for category «{text}»:", reply_markup=edit_back_keyboard())
+    user_data[chat_id] = data
+
+
+@edit_phase_handler('rename_category_enter')
+def edit_phase_rename_enter(message, chat_id: int, text: str, data: dict) -> None:
+    old_name = data.get('edit_cat')
+    if text == "⬅️ Back":
+        # показать список категорий заново
+        data['edit_phase'] = 'rename_category_select'
+        bot.send_message(chat_id, "Select a category to rename:", reply_markup=edit_category_keyboard())
+        user_data[chat_id] = data
+        return
+    if text == "❌ Cancel":
+        cancel_edit_mode(chat_id, data)
+        return
+    new_name = text.strip()
+    with menu_lock:
+        renamed = bool(new_name) and new_name not in menu and old_name in menu
+        if renamed:
+            # Переименование
+            journal = StockJournal()
+            journal.set_category(new_name, menu[old_name])
+            journal.set_category(old_name, None)
+            journal.save()
+    if not renamed:
+        bot.send_message(chat_id, "Invalid or already existing name. Try again:")
+        return
+    bot.send_message(chat_id, f"Category “{old_name}” renamed to “{new_name}”.",
+                     reply_markup=edit_action_keyboard())
+    data['edit_phase'] = 'choose_action'
+    data.pop('edit_cat', None)
+    user_data[chat_id] = data
+
+
+# 7) Выбрать категорию для Fix Price
+@edit_phase_handler('choose_fix_price_cat')
+def edit_phase_fix_price_category(message, chat_id: int, text: str, data: dict) -> None:
+    if text == "⬅️ Back":
+        back_to_edit_menu(chat_id, data)
+        return
+    if text == "❌ Cancel":
+        cancel_edit_mode(chat_id, data)
+        return
+
+    if text not in current_catalog().by_name:
+        bot.send_message(chat_id, "Choose a category from the list.", reply_markup=edit_back_keyboard())
+        return
+    data['edit_cat'] = text
+    data['edit_phase'] = 'enter_new_price'
+    bot.send_message(chat_id, f"Enter new price in ₺ for category '{text}':", reply_markup=edit_back_keyboard())
+    user_data[chat_id] = data
+
+
+# 8) Ввод новой цены для категории
+@edit_phase_handler('enter_new_price')
+def edit_phase_new_price(message, chat_id: int, text: str, data: dict) -> None:
+    if text == "⬅️ Back":
+        back_to_edit_menu(chat_id, data)
+        return
+    if text == "❌ Cancel":
+        cancel_edit_mode(chat_id, data)
+        return
+
+    cat0 = data.get('edit_cat')
+    try:
+        new_price = float(text.strip())
+    except ValueError:
+        bot.send_message(chat_id, "Invalid price format. Enter a number, e.g. 1500:", reply_markup=edit_back_keyboard())
+        return
+
+    with menu_lock:
+        updated = isinstance(menu.get(cat0), dict)
+        if updated:
+            journal = StockJournal()
+            journal.set_field(menu[cat0], "price", int(new_price))
+            journal.save()
+    if not updated:
+        cancel_edit_mode(chat_id, data, "Error: category not found.")
+        return
+
+    bot.send_message(chat_id, f"Price for category '{cat0}' set to {int(new_price)}₺.",
+                     reply_markup=edit_action_keyboard())
+    data.pop('edit_cat', None)
+    data['edit_phase'] = 'choose_action'
+    user_data[chat_id] = data
+
+
+# Полный список одной выбранной модели: один вкус в строке.
+@edit_phase_handler('replace_category_flavor_list')
+def edit_phase_replace_flavor_list(message, chat_id: int, text: str, data: dict) -> None:
+    if text == "⬅️ Back":
+        data['edit_phase'] = 'choose_action'
+        data.pop('edit_cat', None)
+        bot.send_message(
+            chat_id,
+            "Select another model:",
+            reply_markup=types.ReplyKeyboardRemove(),
+        )
+        full_flavor_models_screen(chat_id)
+        user_data[chat_id] = data
+        return
+    if text == "❌ Cancel":
+        cancel_edit_mode(chat_id, data)
+        return
+
+    category = data.get('edit_cat')
+    if category not in current_catalog().by_name:
+        data['edit_phase'] = 'choose_action'
+        data.pop('edit_cat', None)
+        bot.send_message(
+            chat_id,
+            "This model no longer exists. Select a model again:",
+            reply_markup=types.ReplyKeyboardRemove(),
+        )
+        full_flavor_models_screen(chat_id)
+        user_data[chat_id] = data
+        return
+
+    flavor_names = parse_full_flavor_names(text)
+    if not flavor_names:
+        bot.send_message(
+            chat_id,
+            "No valid flavors found. Send one flavor per line.",
+            reply_markup=edit_back_keyboard(),
+        )
+        return
+
+    journal = StockJournal()
+    try:
+        with menu_lock:
+            existing_items = {
+                str(item.get("flavor", "")).strip().casefold(): item
+                for item in menu[category].get("flavors", [])
+                if str(item.get("flavor", "")).strip()
+            }
+            previous_keys = set(existing_items)
+            new_keys = {name.casefold() for name in flavor_names}
+            synchronized = []
+            for flavor_name in flavor_names:
+                existing = existing_items.get(flavor_name.casefold())
+                if existing is None:
+                    flavor_item = blank_flavor_item(flavor_name)
+                else:
+                    flavor_item = dict(existing)
+                    flavor_item["flavor"] = flavor_name
+                    try:
+                        flavor_item["stock"] = max(
+                            int(flavor_item.get("stock", 0) or 0),
+                            0,
+                        )
+                    except (TypeError, ValueError):
+                        flavor_item["stock"] = 0
+                synchronized.append(flavor_item)
+            # Старый список остаётся в журнале целиком: synchronized собран
+            # из копий позиций, поэтому откат — это возврат одной ссылки.
+            journal.set_field(menu[category], "flavors", synchronized)
+            journal.save()
+            preserved_count = len(previous_keys & new_keys)
+            new_count = len(new_keys - previous_keys)
+            removed_count = len(previous_keys - new_keys)
+    except Exception as exc:
+        journal.rollback(f"Full flavor list for {category}")
+        print(f"Full flavor list save failed for {category}: {exc}", flush=True)
+        bot.send_message(
+            chat_id,
+            "Could not save the full flavor list. Please send it again.",
+            reply_markup=edit_back_keyboard(),
+        )
+        return
+
+    data['edit_phase'] = 'choose_action'
+    data.pop('edit_cat', None)
+    user_data[chat_id] = data
+    bot.send_message(
+        chat_id,
+        f"✅ Full flavor list saved for {html.escape(category)}.\n"
+        f"Total: {len(flavor_names)} · Preserved: {preserved_count} · "
+        f"New with stock 0: {new_count} · Removed: {removed_count}",
+        reply_markup=edit_action_keyboard(),
+    )
+
+
+def edit_phase_unknown(message, chat_id: int, text: str, data: dict) -> None:
+    # Если ни одна фаза не совпала, возвращаем пользователя в меню редактирования
+    back_to_edit_menu(chat_id, data)
+
+
+def reset_checkout_waits(data: dict) -> None:
+    data.update({
+        "wait_for_points": False,
+        "wait_for_address": False,
+        "wait_for_contact": False,
+        "wait_for_comment": False,
+        "wait_for_promo": False,
+        "wait_for_search": False,
+        "pending_discount": 0,
+        "pending_points_spent": 0,
+    })
+    clear_promo_state(data)
+
+
+def customer_step_for_text(chat_id: int, text: str) -> str:
+    """Определяет шаг покупателя по тексту reply-кнопки навигации."""
+    # Тот же источник языка, что у t()/tr(), которыми подписаны кнопки.
+    lang = chat_language(chat_id)
+    version, steps = _customer_navigation_steps.get(lang, (None, None))
+    if steps is None or version != _TRANSLATIONS_VERSION:
+        version = _TRANSLATIONS_VERSION
+        steps = {
+            nav_text(chat_id, destination): "menu"
+            for destination in ("address", "contact", "points", "review", "menu")
+        }
+        steps[t(chat_id, "back")] = "menu"
+        steps[nav_text(chat_id, "cart")] = "cart"
+        _customer_navigation_steps[lang] = (version, steps)
+    return steps.get(text, "default")
+
+
+# Пользовательский интерфейс работает через inline-кнопки и отдельные
+# state-handlers выше. Этот fallback не дублирует checkout и не может
+# случайно создать второй заказ.
+@customer_step_handler("cart")
+def customer_step_cart(message, chat_id: int, text: str, data: dict) -> None:
+    reset_checkout_waits(data)
+    bot.send_message(
+        chat_id,
+        tr(chat_id, "Возвращаемся в корзину.", "Back to your cart."),
+        reply_markup=types.ReplyKeyboardRemove(),
+    )
+    send_cart(chat_id)
+
+
+@customer_step_handler("menu")
+def customer_step_menu(message, chat_id: int, text: str, data: dict) -> None:
+    data["current_category"] = None
+    reset_checkout_waits(data)
+    bot.send_message(
+        chat_id,
+        tr(chat_id, "Возвращаемся в меню.", "Back to the menu."),
+        reply_markup=types.ReplyKeyboardRemove(),
+    )
+    show_main_menu(chat_id)
 
-            menu[cat0]["price"] = int(new_price)
-            save_menu_safely()
 
-            bot.send_message(chat_id, f"Price for category '{cat0}' set to {int(new_price)}₺.",
-                             reply_markup=edit_action_keyboard())
-            data.pop('edit_cat', None)
-            data['edit_phase'] = 'choose_action'
-            user_data[chat_id] = data
-            return
+@customer_step_handler("search")
+def customer_step_search(message, chat_id: int, text: str, data: dict) -> None:
+    if not text.strip():
+        show_search_prompt(chat_id)
+        return
+    show_search_results(chat_id, text)
 
-        # Полный список одной выбранной модели: один вкус в строке.
-        if phase == 'replace_category_flavor_list':
-            if text == "⬅️ Back":
-                data['edit_phase'] = 'choose_action'
-                data.pop('edit_cat', None)
-                bot.send_message(
-                    chat_id,
-                    "Select another model:",
-                    reply_markup=types.ReplyKeyboardRemove(),
-                )
-                full_flavor_models_screen(chat_id)
-                user_data[chat_id] = data
-                return
-            if text == "❌ Cancel":
-                data['edit_phase'] = None
-                data.pop('edit_cat', None)
-                bot.send_message(chat_id,
-                                 "Editing cancelled.",
-                                 reply_markup=types.ReplyKeyboardRemove())
-                bot.send_message(chat_id,
-                                 t(chat_id, "choose_category"),
-                                 reply_markup=get_inline_main_menu(chat_id))
-                user_data[chat_id] = data
-                return
 
-            category = data.get('edit_cat')
-            if category not in menu:
-                data['edit_phase'] = 'choose_action'
-                data.pop('edit_cat', None)
-                bot.send_message(
-                    chat_id,
-                    "This model no longer exists. Select a model again:",
-                    reply_markup=types.ReplyKeyboardRemove(),
-                )
-                full_flavor_models_screen(chat_id)
-                user_data[chat_id] = data
-                return
+@customer_step_handler("default")
+def customer_step_default(message, chat_id: int, text: str, data: dict) -> None:
+    show_main_menu(chat_id)
 
-            flavor_names = parse_full_flavor_names(text)
-            if not flavor_names:
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(
-                    chat_id,
-                    "No valid flavors found. Send one flavor per line.",
-                    reply_markup=kb,
-                )
-                return
 
-            category_snapshot = json.loads(json.dumps(menu[category], ensure_ascii=False))
-            try:
-                with menu_lock:
-                    existing_items = {
-                        str(item.get("flavor", "")).strip().casefold(): item
-                        for item in menu[category].get("flavors", [])
-                        if str(item.get("flavor", "")).strip()
-                    }
-                    previous_keys = set(existing_items)
-                    new_keys = {name.casefold() for name in flavor_names}
-                    synchronized = []
-                    for flavor_name in flavor_names:
-                        existing = existing_items.get(flavor_name.casefold())
-                        if existing is None:
-                            flavor_item = blank_flavor_item(flavor_name)
-                        else:
-                            flavor_item = dict(existing)
-                            flavor_item["flavor"] = flavor_name
-                            try:
-                                flavor_item["stock"] = max(
-                                    int(flavor_item.get("stock", 0) or 0),
-                                    0,
-                                )
-                            except (TypeError, ValueError):
-                                flavor_item["stock"] = 0
-                        synchronized.append(flavor_item)
-                    menu[category]["flavors"] = synchronized
-                    save_menu_safely()
-                    preserved_count = len(previous_keys & new_keys)
-                    new_count = len(new_keys - previous_keys)
-                    removed_count = len(previous_keys - new_keys)
-            except Exception as exc:
-                with menu_lock:
-                    menu[category] = category_snapshot
-                    try:
-                        save_menu_safely()
-                    except Exception as restore_exc:
-                        print(
-                            f"Full flavor list restore failed for {category}: {restore_exc}",
-                            flush=True,
-                        )
-                print(f"Full flavor list save failed for {category}: {exc}", flush=True)
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-                kb.add("⬅️ Back", "❌ Cancel")
-                bot.send_message(
-                    chat_id,
-                    "Could not save the full flavor list. Please send it again.",
-                    reply_markup=kb,
-                )
-                return
+@ensure_user
+@bot.message_handler(content_types=['text', 'location', 'venue', 'contact'])
+def universal_handler(message):
+    chat_id = message.chat.id
+    text = message.text or ""
+    if chat_id not in user_data:
+        init_user(chat_id)
+    data = user_data[chat_id]
 
-            data['edit_phase'] = 'choose_action'
-            data.pop('edit_cat', None)
+    # ─── Режим редактирования меню (/change) ────────────────────────────────────────
+    phase = data.get('edit_phase')
+    if phase:
+        if not is_owner(message.from_user.id):
+            data['edit_phase'] = None
             user_data[chat_id] = data
-            bot.send_message(
-                chat_id,
-                f"✅ Full flavor list saved for {html.escape(category)}.\n"
-                f"Total: {len(flavor_names)} · Preserved: {preserved_count} · "
-                f"New with stock 0: {new_count} · Removed: {removed_count}",
-                reply_markup=edit_action_keyboard(),
-            )
+            bot.send_message(chat_id, "У вас нет доступа к админскому меню.")
             return
 
-        # Если ни одна фаза не совпала, возвращаем пользователя в меню редактирования
-        data['edit_phase'] = 'choose_action'
-        bot.send_message(chat_id, "Back to editing menu:", reply_markup=edit_action_keyboard())
-        user_data[chat_id] = data
-        return
-    # ────────────────────────────────────────────────────────────────────────────────
-
-    # Пользовательский интерфейс работает через inline-кнопки и отдельные
-    # state-handlers выше. Этот fallback не дублирует checkout и не может
-    # случайно создать второй заказ.
-    known_navigation = {
-        nav_text(chat_id, "cart"),
-        nav_text(chat_id, "address"),
-        nav_text(chat_id, "contact"),
-        nav_text(chat_id, "points"),
-        nav_text(chat_id, "review"),
-        nav_text(chat_id, "menu"),
-        t(chat_id, "back"),
-    }
-    if text == nav_text(chat_id, "cart"):
-        data.update({
-            "wait_for_points": False,
-            "wait_for_address": False,
-            "wait_for_contact": False,
-            "wait_for_comment": False,
-            "wait_for_promo": False,
-            "pending_discount": 0,
-            "pending_points_spent": 0,
-        })
-        clear_promo_state(data)
-        bot.send_message(
-            chat_id,
-            tr(chat_id, "Возвращаемся в корзину.", "Back to your cart."),
-            reply_markup=types.ReplyKeyboardRemove(),
-        )
-        send_cart(chat_id)
-        return
-
-    if text in known_navigation:
-        data.update({
-            "current_category": None,
-            "wait_for_points": False,
-            "wait_for_address": False,
-            "wait_for_contact": False,
-            "wait_for_comment": False,
-            "wait_for_promo": False,
-            "pending_discount": 0,
-            "pending_points_spent": 0,
-        })
-        clear_promo_state(data)
-        bot.send_message(
-            chat_id,
-            tr(chat_id, "Возвращаемся в меню.", "Back to the menu."),
-            reply_markup=types.ReplyKeyboardRemove(),
-        )
-        show_main_menu(chat_id)
+        handler = EDIT_PHASE_HANDLERS.get(phase, edit_phase_unknown)
+        started = time.perf_counter()
+        try:
+            handler(message, chat_id, text, data)
+        finally:
+            observe_duration(
+                "edit_phase_transition_seconds",
+                time.perf_counter() - started,
+                phase=phase,
+                next_phase=data.get('edit_phase') or "none",
+            )
         return
 
-    show_main_menu(chat_id)
+    step = customer_step_for_text(chat_id, text)
+    if step == "default" and data.get("wait_for_search"):
+        step = "search"
+    started = time.perf_counter()
+    try:
+        CUSTOMER_STEP_HANDLERS[step](message, chat_id, text, data)
+    finally:
+        observe_duration("customer_step_seconds", time.perf_counter() - started, step=step)
 
 @ensure_user
 @bot.callback_query_handler(func=lambda call: call.data == "no_points")
@@ -6952,157 +9859,160 @@ def callback_no_points(call):
 
 
 
-@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("cancel_order|"))
-def handle_cancel_order(call):
-    user_id = call.from_user.id
-    if not is_owner(user_id):
-        return bot.answer_callback_query(call.id, "Нет доступа", show_alert=True)
+def reject_order_card_callback(call) -> bool:
+    """Кнопки карточки заказа доступны только владельцу в админ-группе."""
+    if not is_owner(call.from_user.id):
+        bot.answer_callback_query(call.id, "Нет доступа", show_alert=True)
+        return True
     if call.message.chat.id != GROUP_CHAT_ID:
-        return bot.answer_callback_query(
+        bot.answer_callback_query(
             call.id,
             "Кнопка доступна только в админ-группе",
             show_alert=True,
         )
+        return True
+    return False
 
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("cancel_order|"))
+@early_callback_ack("⏳ Отменяем заказ…", guard=reject_order_card_callback)
+def handle_cancel_order(call):
     try:
         order_id = int(call.data.split("|", 2)[1])
     except (ValueError, IndexError):
-        return bot.answer_callback_query(call.id, "Data error", show_alert=True)
+        return answer_callback(call, "Data error", show_alert=True)
 
     conn = None
-    menu_snapshot = None
+    stock_journal = StockJournal()
     stock_warnings = []
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("BEGIN IMMEDIATE")
-        cursor.execute(
-            "SELECT chat_id, items_json, points_spent, points_earned "
-            "FROM orders WHERE order_id = ?",
-            (order_id,),
-        )
-        row = cursor.fetchone()
-        if not row:
-            conn.rollback()
-            return bot.answer_callback_query(
-                call.id,
-                "Заказ уже отменён или не найден",
-                show_alert=True,
-            )
-
-        user_chat_id, items_json, pts_spent, pts_earned = row
-        items = json.loads(items_json or "[]")
-        if not isinstance(items, list):
-            raise ValueError("items_json is not a list")
-
-        cursor.execute(
-            "SELECT promo_id FROM promo_redemptions WHERE order_id = ?",
-            (order_id,),
-        )
-        promo_redemption = cursor.fetchone()
-        promo_restored = False
-        pts_spent = int(pts_spent or 0)
-        pts_earned = int(pts_earned or 0)
-
-        # Снимок позволяет вернуть каталог в исходное состояние при любой ошибке.
-        menu_snapshot = json.loads(json.dumps(menu, ensure_ascii=False))
-        for item in items:
-            if not isinstance(item, dict):
-                stock_warnings.append("некорректная позиция")
-                continue
-            category = item.get("category")
-            flavor = item.get("flavor")
-            category_data = menu.get(category)
-            if not category_data or not isinstance(category_data.get("flavors"), list):
-                stock_warnings.append(f"категория {category!r} не найдена")
-                continue
-            if not flavor:
-                stock_warnings.append(f"в позиции {category!r} нет вкуса")
-                continue
-            try:
-                quantity = max(int(item.get("quantity", item.get("qty", 1)) or 1), 1)
-            except (TypeError, ValueError):
-                quantity = 1
-
-            found_item = next(
-                (
-                    menu_item
-                    for menu_item in category_data["flavors"]
-                    if menu_item.get("flavor") == flavor
-                ),
-                None,
-            )
-            if found_item is not None:
-                found_item["stock"] = int(found_item.get("stock", 0) or 0) + quantity
-            else:
-                category_data["flavors"].append({
-                    "flavor": flavor,
-                    "stock": quantity,
-                    "emoji": item.get("emoji", ""),
-                    "tags": [],
-                    "description_ru": "",
-                    "description_en": "",
-                    "photo_url": "",
-                })
-
-        save_menu_safely()
-
-        if pts_spent:
-            cursor.execute(
-                "UPDATE users SET points = points + ? WHERE chat_id = ?",
-                (pts_spent, user_chat_id),
-            )
-        if pts_earned:
+        # Склад блокируется до BEGIN IMMEDIATE — в том же порядке, что и в
+        # finalize_order, иначе две транзакции могут ждать друг друга.
+        with menu_lock:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
             cursor.execute(
-                "UPDATE users SET points = points - ? WHERE chat_id = ?",
-                (pts_earned, user_chat_id),
+                "SELECT chat_id, items_json, points_spent, points_earned "
+                "FROM orders WHERE order_id = ?",
+                (order_id,),
             )
+            row = cursor.fetchone()
+            if not row:
+                conn.rollback()
+                return answer_callback(
+                    call,
+                    "Заказ уже отменён или не найден",
+                    show_alert=True,
+                )
+
+            user_chat_id, items_json, pts_spent, pts_earned = row
+            items = json.loads(items_json or "[]")
+            if not isinstance(items, list):
+                raise ValueError("items_json is not a list")
 
-        if promo_redemption:
-            promo_id = int(promo_redemption[0])
             cursor.execute(
-                "DELETE FROM promo_redemptions WHERE order_id = ?",
+                "SELECT promo_id FROM promo_redemptions WHERE order_id = ?",
                 (order_id,),
             )
-            cursor.execute(
-                "UPDATE promo_codes "
-                "SET used_count = CASE WHEN used_count > 0 THEN used_count - 1 ELSE 0 END, "
-                "active = CASE "
-                "WHEN expires_at IS NOT NULL AND expires_at <= ? THEN 0 "
-                "WHEN (CASE WHEN used_count > 0 THEN used_count - 1 ELSE 0 END) >= usage_limit THEN 0 "
-                "ELSE 1 END "
-                "WHERE promo_id = ?",
-                (utc_now_iso(), promo_id),
-            )
-            promo_restored = cursor.rowcount == 1
+            promo_redemption = cursor.fetchone()
+            promo_restored = False
+            pts_spent = int(pts_spent or 0)
+            pts_earned = int(pts_earned or 0)
 
-        cursor.execute("DELETE FROM orders WHERE order_id = ?", (order_id,))
-        if cursor.rowcount != 1:
-            raise RuntimeError("order deletion did not affect exactly one row")
-        conn.commit()
+            for item in items:
+                if not isinstance(item, dict):
+                    stock_warnings.append("некорректная позиция")
+                    continue
+                category = item.get("category")
+                flavor = item.get("flavor")
+                category_data = menu.get(category)
+                if not category_data or not isinstance(category_data.get("flavors"), list):
+                    stock_warnings.append(f"категория {category!r} не найдена")
+                    continue
+                if not flavor:
+                    stock_warnings.append(f"в позиции {category!r} нет вкуса")
+                    continue
+                try:
+                    quantity = max(int(item.get("quantity", item.get("qty", 1)) or 1), 1)
+                except (TypeError, ValueError):
+                    quantity = 1
+
+                found_item = next(
+                    (
+                        menu_item
+                        for menu_item in category_data["flavors"]
+                        if menu_item.get("flavor") == flavor
+                    ),
+                    None,
+                )
+                if found_item is not None:
+                    stock_journal.set_stock(
+                        found_item,
+                        int(found_item.get("stock", 0) or 0) + quantity,
+                    )
+                else:
+                    stock_journal.append_flavor(category_data["flavors"], {
+                        "flavor": flavor,
+                        "stock": quantity,
+                        "emoji": item.get("emoji", ""),
+                        "tags": [],
+                        "description_ru": "",
+                        "description_en": "",
+                        "photo_url": "",
+                    })
+
+            stock_journal.save()
+
+            if pts_spent:
+                cursor.execute(
+                    "UPDATE users SET points = points + ? WHERE chat_id = ?",
+                    (pts_spent, user_chat_id),
+                )
+            if pts_earned:
+                cursor.execute(
+                    "UPDATE users SET points = points - ? WHERE chat_id = ?",
+                    (pts_earned, user_chat_id),
+                )
+
+            if promo_redemption:
+                promo_id = int(promo_redemption[0])
+                cursor.execute(
+                    "DELETE FROM promo_redemptions WHERE order_id = ?",
+                    (order_id,),
+                )
+                cursor.execute(
+                    "UPDATE promo_codes "
+                    "SET used_count = CASE WHEN used_count > 0 THEN used_count - 1 ELSE 0 END, "
+                    "active = CASE "
+                    "WHEN expires_at IS NOT NULL AND expires_at <= ? THEN 0 "
+                    "WHEN (CASE WHEN used_count > 0 THEN used_count - 1 ELSE 0 END) >= usage_limit THEN 0 "
+                    "ELSE 1 END "
+                    "WHERE promo_id = ?",
+                    (utc_now_iso(), promo_id),
+                )
+                promo_restored = cursor.rowcount == 1
+
+            cursor.execute("DELETE FROM orders WHERE order_id = ?", (order_id,))
+            if cursor.rowcount != 1:
+                raise RuntimeError("order deletion did not affect exactly one row")
+            conn.commit()
+            stock_journal.commit()
+        increment_counter("orders_total", outcome="cancelled")
     except Exception as exc:
         if conn is not None:
             try:
                 conn.rollback()
             except Exception:
                 pass
-        if menu_snapshot is not None:
-            menu.clear()
-            menu.update(menu_snapshot)
-            try:
-                save_menu_safely()
-            except Exception as restore_exc:
-                print(
-                    f"Cancel order {order_id}: menu rollback failed: {restore_exc}",
-                    flush=True,
-                )
+        stock_journal.rollback(f"Cancel order {order_id}")
         print(
             f"Cancel order {order_id} failed: {type(exc).__name__}: {exc}",
             flush=True,
         )
         try:
-            bot.answer_callback_query(
-                call.id,
+            answer_callback(
+                call,
                 "Не удалось отменить заказ. Ошибка записана в Railway Logs.",
                 show_alert=True,
             )
@@ -7166,7 +10076,7 @@ def handle_cancel_order(call):
     if not notification_sent:
         callback_text += "; пользователь не получил уведомление"
     try:
-        bot.answer_callback_query(call.id, callback_text, show_alert=not notification_sent)
+        answer_callback(call, callback_text, show_alert=not notification_sent)
     except Exception as exc:
         print(f"Cancel order {order_id}: callback answer failed: {exc}", flush=True)
 
@@ -7221,25 +10131,20 @@ def handle_order_delivered(call: types.CallbackQuery):
 
 
 @bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("deliver_currency|"))
+@early_callback_ack("⏳ Marking delivered…", guard=reject_order_card_callback)
 def handle_deliver_currency(call: types.CallbackQuery):
-
-    if not is_owner(call.from_user.id):
-        return bot.answer_callback_query(call.id, "Нет доступа", show_alert=True)
-    if call.message.chat.id != GROUP_CHAT_ID:
-        return bot.answer_callback_query(call.id, "Нажали не в том чате", show_alert=True)
-
     try:
         _, oid, currency = call.data.split("|", 2)
         order_id = int(oid)
     except (ValueError, IndexError):
-        return bot.answer_callback_query(call.id, "Data error", show_alert=True)
+        return answer_callback(call, "Data error", show_alert=True)
 
     currency = currency.casefold()
     allowed_currencies = {
         "cash", "rub", "dollar", "euro", "uah", "iban", "crypto", "free",
     }
     if currency not in allowed_currencies:
-        return bot.answer_callback_query(call.id, "Unknown payment method", show_alert=True)
+        return answer_callback(call, "Unknown payment method", show_alert=True)
 
     proof_required = currency in PROOF_REQUIRED_DELIVERY_METHODS
     if proof_required:
@@ -7261,8 +10166,8 @@ def handle_deliver_currency(call: types.CallbackQuery):
         )
         if cur.fetchone():
             conn.rollback()
-            return bot.answer_callback_query(
-                call.id,
+            return answer_callback(
+                call,
                 "This order has already been marked delivered.",
                 show_alert=True,
             )
@@ -7274,7 +10179,7 @@ def handle_deliver_currency(call: types.CallbackQuery):
         row = cur.fetchone()
         if not row:
             conn.rollback()
-            return bot.answer_callback_query(call.id, "Order not found", show_alert=True)
+            return answer_callback(call, "Order not found", show_alert=True)
 
         customer_chat_id = int(row[0])
         items = json.loads(row[1] or "[]")
@@ -7310,11 +10215,13 @@ def handle_deliver_currency(call: types.CallbackQuery):
         cur.execute("SELECT SUM(count) FROM delivered_counts")
         overall_total = cur.fetchone()[0] or 0
         conn.commit()
+        if proof_required:
+            mark_awaiting_proof(customer_chat_id, order_id)
     except Exception as exc:
         conn.rollback()
         print(f"Deliver order {order_id} failed: {type(exc).__name__}: {exc}", flush=True)
-        return bot.answer_callback_query(
-            call.id,
+        return answer_callback(
+            call,
             "Не удалось отметить заказ доставленным. Ошибка записана в Railway Logs.",
             show_alert=True,
         )
@@ -7366,8 +10273,8 @@ def handle_deliver_currency(call: types.CallbackQuery):
         callback_text += "; customer was not notified"
     if not admin_message_updated:
         callback_text += "; card was not updated"
-    bot.answer_callback_query(
-        call.id,
+    answer_callback(
+        call,
         callback_text,
         show_alert=not customer_notified or not admin_message_updated,
     )
@@ -7450,8 +10357,252 @@ def handle_courier_on_way(call):
         )
 
     bot.answer_callback_query(call.id, "Marked as In Delivery 🚗")
+
+
+# ------------------------------------------------------------------------
+#   36. Метрики: замер хендлеров и локальный /metrics
+# ------------------------------------------------------------------------
+def timed_handler(function, kind: str):
+    """Обёртка хендлера: длительность и ошибки с меткой имени хендлера."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = profiled_call(function, *args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            observe_duration(
+                "handler_seconds",
+                time.perf_counter() - started,
+                handler=function.__name__,
+                kind=kind,
+                outcome=outcome,
+            )
+
+    wrapper.instrumented = True
+    return wrapper
+
+
+def instrument_handlers() -> None:
+    """Оборачивает таймером все уже зарегистрированные хендлеры telebot."""
+    for kind, handlers in (
+        ("message", bot.message_handlers),
+        ("callback_query", bot.callback_query_handlers),
+        ("my_chat_member", bot.my_chat_member_handlers),
+        ("inline_query", bot.inline_handlers),
+    ):
+        for handler in handlers:
+            function = handler["function"]
+            if not getattr(function, "instrumented", False):
+                handler["function"] = timed_handler(function, kind)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Опрос раз в несколько секунд не должен засорять Railway Logs.
+        pass
+
+
+def start_metrics_server() -> ThreadingHTTPServer | None:
+    """Поднимает /metrics на METRICS_HOST:METRICS_PORT (METRICS_PORT=0 — выключено)."""
+    if not METRICS_PORT:
+        return None
+    try:
+        server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsRequestHandler)
+    except OSError as exc:
+        print(f"Metrics server not started: {exc}", flush=True)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Metrics: http://{METRICS_HOST}:{METRICS_PORT}/metrics", flush=True)
+    return server
+
+
+def stamp_received_updates(updates: list) -> None:
+    """
+    Приём пачки апдейтов до очереди воркеров telebot: счётчик /profile и
+    время приёма на callback'ах.
+    """
+    count_profiled_updates(len(updates))
+    received_at = time.perf_counter()
+    for update in updates:
+        if update.callback_query is not None:
+            update.callback_query.received_at = received_at
+
+
+def install_update_intake() -> None:
+    """Пропускает каждую пачку апдейтов через stamp_received_updates."""
+    process_new_updates = bot.process_new_updates
+
+    def intake(updates):
+        stamp_received_updates(updates)
+        return process_new_updates(updates)
+
+    bot.process_new_updates = intake
+
+
+# Регистрация хендлеров закончена — все они попадают в handler_seconds.
+instrument_handlers()
+install_update_intake()
+
+
+# ------------------------------------------------------------------------
+#   37. Запись входящих апдейтов для replay (UPDATE_RECORD_PATH)
+# ------------------------------------------------------------------------
+# Опционально: каждый апдейт из getUpdates дописывается строкой JSONL в
+# UPDATE_RECORD_PATH. ID пользователей и чатов заменяются псевдонимами,
+# имена, телефоны, геопозиции и file_id вычищаются, а текст, введённый на
+# шагах адреса, контакта и комментария, заменяется заглушкой. Владелец и
+# админ-группа получают фиксированные ID, чтобы replay_updates.py мог
+# воспроизвести и админские действия.
+UPDATE_RECORD_PATH = os.getenv("UPDATE_RECORD_PATH", "").strip()
+UPDATE_RECORD_SALT = os.getenv("UPDATE_RECORD_SALT", "") or os.urandom(16).hex()
+RECORD_ADMIN_ID = 1
+RECORD_GROUP_CHAT_ID = -100
+RECORD_REDACTED_STEPS = (
+    ("wait_for_address", "Recorded address"),
+    ("wait_for_contact", "+90 500 000 00 00"),
+    ("wait_for_comment", "Recorded comment"),
+)
+RECORD_PERSONAL_FIELDS = ("first_name", "last_name", "username", "title", "phone_number", "vcard")
+
+_record_lock = threading.Lock()
+_record_pseudonyms: dict[int, int] = {}
+
+
+def record_pseudonym(raw_id: int) -> int:
+    """Стабильный псевдоним ID в пределах соли; знак (группа/пользователь) сохраняется."""
+    if raw_id == ADMIN_ID:
+        return RECORD_ADMIN_ID
+    if raw_id == GROUP_CHAT_ID:
+        return RECORD_GROUP_CHAT_ID
+    pseudonym = _record_pseudonyms.get(raw_id)
+    if pseudonym is None:
+        digest = hashlib.sha256(f"{UPDATE_RECORD_SALT}:{raw_id}".encode()).digest()
+        pseudonym = 10 ** 9 + int.from_bytes(digest[:8], "big") % 10 ** 9
+        if raw_id < 0:
+            pseudonym = -pseudonym
+        _record_pseudonyms[raw_id] = pseudonym
+    return pseudonym
+
+
+def anonymize_update_value(value, key: str = ""):
+    if isinstance(value, dict):
+        cleaned = {}
+        for field, item in value.items():
+            if field in RECORD_PERSONAL_FIELDS and isinstance(item, str):
+                cleaned[field] = f"{field}-redacted"
+            elif field in ("id", "user_id", "chat_id") and isinstance(item, int):
+                cleaned[field] = record_pseudonym(item)
+            elif field in ("file_id", "file_unique_id", "chat_instance"):
+                cleaned[field] = "redacted"
+            elif field in ("latitude", "longitude"):
+                cleaned[field] = 0.0
+            elif field == "address" and isinstance(item, str):
+                cleaned[field] = "Recorded venue"
+            else:
+                cleaned[field] = anonymize_update_value(item, field)
+        return cleaned
+    if isinstance(value, list):
+        return [anonymize_update_value(item, key) for item in value]
+    return value
+
+
+def anonymize_callback_data(data: str) -> str:
+    """В callback_data админских кнопок бывают chat_id клиентов — подменяем их.
+
+    Номера заказов короткие (< 10^6), токены каталога — ровно 16 символов
+    (иногда из одних цифр), chat_id — 6–14 цифр.
+    """
+    parts = data.split("|")
+    for index, part in enumerate(parts):
+        digits = part.lstrip("-")
+        if digits.isdigit() and len(digits) < 16:
+            value = int(part)
+            if value in _record_pseudonyms or abs(value) >= 10 ** 6:
+                parts[index] = str(record_pseudonym(value))
+    return "|".join(parts)
+
+
+def anonymize_update(raw_update: dict) -> dict:
+    message = raw_update.get("message") or {}
+    chat_id = (message.get("chat") or {}).get("id")
+    redacted_text = None
+    if chat_id is not None and message.get("text") and not message["text"].startswith("/"):
+        state = user_data.get(chat_id, {})
+        redacted_text = next(
+            (placeholder for flag, placeholder in RECORD_REDACTED_STEPS if state.get(flag)),
+            None,
+        )
+    update = anonymize_update_value(raw_update)
+    if redacted_text is not None:
+        update["message"]["text"] = redacted_text
+        update["message"].pop("entities", None)
+    # Сообщения бота (под кнопкой или в ответе) содержат адреса и контакты
+    # из карточек заказов — текст не записываем.
+    callback = update.get("callback_query") or {}
+    for bot_message in (callback.get("message"), update.get("message", {}).get("reply_to_message")):
+        if isinstance(bot_message, dict):
+            for field in ("text", "caption"):
+                if field in bot_message:
+                    bot_message[field] = "Recorded bot message"
+            bot_message.pop("entities", None)
+            bot_message.pop("caption_entities", None)
+    if callback.get("data"):
+        callback["data"] = anonymize_callback_data(callback["data"])
+    return update
+
+
+def record_updates(raw_updates: list) -> None:
+    lines = []
+    for raw_update in raw_updates:
+        try:
+            lines.append(json.dumps({
+                "recorded_at": round(time.time(), 3),
+                "bot_version": BOT_VERSION,
+                "update": anonymize_update(raw_update),
+            }, ensure_ascii=False))
+        except Exception as exc:
+            print(f"Update recording skipped: {type(exc).__name__}: {exc}", flush=True)
+    if not lines:
+        return
+    with _record_lock:
+        with open(UPDATE_RECORD_PATH, "a", encoding="utf-8") as file_obj:
+            file_obj.write("\n".join(lines) + "\n")
+
+
+def install_update_recorder() -> bool:
+    """Включает запись апдейтов, если задан UPDATE_RECORD_PATH."""
+    if not UPDATE_RECORD_PATH:
+        return False
+    raw_get_updates = apihelper.get_updates
+
+    def recording_get_updates(*args, **kwargs):
+        raw_updates = raw_get_updates(*args, **kwargs)
+        if raw_updates:
+            record_updates(raw_updates)
+        return raw_updates
+
+    apihelper.get_updates = recording_get_updates
+    print(f"Recording anonymized updates to {UPDATE_RECORD_PATH}", flush=True)
+    return True
+
+
 # ------------------------------------------------------------------------
-#   36. Запуск бота
+#   38. Запуск бота
 # ------------------------------------------------------------------------
 if __name__ == "__main__":
     # 1) Определяем московскую зону
@@ -7468,6 +10619,57 @@ if __name__ == "__main__":
         minute=55,
         timezone=moscow_tz    # <- убеждаемся, что триггер знает, что это МСК
     )
+    # getMe — один раз при старте и изредка в фоне (username для ссылок)
+    refresh_bot_identity_job()
+    scheduler.add_job(
+        refresh_bot_identity_job,
+        trigger='interval',
+        hours=BOT_IDENTITY_REFRESH_HOURS,
+    )
+    # Старые закрытые заказы уходят в archive.db до уборки и vacuum
+    scheduler.add_job(
+        archive_old_orders_job,
+        trigger='cron',
+        hour=4,
+        minute=15,
+        timezone=moscow_tz,
+    )
+    # Ночная уборка пустых и заброшенных корзин
+    scheduler.add_job(
+        collect_abandoned_carts_job,
+        trigger='cron',
+        hour=4,
+        minute=30,
+        timezone=moscow_tz,
+    )
+    # После уборки корзин — ANALYZE, vacuum, checkpoint и quick_check
+    scheduler.add_job(
+        run_database_maintenance_job,
+        trigger='cron',
+        hour=4,
+        minute=45,
+        timezone=moscow_tz,
+    )
+    # Онлайн-бэкап базы и каталога
+    scheduler.add_job(
+        create_backup_job,
+        trigger='interval',
+        hours=BACKUP_INTERVAL_HOURS,
+    )
+    # Реплика для отчётов владельца (снимается сразу и каждые 5 минут)
+    scheduler.add_job(
+        refresh_analytics_replica_job,
+        trigger='interval',
+        minutes=ANALYTICS_REFRESH_MINUTES,
+        next_run_time=datetime.datetime.now(moscow_tz),
+    )
+    # Курсы валют обновляются в фоне, а не на экране покупателя
+    scheduler.add_job(
+        refresh_exchange_rates,
+        trigger='interval',
+        minutes=RATES_REFRESH_MINUTES,
+        next_run_time=datetime.datetime.now(moscow_tz),
+    )
 
     scheduler.start()
 
@@ -7475,10 +10677,17 @@ if __name__ == "__main__":
     for job in scheduler.get_jobs():
         print("Next run (UTC):", job.next_run_time)
 
-    # 5) Запускаем бота
+    # 5) Фоновая доставка уведомлений из outbox (в т.ч. оставшихся до рестарта)
+    start_outbox_workers()
+
+    # 6) Локальный /metrics для Prometheus и (по желанию) запись апдейтов
+    start_metrics_server()
+    install_update_recorder()
+
+    # 7) Запускаем бота
     bot.delete_webhook()
     bot.infinity_polling(
         timeout=10,
         long_polling_timeout=5,
-        allowed_updates=["message", "callback_query", "my_chat_member"],
+        allowed_updates=["message", "callback_query", "my_chat_member", "inline_query"],
     )
@@ -0,0 +1,307 @@
+"""
+Фейковый Telegram Bot API для офлайн-нагрузочных тестов.
+
+Отвечает на методы, которые вызывает bot.py (getUpdates, sendMessage,
+editMessageText, editMessageCaption, editMessageReplyMarkup, sendPhoto,
+sendDocument, copyMessage, answerCallbackQuery, deleteWebhook, getMe),
+хранит журнал всех вызовов и раздаёт апдейты, которые подкладывает драйвер
+сценария. Бот подключается через TELEGRAM_API_URL=<api_url>.
+"""
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+BOT_USER = {
+    "id": 100000,
+    "is_bot": True,
+    "first_name": "Load test bot",
+    "username": "loadtest_bot",
+}
+
+MESSAGE_METHODS = {"sendMessage", "sendPhoto", "sendDocument"}
+EDIT_METHODS = {"editMessageText", "editMessageCaption", "editMessageReplyMarkup"}
+
+
+class ApiCall:
+    """Один вызов Bot API, записанный фейковым сервером."""
+
+    __slots__ = ("index", "at", "method", "params", "chat_id", "message_id")
+
+    def __init__(self, index, at, method, params, chat_id, message_id):
+        self.index = index
+        self.at = at
+        self.method = method
+        self.params = params
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    @property
+    def text(self) -> str:
+        return str(self.params.get("text") or self.params.get("caption") or "")
+
+    def callback_buttons(self) -> list[tuple[str, str]]:
+        """(текст, callback_data) inline-кнопок из reply_markup."""
+        markup = self.params.get("reply_markup")
+        if not markup:
+            return []
+        if isinstance(markup, str):
+            try:
+                markup = json.loads(markup)
+            except ValueError:
+                return []
+        return [
+            (button.get("text", ""), button["callback_data"])
+            for row in markup.get("inline_keyboard", [])
+            for button in row
+            if button.get("callback_data")
+        ]
+
+
+def _chat_id(params: dict) -> int | None:
+    try:
+        return int(params["chat_id"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class FakeTelegramAPI:
+    """HTTP-сервер с журналом вызовов и очередью апдейтов для getUpdates."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self._condition = threading.Condition()
+        self._updates: list[dict] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+        self._last_messages: dict[int, dict] = {}
+        self.calls: list[ApiCall] = []
+        self.polls = 0
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    # --------------------------------------------------------------
+    #   Жизненный цикл
+    # --------------------------------------------------------------
+    @property
+    def api_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def start(self) -> "FakeTelegramAPI":
+        self._thread = threading.Thread(
+            target=self.server.serve_forever,
+            name="fake-telegram",
+            daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        with self._condition:
+            self._condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    # --------------------------------------------------------------
+    #   Апдейты от «пользователей»
+    # --------------------------------------------------------------
+    def _push(self, kind: str, payload: dict) -> int:
+        with self._condition:
+            update_id = next(self._update_ids)
+            self._updates.append({"update_id": update_id, kind: payload})
+            self._condition.notify_all()
+        return update_id
+
+    @staticmethod
+    def _chat(chat_id: int) -> dict:
+        if chat_id < 0:
+            return {"id": chat_id, "type": "supergroup", "title": "Admin group"}
+        return {"id": chat_id, "type": "private", "first_name": f"User{chat_id}"}
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {
+            "id": user_id,
+            "is_bot": False,
+            "first_name": f"User{user_id}",
+            "username": f"user{user_id}",
+            "language_code": "en",
+        }
+
+    def send_text(self, chat_id: int, text: str, from_id: int | None = None) -> int:
+        """Кладёт в очередь текстовое сообщение пользователя; возвращает индекс журнала."""
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": self._chat(chat_id),
+            "from": self._user(from_id or chat_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        mark = self.mark()
+        self._push("message", message)
+        return mark
+
+    def press_button(self, chat_id: int, data: str, from_id: int | None = None) -> tuple[int, str]:
+        """Нажатие inline-кнопки под последним сообщением бота в чате."""
+        last = self._last_messages.get(chat_id) or {
+            "message_id": next(self._message_ids),
+            "date": 0,
+            "chat": self._chat(chat_id),
+            "text": "",
+        }
+        callback_id = str(next(self._callback_ids))
+        mark = self.mark()
+        self._push("callback_query", {
+            "id": callback_id,
+            "chat_instance": str(chat_id),
+            "from": self._user(from_id or chat_id),
+            "message": dict(last),
+            "data": data,
+        })
+        return mark, callback_id
+
+    # --------------------------------------------------------------
+    #   Журнал вызовов
+    # --------------------------------------------------------------
+    def mark(self) -> int:
+        with self._condition:
+            return len(self.calls)
+
+    def wait_for(self, predicate, since: int = 0, timeout: float = 10.0) -> ApiCall | None:
+        """Ждёт первый вызов с индексом >= since, для которого predicate(call) истинно."""
+        deadline = time.monotonic() + timeout
+        position = since
+        with self._condition:
+            while True:
+                while position < len(self.calls):
+                    call = self.calls[position]
+                    position += 1
+                    if predicate(call):
+                        return call
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def calls_for(self, chat_id: int, since: int = 0) -> list[ApiCall]:
+        with self._condition:
+            return [call for call in self.calls[since:] if call.chat_id == chat_id]
+
+    def method_counts(self) -> dict[str, int]:
+        counts: dict[str, int] = {}
+        with self._condition:
+            for call in self.calls:
+                counts[call.method] = counts.get(call.method, 0) + 1
+        return dict(sorted(counts.items()))
+
+    # --------------------------------------------------------------
+    #   Обработка запросов бота
+    # --------------------------------------------------------------
+    def _get_updates(self, params: dict) -> list[dict]:
+        offset = int(params.get("offset", 0) or 0)
+        timeout = min(float(params.get("timeout", 0) or 0), 5.0)
+        limit = int(params.get("limit", 100) or 100)
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self.polls += 1
+            # Подтверждённые апдейты больше не отдаём, как и настоящий API.
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self._updates[:limit]
+
+    def record_call(self, method: str, params: dict) -> object:
+        """Записывает вызов и возвращает result, как настоящий Bot API."""
+        chat_id = _chat_id(params)
+        result: object = True
+        message_id = None
+        if method in MESSAGE_METHODS and chat_id is not None:
+            message_id = next(self._message_ids)
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": self._chat(chat_id),
+            }
+            if method == "sendPhoto":
+                result["photo"] = [{"file_id": "photo", "file_unique_id": "photo", "width": 1, "height": 1}]
+                result["caption"] = params.get("caption", "")
+            elif method == "sendDocument":
+                result["document"] = {"file_id": "document", "file_unique_id": "document"}
+            else:
+                result["text"] = params.get("text", "")
+        elif method == "copyMessage":
+            message_id = next(self._message_ids)
+            result = {"message_id": message_id}
+        elif method in EDIT_METHODS and chat_id is not None:
+            message_id = int(params.get("message_id", 0) or 0)
+            previous = self._last_messages.get(chat_id, {})
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": self._chat(chat_id),
+            }
+            if "photo" in previous and previous.get("message_id") == message_id:
+                result["photo"] = previous["photo"]
+                result["caption"] = params.get("caption", previous.get("caption", ""))
+            else:
+                result["text"] = params.get("text", previous.get("text", ""))
+        elif method == "getMe":
+            result = dict(BOT_USER)
+
+        with self._condition:
+            if isinstance(result, dict) and "chat" in result and "date" in result:
+                last = dict(result)
+                markup = params.get("reply_markup")
+                if markup:
+                    last["reply_markup"] = json.loads(markup) if isinstance(markup, str) else markup
+                self._last_messages[chat_id] = last
+            self.calls.append(ApiCall(
+                len(self.calls), time.monotonic(), method, params, chat_id, message_id,
+            ))
+            self._condition.notify_all()
+        return result
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self):
+                parts = urlsplit(self.path)
+                method = parts.path.rsplit("/", 1)[-1]
+                params = dict(parse_qsl(parts.query, keep_blank_values=True))
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                content_type = self.headers.get("Content-Type", "")
+                if body and content_type.startswith("application/x-www-form-urlencoded"):
+                    params.update(parse_qsl(body.decode("utf-8"), keep_blank_values=True))
+                elif body and content_type.startswith("application/json"):
+                    params.update(json.loads(body))
+
+                if method == "getUpdates":
+                    result = api._get_updates(params)
+                else:
+                    result = api.record_call(method, params)
+                payload = json.dumps({"ok": True, "result": result}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = _respond
+            do_POST = _respond
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,396 @@
+"""
+Офлайн-нагрузочный тест: bot.py против фейкового Bot API (fake_telegram.py).
+
+N одновременных покупателей проходят путь
+/start → язык → категория → вкус → cart_add → checkout → адрес → контакт →
+без комментария → confirm_order. Бот запускается отдельным процессом
+на временной копии DATA_DIR, сеть наружу отрезана прокси-заглушкой.
+
+Сценарии:
+  hot    — все покупают один вкус с остатком --stock (проверка оверселла);
+  spread — каждый берёт случайный вкус, остатков хватает всем.
+
+Пример:
+  python loadtest.py --customers 50 --stock 20
+  python loadtest.py --scenario spread --customers 100 --output loadtest_output.json
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_telegram import FakeTelegramAPI
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+TOKEN = "100000:loadtest"
+ADMIN_ID = 1
+GROUP_CHAT_ID = -100000
+FIRST_CUSTOMER_ID = 500000
+
+ORDER_PATTERN = re.compile(r"order #(\d+)")
+REJECTED_PATTERN = re.compile(r"no longer|out of stock|unfortunately|outdated|only \d+", re.I)
+
+
+def percentile(values: list[float], share: float) -> float:
+    """Перцентиль методом ближайшего ранга."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(share * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def prepare_data_dir(scenario: str, stock: int, customers: int) -> tuple[str, str, str]:
+    """Копия menu.json/languages.json во временный DATA_DIR с заданными остатками."""
+    data_dir = tempfile.mkdtemp(prefix="vozol-loadtest-")
+    shutil.copy(os.path.join(REPO_DIR, "languages.json"), data_dir)
+    with open(os.path.join(REPO_DIR, "menu.json"), encoding="utf-8") as file_obj:
+        menu = json.load(file_obj)
+
+    hot_category = next(cat for cat, data in menu.items() if data.get("flavors"))
+    hot_flavor = menu[hot_category]["flavors"][0]["flavor"]
+    for category, data in menu.items():
+        for item in data.get("flavors", []):
+            if scenario == "hot":
+                is_hot = category == hot_category and item["flavor"] == hot_flavor
+                item["stock"] = stock if is_hot else 0
+            else:
+                item["stock"] = customers
+    with open(os.path.join(data_dir, "menu.json"), "w", encoding="utf-8") as file_obj:
+        json.dump(menu, file_obj, ensure_ascii=False, indent=2)
+    return data_dir, hot_category, hot_flavor
+
+
+def start_bot(api: FakeTelegramAPI, data_dir: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "TOKEN": TOKEN,
+        "DATA_DIR": data_dir,
+        "TELEGRAM_API_URL": api.api_url,
+        "ADMIN_ID": str(ADMIN_ID),
+        "GROUP_CHAT_ID": str(GROUP_CHAT_ID),
+        "METRICS_PORT": "0",
+        "PYTHONUNBUFFERED": "1",
+        # Курсы валют и перевод уходят в никуда и сразу падают в fallback.
+        "HTTP_PROXY": "http://127.0.0.1:9",
+        "HTTPS_PROXY": "http://127.0.0.1:9",
+        "NO_PROXY": "127.0.0.1,localhost",
+    })
+    log = open(os.path.join(data_dir, "bot.log"), "w", encoding="utf-8")
+    return subprocess.Popen(
+        [sys.executable, os.path.join(REPO_DIR, "bot.py")],
+        cwd=data_dir,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+class Customer:
+    """Один покупатель: шаги сценария с замером задержек."""
+
+    def __init__(self, api: FakeTelegramAPI, chat_id: int, target: tuple[str, str] | None,
+                 step_timeout: float):
+        self.api = api
+        self.chat_id = chat_id
+        self.target = target
+        self.step_timeout = step_timeout
+        self.latencies: dict[str, float] = {}
+        self.outcome = "pending"
+        self.failed_step = None
+        self.order_id = None
+
+    # Ожидания: шаг закончен, когда бот прислал нужную клавиатуру или текст.
+    def _expect(self, since: int, *, button: str | None = None, text: str | None = None):
+        pattern = re.compile(text) if text else None
+
+        def matches(call):
+            if call.chat_id != self.chat_id or call.method == "answerCallbackQuery":
+                return False
+            if button and not any(data.startswith(button) for _label, data in call.callback_buttons()):
+                return False
+            if pattern and not pattern.search(call.text):
+                return False
+            return True
+
+        return self.api.wait_for(matches, since, self.step_timeout)
+
+    def _rejected_since(self, since: int) -> bool:
+        texts = [call.text for call in self.api.calls_for(self.chat_id, since)]
+        texts += [
+            str(call.params.get("text", ""))
+            for call in self.api.calls[since:]
+            if call.method == "answerCallbackQuery"
+        ]
+        return any(REJECTED_PATTERN.search(text) for text in texts)
+
+    def _step(self, name: str, send, **expect):
+        started = time.monotonic()
+        since = send()
+        reply = self._expect(since, **expect)
+        if reply is None:
+            self.failed_step = name
+            self.outcome = "sold_out" if self._rejected_since(since) else "timeout"
+            return None
+        self.latencies[name] = reply.at - started
+        return reply
+
+    def _press(self, data: str):
+        return lambda: self.api.press_button(self.chat_id, data)[0]
+
+    def _say(self, text: str):
+        return lambda: self.api.send_text(self.chat_id, text)
+
+    def _pick(self, reply, prefix: str, label: str | None) -> str | None:
+        buttons = [(text, data) for text, data in reply.callback_buttons() if data.startswith(prefix)]
+        if label is not None:
+            buttons = [(text, data) for text, data in buttons if label in text]
+        return random.choice(buttons)[1] if buttons else None
+
+    def run(self) -> "Customer":
+        category, flavor = self.target or (None, None)
+        if not self._step("start", self._say("/start"), button="set_lang|"):
+            return self
+        reply = self._step("set_lang", self._press("set_lang|en"), button="category|")
+        if not reply:
+            return self
+        category_data = self._pick(reply, "category|", category)
+        if category_data is None:
+            self.outcome, self.failed_step = "sold_out", "category"
+            return self
+        reply = self._step("category", self._press(category_data), button="product|")
+        if not reply:
+            return self
+        product_data = self._pick(reply, "product|", flavor)
+        if product_data is None:
+            self.outcome, self.failed_step = "sold_out", "product"
+            return self
+        token = product_data.split("|", 1)[1]
+        if not self._step("product", self._press(product_data), button="cart_add|"):
+            return self
+        if not self._step("cart_add", self._press(f"cart_add|{token}"), button="view_cart"):
+            return self
+        if not self._step("finish_order", self._press("finish_order"), text=r"1/3"):
+            return self
+        if not self._step("address", self._say(f"Load test street {self.chat_id}"), text=r"phone number"):
+            return self
+        if not self._step("contact", self._say("+90 555 000 00 00"), button="comment_skip"):
+            return self
+        if not self._step("comment_skip", self._press("comment_skip"), button="confirm_order"):
+            return self
+
+        started = time.monotonic()
+        since, callback_id = self.api.press_button(self.chat_id, "confirm_order")
+        ack = self.api.wait_for(
+            lambda call: call.method == "answerCallbackQuery"
+            and call.params.get("callback_query_id") == callback_id,
+            since,
+            self.step_timeout,
+        )
+        if ack is not None:
+            self.latencies["confirm_ack"] = ack.at - started
+        result = self._expect(since, text=r"order #\d+|no longer available")
+        if result is None:
+            self.outcome = "sold_out" if self._rejected_since(since) else "timeout"
+            self.failed_step = "confirm_order"
+            return self
+        self.latencies["confirm_order"] = result.at - started
+        match = ORDER_PATTERN.search(result.text)
+        if match:
+            self.outcome = "ordered"
+            self.order_id = int(match.group(1))
+        else:
+            self.outcome, self.failed_step = "sold_out", "confirm_order"
+        return self
+
+
+def wait_outbox_drained(db_path: str, timeout: float) -> int:
+    """Ждёт, пока outbox доставит всё; возвращает число недоставленных строк."""
+    deadline = time.monotonic() + timeout
+    pending = -1
+    while time.monotonic() < deadline:
+        with sqlite3.connect(db_path, timeout=5) as conn:
+            pending = conn.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+        if pending == 0:
+            return 0
+        time.sleep(0.2)
+    return pending
+
+
+def consistency_checks(data_dir: str, api: FakeTelegramAPI, customers: list[Customer],
+                       scenario: str, stock: int, hot: tuple[str, str]) -> dict:
+    with open(os.path.join(data_dir, "menu.json"), encoding="utf-8") as file_obj:
+        menu = json.load(file_obj)
+    with sqlite3.connect(os.path.join(data_dir, "database.db"), timeout=5) as conn:
+        orders = conn.execute("SELECT order_id, chat_id, items_json FROM orders").fetchall()
+        outbox = dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+    sold: dict[tuple[str, str], int] = {}
+    for _order_id, _chat_id, items_json in orders:
+        for item in json.loads(items_json):
+            key = (item["category"], item["flavor"])
+            sold[key] = sold.get(key, 0) + 1
+
+    negative = [
+        f"{category} / {item['flavor']}: {item['stock']}"
+        for category, data in menu.items()
+        for item in data.get("flavors", [])
+        if int(item.get("stock", 0)) < 0
+    ]
+    stock_mismatch = []
+    for category, data in menu.items():
+        for item in data.get("flavors", []):
+            key = (category, item["flavor"])
+            initial = (stock if key == hot else 0) if scenario == "hot" else len(customers)
+            if initial - int(item.get("stock", 0)) != sold.get(key, 0):
+                stock_mismatch.append(
+                    f"{category} / {item['flavor']}: initial {initial}, "
+                    f"left {item.get('stock')}, sold {sold.get(key, 0)}"
+                )
+
+    ordered = [customer for customer in customers if customer.outcome == "ordered"]
+    ordered_ids = sorted(customer.order_id for customer in ordered)
+    db_ids = sorted(order_id for order_id, _chat_id, _items in orders)
+    group_notices: dict[int, int] = {}
+    for call in api.calls:
+        if call.chat_id == GROUP_CHAT_ID and call.method == "sendMessage":
+            for match in re.finditer(r"#(\d+)", call.text):
+                group_notices[int(match.group(1))] = group_notices.get(int(match.group(1)), 0) + 1
+                break
+
+    checks = {
+        "negative_stock": negative,
+        "stock_mismatch": stock_mismatch,
+        "oversold": scenario == "hot" and sold.get(hot, 0) > stock,
+        "orders_in_db": len(orders),
+        "orders_confirmed_to_customers": len(ordered),
+        "orders_match_confirmations": ordered_ids == db_ids,
+        "duplicate_admin_notices": sorted(o for o, n in group_notices.items() if n > 1),
+        "missing_admin_notices": sorted(o for o in db_ids if o not in group_notices),
+        "outbox": outbox,
+    }
+    if scenario == "hot":
+        checks["expected_orders"] = min(stock, len(customers))
+    checks["passed"] = (
+        not negative
+        and not stock_mismatch
+        and not checks["oversold"]
+        and checks["orders_match_confirmations"]
+        and not checks["duplicate_admin_notices"]
+        and not checks["missing_admin_notices"]
+        and outbox.get("pending", 0) == 0
+        and outbox.get("failed", 0) == 0
+        and (scenario != "hot" or len(orders) == checks["expected_orders"])
+    )
+    return checks
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--customers", type=int, default=50)
+    parser.add_argument("--stock", type=int, default=None,
+                        help="остаток «горячего» вкуса в сценарии hot (по умолчанию половина покупателей)")
+    parser.add_argument("--scenario", choices=("hot", "spread"), default="hot")
+    parser.add_argument("--step-timeout", type=float, default=20.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="loadtest_output.json")
+    parser.add_argument("--keep", action="store_true", help="не удалять временный DATA_DIR")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    stock = args.stock if args.stock is not None else max(args.customers // 2, 1)
+    data_dir, hot_category, hot_flavor = prepare_data_dir(args.scenario, stock, args.customers)
+    api = FakeTelegramAPI().start()
+    bot_process = start_bot(api, data_dir)
+    try:
+        if api.wait_for(lambda call: call.method == "deleteWebhook", 0, 60) is None:
+            print("Bot did not start, see", os.path.join(data_dir, "bot.log"))
+            return 2
+
+        target = (hot_category, hot_flavor) if args.scenario == "hot" else None
+        customers = [
+            Customer(api, FIRST_CUSTOMER_ID + index, target, args.step_timeout)
+            for index in range(args.customers)
+        ]
+        updates_before = api.mark()
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.customers) as executor:
+            list(executor.map(Customer.run, customers))
+        elapsed = time.monotonic() - started
+        api_calls = api.mark() - updates_before
+        undelivered = wait_outbox_drained(os.path.join(data_dir, "database.db"), 30)
+    finally:
+        bot_process.terminate()
+        try:
+            bot_process.wait(10)
+        except subprocess.TimeoutExpired:
+            bot_process.kill()
+        api.stop()
+
+    outcomes: dict[str, int] = {}
+    for customer in customers:
+        outcomes[customer.outcome] = outcomes.get(customer.outcome, 0) + 1
+    steps: dict[str, list[float]] = {}
+    for customer in customers:
+        for step, seconds in customer.latencies.items():
+            steps.setdefault(step, []).append(seconds)
+    latency = {
+        step: {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+            "p90_ms": round(percentile(values, 0.90) * 1000, 1),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+            "max_ms": round(max(values) * 1000, 1),
+        }
+        for step, values in steps.items()
+    }
+    checks = consistency_checks(
+        data_dir, api, customers, args.scenario, stock, (hot_category, hot_flavor),
+    )
+    checks["outbox_undelivered_after_wait"] = undelivered
+    report = {
+        "scenario": args.scenario,
+        "customers": args.customers,
+        "hot_stock": stock if args.scenario == "hot" else None,
+        "elapsed_s": round(elapsed, 3),
+        "checkouts_per_s": round(outcomes.get("ordered", 0) / elapsed, 2) if elapsed else 0,
+        "api_calls_per_s": round(api_calls / elapsed, 1) if elapsed else 0,
+        "outcomes": outcomes,
+        "failed_steps": {
+            step: sum(1 for c in customers if c.failed_step == step)
+            for step in sorted({c.failed_step for c in customers if c.failed_step})
+        },
+        "latency": latency,
+        "api_methods": api.method_counts(),
+        "checks": checks,
+        "data_dir": data_dir if args.keep else None,
+    }
+
+    print(f"Scenario {args.scenario}: {args.customers} customers in {elapsed:.2f}s, outcomes {outcomes}")
+    print(f"Throughput: {report['checkouts_per_s']} checkouts/s, {report['api_calls_per_s']} API calls/s")
+    print(f"{'step':<14}{'n':>5}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for step, stats in latency.items():
+        print(
+            f"{step:<14}{stats['count']:>5}{stats['p50_ms']:>10}{stats['p90_ms']:>10}"
+            f"{stats['p99_ms']:>10}{stats['max_ms']:>10}"
+        )
+    print("Consistency:", "OK" if checks["passed"] else "FAILED")
+    if not checks["passed"]:
+        print(json.dumps(checks, ensure_ascii=False, indent=2))
+    with open(args.output, "w", encoding="utf-8") as file_obj:
+        json.dump(report, file_obj, ensure_ascii=False, indent=2)
+    if not args.keep:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return 0 if checks["passed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
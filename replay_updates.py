@@ -0,0 +1,330 @@
+"""
+Воспроизведение записанных апдейтов (UPDATE_RECORD_PATH) против песочницы.
+
+Апдейты из JSONL подаются прямо в хендлеры bot.py с исходными паузами,
+ускоренными в --speed раз (или без пауз: --speed max). БД и menu.json —
+временная копия, Bot API подменён журналом из fake_telegram.py, внешние
+HTTP-запросы отрезаны. На выходе — задержки обработки и все исходящие
+сообщения; с --baseline выводится diff относительно прошлого прогона.
+
+Пример:
+  python replay_updates.py updates.jsonl --speed 10
+  python replay_updates.py updates.jsonl --speed max --baseline replay_baseline.json
+"""
+import argparse
+import difflib
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from fake_telegram import FakeTelegramAPI
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# Должны совпадать с RECORD_ADMIN_ID / RECORD_GROUP_CHAT_ID в bot.py.
+RECORD_ADMIN_ID = 1
+RECORD_GROUP_CHAT_ID = -100
+
+# Время и даты меняются от прогона к прогону и не считаются отличием.
+VOLATILE_PATTERNS = (
+    (re.compile(r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?([+-]\d{2}:\d{2})?"), "<datetime>"),
+    (re.compile(r"\d{2}\.\d{2}\.\d{4}"), "<date>"),
+    (re.compile(r"\b\d{1,2}:\d{2}(:\d{2})?\b"), "<time>"),
+)
+
+
+def percentile(values: list[float], share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(share * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def latency_summary(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+        "p90_ms": round(percentile(values, 0.90) * 1000, 2),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+        "max_ms": round(max(values) * 1000, 2) if values else 0.0,
+    }
+
+
+def normalize_call(method: str, params: dict) -> str:
+    """Одна строка на исходящий вызов: метод, чат, текст и кнопки."""
+    text = str(params.get("text") or params.get("caption") or "")
+    for pattern, replacement in VOLATILE_PATTERNS:
+        text = pattern.sub(replacement, text)
+    line = f"{method} chat={params.get('chat_id', '-')}"
+    if text:
+        line += " " + text.replace("\n", "⏎")
+    markup = params.get("reply_markup")
+    if markup:
+        markup = json.loads(markup) if isinstance(markup, str) else markup
+        buttons = [
+            button.get("callback_data") or button.get("url") or button.get("text", "")
+            for row in markup.get("inline_keyboard", []) or markup.get("keyboard", [])
+            for button in (row if isinstance(row, list) else [row])
+            if isinstance(button, dict)
+        ]
+        if buttons:
+            line += " [" + ", ".join(buttons) + "]"
+    if method == "answerCallbackQuery" and params.get("text"):
+        line += f" alert={bool(params.get('show_alert'))}"
+    return line
+
+
+class SettlingExecutor(ThreadPoolExecutor):
+    """Пул для фоновых продолжений callback'ов, дожидающийся их между апдейтами."""
+
+    def __init__(self, max_workers: int):
+        super().__init__(max_workers=max_workers, thread_name_prefix="callback")
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = super().submit(fn, *args, **kwargs)
+        with self._pending_lock:
+            self._pending.add(future)
+        future.add_done_callback(self._forget)
+        return future
+
+    def _forget(self, future) -> None:
+        with self._pending_lock:
+            self._pending.discard(future)
+
+    def settle(self, timeout: float = 30.0) -> None:
+        with self._pending_lock:
+            pending = list(self._pending)
+        if pending:
+            wait(pending, timeout)
+
+
+def load_records(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as file_obj:
+        return [json.loads(line) for line in file_obj if line.strip()]
+
+
+def prepare_sandbox(source_dir: str) -> str:
+    data_dir = tempfile.mkdtemp(prefix="vozol-replay-")
+    for name in ("menu.json", "languages.json"):
+        shutil.copy(os.path.join(source_dir, name), data_dir)
+    return data_dir
+
+
+def import_bot(data_dir: str, api: FakeTelegramAPI, outputs: list, outputs_lock):
+    """Импортирует bot.py в песочнице с подменённым Bot API."""
+    os.environ.update({
+        "TOKEN": "100000:replay",
+        "DATA_DIR": data_dir,
+        "ADMIN_ID": str(RECORD_ADMIN_ID),
+        "GROUP_CHAT_ID": str(RECORD_GROUP_CHAT_ID),
+        "METRICS_PORT": "0",
+        "UPDATE_RECORD_PATH": "",
+        "HTTP_PROXY": "http://127.0.0.1:9",
+        "HTTPS_PROXY": "http://127.0.0.1:9",
+        "NO_PROXY": "127.0.0.1,localhost",
+    })
+    from telebot import apihelper
+
+    def stub_request(token, method_name, method="get", params=None, files=None):
+        params = dict(params or {})
+        result = api.record_call(method_name, params)
+        with outputs_lock:
+            outputs.append((threading.current_thread().name, method_name, params))
+        return result
+
+    apihelper._make_request = stub_request
+    # Реферальные коды и прочие случайности одинаковы в каждом прогоне.
+    random.seed(0)
+    sys.path.insert(0, REPO_DIR)
+    import bot as bot_module
+    return bot_module
+
+
+def wait_outbox_drained(bot_module, timeout: float) -> int:
+    deadline = time.monotonic() + timeout
+    while True:
+        conn = bot_module.get_db_connection()
+        try:
+            pending = conn.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+        finally:
+            conn.close()
+        if pending == 0 or time.monotonic() >= deadline:
+            return pending
+        bot_module.wake_outbox()
+        time.sleep(0.1)
+
+
+def handler_summary(bot_module) -> dict:
+    """Средняя и максимальная длительность хендлеров из метрик bot.py."""
+    summary = {}
+    with bot_module._metrics_lock:
+        for (metric, labels), stats in bot_module._duration_metrics.items():
+            if metric != "handler_seconds":
+                continue
+            handler = dict(labels).get("handler", "?")
+            entry = summary.setdefault(handler, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            entry["count"] += stats[0]
+            entry["total_ms"] += stats[1] * 1000
+            entry["max_ms"] = max(entry["max_ms"], stats[2] * 1000)
+    return {
+        handler: {
+            "count": entry["count"],
+            "mean_ms": round(entry["total_ms"] / entry["count"], 3),
+            "max_ms": round(entry["max_ms"], 3),
+        }
+        for handler, entry in sorted(summary.items(), key=lambda item: -item[1]["total_ms"])
+    }
+
+
+def diff_against(baseline_path: str, report: dict, limit: int) -> int:
+    with open(baseline_path, encoding="utf-8") as file_obj:
+        baseline = json.load(file_obj)
+    differences = 0
+    previous = {entry["index"]: entry["calls"] for entry in baseline.get("outputs", [])}
+    for entry in report["outputs"]:
+        before = previous.get(entry["index"])
+        if before == entry["calls"]:
+            continue
+        differences += 1
+        if differences <= limit:
+            print(f"--- update #{entry['index']} ({entry['kind']})")
+            for line in difflib.unified_diff(before or [], entry["calls"], "baseline", "current", lineterm="", n=1):
+                print(line)
+    if len(previous) != len(report["outputs"]):
+        differences += 1
+        print(f"Update count differs: baseline {len(previous)}, current {len(report['outputs'])}")
+    if baseline.get("notifications") != report["notifications"]:
+        differences += 1
+        print("Outbox notifications differ:")
+        before_lines = [line for chat in sorted(baseline.get("notifications", {})) for line in baseline["notifications"][chat]]
+        after_lines = [line for chat in sorted(report["notifications"]) for line in report["notifications"][chat]]
+        for line in list(difflib.unified_diff(before_lines, after_lines, "baseline", "current", lineterm="", n=0))[:limit * 4]:
+            print(line)
+    print(
+        f"Baseline {baseline.get('bot_version')} → current {report['bot_version']}: "
+        f"{differences} difference(s)"
+    )
+    return differences
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("recording", help="JSONL из UPDATE_RECORD_PATH")
+    parser.add_argument("--speed", default="max", help="1, 10, ... или max (без пауз)")
+    parser.add_argument("--source-data", default=REPO_DIR,
+                        help="откуда взять menu.json и languages.json для песочницы")
+    parser.add_argument("--callback-workers", type=int, default=4)
+    parser.add_argument("--output", default="replay_output.json")
+    parser.add_argument("--baseline", help="прошлый replay_output.json для сравнения сообщений")
+    parser.add_argument("--diff-limit", type=int, default=20)
+    parser.add_argument("--keep", action="store_true", help="не удалять песочницу")
+    args = parser.parse_args()
+
+    speed = None if args.speed == "max" else float(args.speed)
+    records = load_records(args.recording)
+    if not records:
+        print("Recording is empty.")
+        return 2
+
+    data_dir = prepare_sandbox(args.source_data)
+    api = FakeTelegramAPI()
+    outputs: list = []
+    outputs_lock = threading.Lock()
+    bot_module = import_bot(data_dir, api, outputs, outputs_lock)
+    from telebot import types
+
+    bot_module.bot.threaded = False
+    executor = SettlingExecutor(args.callback_workers)
+    bot_module._callback_executor = executor
+    bot_module.start_outbox_workers()
+
+    per_update = []
+    latencies: dict[str, list[float]] = {}
+    errors = 0
+    first_at = records[0].get("recorded_at", 0)
+    started = time.monotonic()
+    for index, record in enumerate(records):
+        if speed:
+            due = started + (record.get("recorded_at", first_at) - first_at) / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        raw_update = record["update"]
+        kind = next((key for key in raw_update if key != "update_id"), "unknown")
+        with outputs_lock:
+            mark = len(outputs)
+        handled_at = time.perf_counter()
+        try:
+            bot_module.bot.process_new_updates([types.Update.de_json(json.dumps(raw_update))])
+        except Exception as exc:
+            errors += 1
+            print(f"Update #{index} raised {type(exc).__name__}: {exc}")
+        executor.settle()
+        elapsed = time.perf_counter() - handled_at
+        latencies.setdefault(kind, []).append(elapsed)
+        latencies.setdefault("all", []).append(elapsed)
+        with outputs_lock:
+            produced = [
+                normalize_call(method, params)
+                for thread_name, method, params in outputs[mark:]
+                if not thread_name.startswith("outbox")
+            ]
+        per_update.append({"index": index, "kind": kind, "calls": produced})
+    wall_time = time.monotonic() - started
+    undelivered = wait_outbox_drained(bot_module, 30)
+
+    notifications: dict[str, list[str]] = {}
+    with outputs_lock:
+        for thread_name, method, params in outputs:
+            if thread_name.startswith("outbox"):
+                notifications.setdefault(str(params.get("chat_id")), []).append(normalize_call(method, params))
+    notifications = {chat: sorted(lines) for chat, lines in sorted(notifications.items())}
+
+    report = {
+        "bot_version": bot_module.BOT_VERSION,
+        "recording": os.path.abspath(args.recording),
+        "speed": args.speed,
+        "updates": len(records),
+        "errors": errors,
+        "elapsed_s": round(wall_time, 3),
+        "updates_per_s": round(len(records) / wall_time, 1) if wall_time else 0,
+        "latency": {kind: latency_summary(values) for kind, values in sorted(latencies.items())},
+        "handlers": handler_summary(bot_module),
+        "outbox_undelivered": undelivered,
+        "outputs": per_update,
+        "notifications": notifications,
+    }
+    with open(args.output, "w", encoding="utf-8") as file_obj:
+        json.dump(report, file_obj, ensure_ascii=False, indent=2)
+
+    overall = report["latency"]["all"]
+    print(
+        f"Replayed {len(records)} updates at {args.speed}× in {wall_time:.2f}s "
+        f"({report['updates_per_s']} updates/s), errors: {errors}"
+    )
+    print(
+        f"Per-update latency: p50 {overall['p50_ms']} ms, p90 {overall['p90_ms']} ms, "
+        f"p99 {overall['p99_ms']} ms, max {overall['max_ms']} ms"
+    )
+    exit_code = 0
+    if args.baseline:
+        exit_code = 1 if diff_against(args.baseline, report, args.diff_limit) else 0
+
+    executor.shutdown(wait=False)
+    if not args.keep:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    # Фоновые потоки бота (outbox) — демоны, но sqlite-файлы уже не нужны.
+    os._exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
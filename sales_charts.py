@@ -0,0 +1,127 @@
+"""
+Графики продаж для /sold и ежедневного отчёта.
+
+Выполняется в процессе-воркере (ProcessPoolExecutor в bot.py): модуль не
+импортирует bot.py, получает готовые строки доставок и возвращает PNG.
+pandas и matplotlib импортируются внутри функций, поэтому основной процесс
+бота, который импортирует этот модуль только ради имён, их не загружает.
+
+Строка доставки: (delivery_id, timestamp, currency, qty, order_id, total,
+items_json) — как её отдаёт запрос в bot.sales_chart_png().
+"""
+import io
+import json
+
+CHART_DAYS = 14
+TOP_CATEGORIES = 8
+DELIVERY_COLUMNS = ("delivery_id", "timestamp", "currency", "qty", "order_id", "total", "items_json")
+
+
+def delivery_frame(rows, tz_name: str):
+    """DataFrame доставок с московским днём каждой доставки."""
+    import pandas as pd
+
+    frame = pd.DataFrame.from_records(rows, columns=DELIVERY_COLUMNS)
+    delivered = pd.to_datetime(frame["timestamp"], utc=True, format="ISO8601")
+    frame["day"] = delivered.dt.tz_convert(tz_name).dt.normalize().dt.tz_localize(None)
+    frame["currency"] = frame["currency"].fillna("unknown").str.upper()
+    frame["qty"] = frame["qty"].fillna(0).astype("int64")
+    frame["total"] = frame["total"].fillna(0).astype("int64")
+    return frame
+
+
+def daily_revenue(frame, days):
+    """Сумма заказов по дням; дни без доставок — нули."""
+    per_order = frame.drop_duplicates("order_id")
+    return per_order.groupby("day")["total"].sum().reindex(days, fill_value=0)
+
+
+def units_by_category(frame):
+    """Проданные штуки по моделям (категориям), по убыванию."""
+    import pandas as pd
+
+    # items_json пуст (NaN/None) у доставок отменённых заказов: заказ удалён,
+    # а строка delivered_log осталась и приходит через LEFT JOIN.
+    items = (
+        frame.drop_duplicates("order_id")["items_json"]
+        .map(lambda raw: json.loads(raw) if isinstance(raw, str) and raw else [])
+        .explode()
+        .dropna()
+    )
+    if items.empty:
+        return pd.Series(dtype="int64")
+    categories = pd.json_normalize(items.tolist()).get("category")
+    if categories is None:
+        return pd.Series(dtype="int64")
+    return categories.fillna("—").value_counts()
+
+
+def currency_mix(frame):
+    """Штуки по способу оплаты доставки."""
+    return frame.groupby("currency")["qty"].sum().sort_values(ascending=False)
+
+
+def render_sales_charts(rows, day: str, tz_name: str = "Europe/Moscow", days: int = CHART_DAYS) -> bytes:
+    """
+    Один PNG из трёх панелей: выручка по дням за days дней до day
+    включительно, штуки по моделям и способы оплаты за day.
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import pandas as pd
+
+    last_day = pd.Timestamp(day)
+    day_index = pd.date_range(end=last_day, periods=days, freq="D")
+    frame = delivery_frame(rows, tz_name)
+    today = frame[frame["day"] == last_day]
+
+    revenue = daily_revenue(frame, day_index)
+    categories = units_by_category(today).head(TOP_CATEGORIES)
+    currencies = currency_mix(today)
+
+    figure, (revenue_axis, category_axis, currency_axis) = plt.subplots(
+        1, 3, figsize=(15, 4.5), gridspec_kw={"width_ratios": [1.4, 1.2, 0.8]},
+    )
+    revenue_axis.bar(revenue.index.strftime("%d.%m"), revenue.to_numpy(), color="#3b7dd8")
+    revenue_axis.set_title(f"Revenue, last {days} days (₺)")
+    revenue_axis.tick_params(axis="x", labelrotation=60, labelsize=8)
+
+    if categories.empty:
+        category_axis.text(0.5, 0.5, "No deliveries", ha="center", va="center")
+        category_axis.set_axis_off()
+    else:
+        labels = [str(name)[:28] for name in categories.index[::-1]]
+        category_axis.barh(labels, categories.to_numpy()[::-1], color="#45a56b")
+        category_axis.tick_params(axis="y", labelsize=8)
+    category_axis.set_title(f"Units by model, {last_day:%d.%m}")
+
+    if currencies.empty or not currencies.sum():
+        currency_axis.text(0.5, 0.5, "No deliveries", ha="center", va="center")
+        currency_axis.set_axis_off()
+    else:
+        currency_axis.pie(
+            currencies.to_numpy(),
+            labels=currencies.index.tolist(),
+            autopct="%1.0f%%",
+            textprops={"fontsize": 8},
+        )
+    currency_axis.set_title("Payment mix (pcs)")
+
+    figure.tight_layout()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png", dpi=110)
+    plt.close(figure)
+    return buffer.getvalue()
+
+
+def warm_up() -> bool:
+    """Загружает pandas и matplotlib в воркер заранее, до первого /sold."""
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot  # noqa: F401
+    import pandas  # noqa: F401
+
+    return True
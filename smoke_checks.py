@@ -0,0 +1,162 @@
+"""
+Сквозные проверки сценариев, которые не покрывает нагрузочный тест.
+
+Каждая проверка идёт в одной песочнице (временный DATA_DIR, фейковый Bot
+API) и падает с AssertionError; код выхода — число упавших проверок.
+
+  backup_restore — бэкап → изменения → /restore → повторное открытие базы:
+                   данные как в копии, outbox живой, реплика отчётов свежая,
+                   сессии покупателей и кеш отрисовок сброшены.
+  archive_promo  — архивирование старого заказа с промокодом: заказ уходит
+                   в archive.db, а погашение промокода остаётся в основной
+                   базе, где его видит проверка одноразовости.
+  sales_charts   — графики за день, где рядом с обычной доставкой лежит
+                   доставка отменённого (удалённого) заказа без items_json.
+
+Пример:
+  python smoke_checks.py
+  python smoke_checks.py --only backup_restore
+"""
+import argparse
+import datetime
+import shutil
+import sqlite3
+import sys
+import threading
+import traceback
+
+from fake_telegram import FakeTelegramAPI
+from replay_updates import REPO_DIR, import_bot, prepare_sandbox
+
+CHECKS = {}
+
+
+def check(function):
+    CHECKS[function.__name__.removeprefix("check_")] = function
+    return function
+
+
+def insert_order(bot_module, conn, chat_id: int) -> int:
+    return conn.execute(
+        "INSERT INTO orders (chat_id, items_json, total, timestamp, payment_status) "
+        "VALUES (?, '[]', 1300, ?, 'cash')",
+        (chat_id, bot_module.utc_now_iso()),
+    ).lastrowid
+
+
+@check
+def check_backup_restore(bot_module) -> None:
+    conn = bot_module.get_db_connection()
+    insert_order(bot_module, conn, 101)
+    bot_module.enqueue_outbox_message(conn.cursor(), "smoke:before", 101, "before backup")
+    conn.commit()
+    conn.close()
+    backup = bot_module.create_backup(reason="smoke")
+
+    # После копии: сообщение отправлено, появились новый заказ и новое сообщение.
+    conn = bot_module.get_db_connection()
+    conn.execute("UPDATE outbox SET status = 'sent', sent_at = ? WHERE idempotency_key = 'smoke:before'",
+                 (bot_module.utc_now_iso(),))
+    insert_order(bot_module, conn, 102)
+    bot_module.enqueue_outbox_message(conn.cursor(), "smoke:after", 102, "after backup")
+    conn.commit()
+    conn.close()
+    bot_module.refresh_analytics_replica()
+
+    bot_module.user_data[102] = {"cart": [{"category": "A", "flavor": "x", "price": 1}]}
+    bot_module.remember_render(102, 1, b"screen")
+
+    restored_at = datetime.datetime.now(datetime.timezone.utc)
+    result = bot_module.restore_backup(backup["name"])
+    assert result["reset_sessions"] == 1, f"reset sessions: {result['reset_sessions']}"
+    assert not bot_module.render_cache_matches(102, 1, b"screen"), "render cache survived restore"
+
+    # Повторное открытие — новым соединением, как после рестарта бота.
+    conn = sqlite3.connect(bot_module.DB_PATH)
+    try:
+        assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+        chats = [row[0] for row in conn.execute("SELECT chat_id FROM orders ORDER BY order_id")]
+        assert chats == [101], f"orders after restore: {chats}"
+        outbox = dict(conn.execute("SELECT idempotency_key, status FROM outbox"))
+        assert outbox == {"smoke:before": "sent", "smoke:after": "pending"}, f"outbox: {outbox}"
+    finally:
+        conn.close()
+
+    replica, as_of = bot_module.get_analytics_connection()
+    try:
+        assert as_of >= restored_at, f"replica as of {as_of}, restore at {restored_at}"
+        count = replica.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+        assert count == 1, f"replica orders: {count}"
+    finally:
+        replica.close()
+
+
+@check
+def check_archive_promo(bot_module) -> None:
+    old = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=400)).isoformat()
+    conn = bot_module.get_db_connection()
+    order_id = insert_order(bot_module, conn, 201)
+    conn.execute("UPDATE orders SET timestamp = ?, delivered_at = ? WHERE order_id = ?",
+                 (old, old, order_id))
+    conn.execute("INSERT INTO promo_redemptions (promo_id, chat_id, order_id, discount_amount, "
+                 "redeemed_at) VALUES (1, 201, ?, 100, ?)", (order_id, old))
+    conn.commit()
+    conn.close()
+
+    stats = bot_module.archive_old_orders(after_days=90)
+    assert stats["orders"] >= 1, f"archive stats: {stats}"
+    conn = bot_module.get_db_connection()
+    try:
+        assert not conn.execute("SELECT 1 FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+        # Тот же запрос, что и в finalize_order / проверке промокода.
+        assert conn.execute(
+            "SELECT 1 FROM promo_redemptions WHERE promo_id = ? AND chat_id = ?", (1, 201)
+        ).fetchone(), "promo redemption left the hot database"
+    finally:
+        conn.close()
+
+
+@check
+def check_sales_charts(bot_module) -> None:
+    import sales_charts
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    stamp = now.isoformat()
+    item = '[{"category": "VOZOL Gear 20000", "flavor": "Mint", "price": 1300}]'
+    rows = [
+        (1, stamp, "try", 1, 5, 1300, item),
+        # Заказ 7 отменён после доставки: LEFT JOIN даёт NULL вместо заказа.
+        (2, stamp, "usd", 1, 7, None, None),
+    ]
+    day = now.astimezone(datetime.timezone(datetime.timedelta(hours=3))).strftime("%Y-%m-%d")
+    frame = sales_charts.delivery_frame(rows, "Europe/Moscow")
+    units = sales_charts.units_by_category(frame)
+    assert units.to_dict() == {"VOZOL Gear 20000": 1}, f"units: {units.to_dict()}"
+    png = sales_charts.render_sales_charts(rows, day)
+    assert png.startswith(b"\x89PNG"), "not a PNG"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--only", choices=sorted(CHECKS), action="append")
+    args = parser.parse_args()
+
+    data_dir = prepare_sandbox(REPO_DIR)
+    failed = 0
+    try:
+        bot_module = import_bot(data_dir, FakeTelegramAPI(), [], threading.Lock())
+        for name in args.only or CHECKS:
+            try:
+                CHECKS[name](bot_module)
+            except Exception:
+                failed += 1
+                print(f"FAIL {name}\n{traceback.format_exc()}", flush=True)
+            else:
+                print(f"ok   {name}", flush=True)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return failed
+
+
+if __name__ == "__main__":
+    sys.exit(main())